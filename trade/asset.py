@@ -1,17 +1,24 @@
 import dataclasses
 from decimal import Decimal
 from logging import Logger
-from typing import Union
+from typing import Union, Optional
 
 import numpy as np
 
-from trade.model import Position, Trade
+from trade.model import Position, Trade, Precision
 from trade.side import Side
 from trade.strategy.internal.risk import RocDrawDown
 
 
 # TODO: リファクタリング
 class Asset:
+    """
+    資産
+
+    固定小数点モードでは、価格は固定小数点の整数で与えられます。
+    `precision`が与えられた場合、トレードの記録およびログの価格と損益は、その精度でDecimalに変換されます。
+    """
+
     @dataclasses.dataclass
     class Stat:
         num_trade_total: int = 0
@@ -26,13 +33,14 @@ class Asset:
     _log_format: str
     _position: Position
     _last_origin_at: Union[np.datetime64, None]
-    price: Decimal
+    price: Union[Decimal, int]
     roc_total: Decimal
     stat: 'Stat'
 
-    def __init__(self, logger: Logger, log_format: str = 'plain'):
+    def __init__(self, logger: Logger, log_format: str = 'plain', precision: Optional[Precision] = None):
         self._logger = logger
         self._log_format = log_format
+        self._precision = precision
 
         # self._position = Position.NoPosition
         self._last_origin_at = None
@@ -45,8 +53,8 @@ class Asset:
         if self._log_format.lower() == 'tsv':
             self._logger.info('\t'.join(Trade.columns_playback()))
 
-    def new_long_position(self, price: Decimal, decision_at: np.datetime64):
-        if not self.price.is_zero():
+    def new_long_position(self, price: Union[Decimal, int], decision_at: np.datetime64):
+        if self.price:
             self._dd_roc.finish_period()
             dd_roc = Decimal('0')
         else:
@@ -55,8 +63,8 @@ class Asset:
 
         self._new_position(price, Position.Long, decision_at)
 
-    def new_short_position(self, price: Decimal, decision_at: np.datetime64):
-        if self.price.is_zero():
+    def new_short_position(self, price: Union[Decimal, int], decision_at: np.datetime64):
+        if not self.price:
             self._dd_roc.finish_period()
             dd_roc = Decimal('0')
         else:
@@ -65,7 +73,7 @@ class Asset:
 
         self._new_position(price, Position.Short, decision_at)
 
-    def close_position(self, price: Decimal,
+    def close_position(self, price: Union[Decimal, int],
                        origin_at: np.datetime64,
                        decision_at: np.datetime64) -> Decimal:
         """
@@ -77,8 +85,8 @@ class Asset:
         """
         profit = self._calc_profit(price)
 
-        if not profit.is_zero() or not self.price.is_zero():
-            roc = profit / self.price
+        if profit or self.price:
+            roc = Decimal(profit) / self.price
             self.roc_total += roc
 
             self._dd_roc.apply(price)
@@ -87,6 +95,9 @@ class Asset:
             roc = Decimal('0.0')
             roc_drop = Decimal('0.0')
 
+        profit = self._decimal_price(profit)
+        entry, _exit = self._decimal_price(self.price), self._decimal_price(price)
+
         if 0 < profit:
             self.stat.num_trade_profit += 1
             self.stat.sum_profit += profit
@@ -118,8 +129,8 @@ class Asset:
             profit=profit,
             profit_sigma=self.stat.profit_sigma,
             position=self._position,
-            entry=self.price,
-            exit=price,
+            entry=entry,
+            exit=_exit,
             roc_total=self.roc_total,
             profit_factor=self.stat.profit_factor,
             probability_of_win=self.stat.probability_of_win,
@@ -139,7 +150,7 @@ class Asset:
                 'close asset (at:{}, profit:{}, profit(sigma):{}, position:{}, entry:{}, exit:{}, roc(total):{:.4%}'
                 ', pl:{:.3}, pf_trade_ratio: {:.2%}, roc(indiv):{:.4%}, dd:{:.4%}, reversal:{}'
                 ', hold:{}, hold_mins:{})'.format(
-                    decision_at, profit, self.stat.profit_sigma, self._position, self.price, price,
+                    decision_at, profit, self.stat.profit_sigma, self._position, entry, _exit,
                     self.roc_total, self.stat.profit_factor, self.stat.probability_of_win, roc, roc_drop,
                     '0',
                     hold_in_ns, hold_in_min
@@ -151,14 +162,16 @@ class Asset:
 
         return roc
 
-    def _new_position(self, price: Decimal, position: Position, decision_at: np.datetime64):
+    def _new_position(self, price: Union[Decimal, int], position: Position, decision_at: np.datetime64):
         if self._log_format.lower() == 'plain':
-            self._logger.info('open asset ({}, entry:{}, decision_at:{})'.format(position, price, decision_at))
+            self._logger.info('open asset ({}, entry:{}, decision_at:{})'.format(
+                position, self._decimal_price(price), decision_at
+            ))
 
         self.price = price
         self._position = position
 
-    def _calc_profit(self, price: Decimal):
+    def _calc_profit(self, price: Union[Decimal, int]) -> Union[Decimal, int]:
         if self._position is Position.NoPosition:
             return Decimal('0')
         elif self._position is Position.Long:
@@ -168,6 +181,11 @@ class Asset:
         else:
             raise Exception('Unexpected position: {}'.format(self._position))
 
+    def _decimal_price(self, price: Union[Decimal, int]) -> Union[Decimal, int]:
+        if self._precision is None:
+            return price
+        return self._precision.decimal_price(price)
+
     def __str__(self):
         if self._log_format.lower() == 'plain':
             return ''
@@ -1,11 +1,11 @@
 from dataclasses import dataclass
 from decimal import Decimal
 from logging import Logger
-from typing import AsyncIterable
+from typing import AsyncIterable, Optional, Union
 
 from trade.asset import Asset
 from trade.execution.model import Execution
-from trade.model import Position
+from trade.model import Position, Precision, to_fixed_point
 from trade.side import Side
 from trade.sign import Signal
 from trade.strategy import BaseStrategy
@@ -14,18 +14,26 @@ from trade.strategy import BaseStrategy
 async def stub_broker(logger: Logger,
                       reader: AsyncIterable[Execution],
                       strategy: BaseStrategy,
-                      losscut: Decimal):
+                      losscut: Decimal,
+                      precision: Optional[Precision] = None):
     """
     必ず約定する理想的なbroker
+
+    `precision`が与えられた場合、固定小数点モードで動作します。
+    Executionの価格は固定小数点の整数で、`losscut`はその精度の整数に変換されます。
     """
 
     @dataclass
     class _Entered:
         position: Position
-        price: Decimal
+        price: Union[Decimal, int]
+
+    if precision is not None:
+        losscut = to_fixed_point(losscut, precision.price)
 
     execution: Execution
-    asset: Asset = Asset(logger, log_format='tsv')  # TODO: Assetがreversalを正しく表示できるように（いまは常にFalse）
+    # TODO: Assetがreversalを正しく表示できるように（いまは常にFalse）
+    asset: Asset = Asset(logger, log_format='tsv', precision=precision)
     entered: _Entered = _Entered(position=Position.NoPosition, price=Decimal('NaN'))
 
     async for execution in reader:
@@ -1,12 +1,15 @@
 from dataclasses import dataclass
 from decimal import Decimal
-from typing import Union, Optional, Mapping
+from types import MappingProxyType
+from typing import Union, Optional, Mapping, Dict, Any, Sequence, Iterator
 
 import numpy as np
 
-from trade.model import Symbol
+from trade.model import Symbol, Precision, to_fixed_point, from_fixed_point
 from trade.side import Side
 
+_EMPTY_ATTRS: Mapping[str, Any] = MappingProxyType(dict())
+
 
 @dataclass
 class SwitchedToRealtime:
@@ -36,14 +39,28 @@ def encode_bitflyer_channel(channel: str) -> Symbol:
 
 
 class Execution:
+    """
+    約定
+
+    大量に生成されるため、`__slots__`によりインスタンス毎の`__dict__`を持ちません。
+    `attrs`は、追加の属性が与えられた場合か、参照された場合にだけ確保されます。
+
+    固定小数点モードでは、価格およびサイズはシンボル毎の精度 (`Precision.of`) による整数です。
+    """
+
+    __slots__ = ('symbol', '_id', 'timestamp', 'side', 'price', 'size',
+                 'buy_child_order_acceptance_id', 'sell_child_order_acceptance_id',
+                 'timeunit_if_ohlc_from',
+                 'synchronized_execution_price_deviation', 'synchronized_execution_time_delta',
+                 'synchronized_execution', '_attrs')
 
     def __init__(self,
                  symbol: Symbol,
                  _id: Union[int, SwitchedToRealtime, None],
                  timestamp: np.datetime64,
                  side: Optional[Side],
-                 price: Decimal,
-                 size: Decimal,
+                 price: Union[Decimal, int],
+                 size: Union[Decimal, int],
                  buy_child_order_acceptance_id: str,
                  sell_child_order_acceptance_id: str,
                  timeunit_if_ohlc_from: Optional[np.timedelta64] = None,
@@ -66,7 +83,17 @@ class Execution:
         self.synchronized_execution_price_deviation = synchronized_execution_price_deviation
         self.synchronized_execution_time_delta = synchronized_execution_time_delta
         self.synchronized_execution = synchronized_execution
-        self.attrs = attrs
+        self._attrs = attrs or None
+
+    @property
+    def attrs(self) -> Dict[str, Any]:
+        if self._attrs is None:
+            self._attrs = dict()
+        return self._attrs
+
+    @attrs.setter
+    def attrs(self, value: Dict[str, Any]):
+        self._attrs = value
 
     def __str__(self):
         return f'{self.__class__.__name__}(symbol={self.symbol.value}' \
@@ -105,18 +132,27 @@ class Execution:
                self.synchronized_execution_price_deviation == other.synchronized_execution_price_deviation and \
                self.synchronized_execution_time_delta == other.synchronized_execution_time_delta and \
                self.synchronized_execution == other.synchronized_execution and \
-               self.attrs == other.attrs
+               (self._attrs or _EMPTY_ATTRS) == (other._attrs or _EMPTY_ATTRS)
 
     @staticmethod
     def encode_bitflyer_response(symbol: Symbol,
-                                 dictobj: Mapping[str, Union[str, int]]) -> 'Execution':
+                                 dictobj: Mapping[str, Union[str, int]],
+                                 fixed_point: bool = False) -> 'Execution':
+        """
+        :param fixed_point: Trueの場合、価格およびサイズをシンボル毎の精度による固定小数点の整数で返します。
+        """
+        price, size = Decimal(str(dictobj['price'])), Decimal(str(dictobj['size']))
+        if fixed_point:
+            precision = Precision.of(symbol)
+            price, size = to_fixed_point(price, precision.price), to_fixed_point(size, precision.size)
+
         return Execution(
             symbol=symbol,
             _id=dictobj['id'],
             timestamp=np.datetime64(dictobj['exec_date'].rstrip('Z'), 'ns', utc=True),
             side=dictobj['side'] and Side(dictobj['side']) or Side.NOTHING,
-            price=Decimal(str(dictobj['price'])),
-            size=Decimal(str(dictobj['size'])),
+            price=price,
+            size=size,
             buy_child_order_acceptance_id=dictobj['buy_child_order_acceptance_id'],
             sell_child_order_acceptance_id=dictobj['sell_child_order_acceptance_id'],
         )
@@ -146,23 +182,49 @@ class Execution:
             buy_child_order_acceptance_id=execution.buy_child_order_acceptance_id,
             sell_child_order_acceptance_id=execution.sell_child_order_acceptance_id,
             timeunit_if_ohlc_from=timeunit_if_ohlc_from,
-            synchronized_execution_price_deviation=synchronized_execution and (
-                    execution.price - synchronized_execution.price) / execution.price,
+            synchronized_execution_price_deviation=synchronized_execution and _price_deviation(
+                execution, synchronized_execution),
             synchronized_execution_time_delta=synchronized_execution and (
                     synchronized_execution.timestamp - execution.timestamp),
             synchronized_execution=synchronized_execution
         )
 
 
+def _price_deviation(execution: Execution, synchronized_execution: 'SynchronizedExecution') -> Decimal:
+    """
+    主の約定に対する、副の約定の価格の乖離率を返します。
+
+    価格が固定小数点の整数の場合、シンボル毎の精度を揃えてから計算します。乖離率は常にDecimalです。
+    """
+    price, synchronized_price = execution.price, synchronized_execution.price
+    if isinstance(price, int) and isinstance(synchronized_price, int):
+        shift = Precision.of(execution.symbol).price - Precision.of(synchronized_execution.symbol).price
+        if shift > 0:
+            synchronized_price *= 10 ** shift
+        elif shift < 0:
+            price *= 10 ** -shift
+        return Decimal(price - synchronized_price) / Decimal(price)
+
+    return (price - synchronized_price) / price
+
+
 class SynchronizedExecution:
+    """
+    Executionに同期された、副の約定
+
+    全ての属性が`None`であるSynchronizedExecutionは、`None`と等価です。
+    """
+
+    __slots__ = ('symbol', '_id', 'timestamp', 'side', 'price', 'size',
+                 'buy_child_order_acceptance_id', 'sell_child_order_acceptance_id', '_attrs')
 
     def __init__(self,
                  symbol: Optional[Symbol] = None,
                  _id: Union[int, SwitchedToRealtime] = None,
                  timestamp: Optional[np.datetime64] = None,
                  side: Optional[Side] = None,
-                 price: Optional[Decimal] = None,
-                 size: Optional[Decimal] = None,
+                 price: Union[Decimal, int, None] = None,
+                 size: Union[Decimal, int, None] = None,
                  buy_child_order_acceptance_id: Optional[str] = None,
                  sell_child_order_acceptance_id: Optional[str] = None,
                  **attrs):
@@ -174,7 +236,31 @@ class SynchronizedExecution:
         self.size = size
         self.buy_child_order_acceptance_id = buy_child_order_acceptance_id
         self.sell_child_order_acceptance_id = sell_child_order_acceptance_id
-        self.attrs = attrs
+        self._attrs = attrs or None
+
+    @property
+    def attrs(self) -> Dict[str, Any]:
+        if self._attrs is None:
+            self._attrs = dict()
+        return self._attrs
+
+    @attrs.setter
+    def attrs(self, value: Dict[str, Any]):
+        self._attrs = value
+
+    def is_empty(self) -> bool:
+        """
+        全ての属性が`None`であるか
+        """
+        return self.symbol is None and \
+               self._id is None and \
+               self.timestamp is None and \
+               self.side is None and \
+               self.price is None and \
+               self.size is None and \
+               self.buy_child_order_acceptance_id is None and \
+               self.sell_child_order_acceptance_id is None and \
+               not self._attrs
 
     def __str__(self):
         return f'{self.__class__.__name__}(symbol={self.symbol and self.symbol.value}' \
@@ -203,7 +289,10 @@ class SynchronizedExecution:
                f'{self.sell_child_order_acceptance_id and self.sell_child_order_acceptance_id!r}' \
                f', attrs={self.attrs!r})'
 
-    def __eq__(self, other: 'SynchronizedExecution'):
+    def __eq__(self, other: Optional['SynchronizedExecution']):
+        if other is None:
+            return self.is_empty()
+
         return self.symbol == other.symbol and \
                self._id == other._id and \
                self.timestamp == other.timestamp and \
@@ -212,7 +301,7 @@ class SynchronizedExecution:
                self.size == other.size and \
                self.buy_child_order_acceptance_id == other.buy_child_order_acceptance_id and \
                self.sell_child_order_acceptance_id == other.sell_child_order_acceptance_id and \
-               self.attrs == other.attrs
+               (self._attrs or _EMPTY_ATTRS) == (other._attrs or _EMPTY_ATTRS)
 
     @staticmethod
     def from_execution(e: Execution):
@@ -220,5 +309,270 @@ class SynchronizedExecution:
             symbol=e.symbol, _id=e._id, timestamp=e.timestamp, side=e.side, price=e.price, size=e.size,
             buy_child_order_acceptance_id=e.buy_child_order_acceptance_id,
             sell_child_order_acceptance_id=e.sell_child_order_acceptance_id,
-            **e.attrs
+            **(e._attrs or _EMPTY_ATTRS)
         )
+
+
+_SIDE_TO_CODE: Mapping[Optional[Side], int] = {Side.BUY: 1, Side.SELL: -1, Side.NOTHING: 0, None: 0}
+_CODE_TO_SIDE: Mapping[int, Side] = {1: Side.BUY, -1: Side.SELL, 0: Side.NOTHING}
+_BITFLYER_SIDE_TO_CODE: Mapping[Optional[str], int] = {'BUY': 1, 'SELL': -1, '': 0, None: 0}
+
+
+class ExecutionBatch:
+    """
+    Executionを列指向で保持する、NumPy配列のバッチ
+
+    各列は次の型で保持されます。
+
+    - ids: int64
+    - timestamps: int64 (UNIXエポックからのナノ秒)
+    - sides: int8 (BUY: 1, SELL: -1, NOTHING: 0)
+    - prices: int64 (10の`price_precision`乗倍した固定小数点)
+    - sizes: int64 (10の`size_precision`乗倍した固定小数点)
+
+    `synchronized`は行ごとに同期された副のバッチで、`synchronized_mask`がFalseの行は副の約定が存在しないことをあらわします。
+
+    イテレーションすると、行ごとのExecutionオブジェクトに展開されます。
+    """
+
+    __slots__ = ('symbol', 'ids', 'timestamps', 'sides', 'prices', 'sizes',
+                 'buy_child_order_acceptance_ids', 'sell_child_order_acceptance_ids',
+                 'price_precision', 'size_precision', 'synchronized', 'synchronized_mask')
+
+    def __init__(self,
+                 symbol: Symbol,
+                 ids: np.ndarray,
+                 timestamps: np.ndarray,
+                 sides: np.ndarray,
+                 prices: np.ndarray,
+                 sizes: np.ndarray,
+                 buy_child_order_acceptance_ids: Optional[np.ndarray] = None,
+                 sell_child_order_acceptance_ids: Optional[np.ndarray] = None,
+                 price_precision: Optional[int] = None,
+                 size_precision: Optional[int] = None,
+                 synchronized: Optional['ExecutionBatch'] = None,
+                 synchronized_mask: Optional[np.ndarray] = None):
+        self.symbol = symbol
+        self.ids = ids
+        self.timestamps = timestamps
+        self.sides = sides
+        self.prices = prices
+        self.sizes = sizes
+        self.buy_child_order_acceptance_ids = buy_child_order_acceptance_ids
+        self.sell_child_order_acceptance_ids = sell_child_order_acceptance_ids
+        self.price_precision = Precision.of(symbol).price if price_precision is None else price_precision
+        self.size_precision = Precision.of(symbol).size if size_precision is None else size_precision
+        self.synchronized = synchronized
+        self.synchronized_mask = synchronized_mask
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getitem__(self, key: Union[slice, np.ndarray]) -> 'ExecutionBatch':
+        """
+        スライス、インデックス配列、またはブール配列で選択された行からなるバッチを返します。
+        """
+        def _take(column: Optional[Any]) -> Optional[Any]:
+            return None if column is None else column[key]
+
+        return ExecutionBatch(
+            symbol=self.symbol,
+            ids=self.ids[key],
+            timestamps=self.timestamps[key],
+            sides=self.sides[key],
+            prices=self.prices[key],
+            sizes=self.sizes[key],
+            buy_child_order_acceptance_ids=_take(self.buy_child_order_acceptance_ids),
+            sell_child_order_acceptance_ids=_take(self.sell_child_order_acceptance_ids),
+            price_precision=self.price_precision,
+            size_precision=self.size_precision,
+            synchronized=_take(self.synchronized),
+            synchronized_mask=_take(self.synchronized_mask),
+        )
+
+    def __iter__(self) -> Iterator[Execution]:
+        return self.executions()
+
+    def executions(self, fixed_point: bool = False) -> Iterator[Execution]:
+        """
+        行ごとのExecutionオブジェクトに展開します。
+
+        :param fixed_point: Trueの場合、価格およびサイズはDecimalに変換されず、固定小数点の整数のままセットされます。
+        この場合、バッチの精度はシンボル毎の精度 (`Precision.of`) と一致している必要があります。
+        """
+        if fixed_point and Precision.of(self.symbol) != Precision(price=self.price_precision, size=self.size_precision):
+            raise ValueError(f'Precision is not same as the symbol: {self.symbol}')
+
+        buy_ids = self.buy_child_order_acceptance_ids
+        sell_ids = self.sell_child_order_acceptance_ids
+        mask = self.synchronized_mask
+        synchronized = None if self.synchronized is None else [
+            SynchronizedExecution.from_execution(e) for e in self.synchronized.executions(fixed_point)
+        ]
+
+        prices = self.prices.tolist()
+        sizes = self.sizes.tolist()
+        if not fixed_point:
+            prices = [from_fixed_point(price, self.price_precision) for price in prices]
+            sizes = [from_fixed_point(size, self.size_precision) for size in sizes]
+
+        for n, (_id, timestamp, side, price, size) in enumerate(zip(
+                self.ids.tolist(), self.timestamps.tolist(), self.sides.tolist(), prices, sizes)):
+            execution = Execution(
+                symbol=self.symbol,
+                _id=_id,
+                timestamp=np.datetime64(timestamp, 'ns'),
+                side=_CODE_TO_SIDE[side],
+                price=price,
+                size=size,
+                buy_child_order_acceptance_id=None if buy_ids is None else buy_ids[n],
+                sell_child_order_acceptance_id=None if sell_ids is None else sell_ids[n],
+            )
+            if synchronized is not None:
+                execution = Execution.wrap(
+                    execution, synchronized_execution=synchronized[n] if mask[n] else None
+                )
+            yield execution
+
+    @staticmethod
+    def from_executions(symbol: Symbol,
+                        executions: Sequence[Execution],
+                        price_precision: Optional[int] = None,
+                        size_precision: Optional[int] = None) -> 'ExecutionBatch':
+        """
+        Executionのシーケンスからバッチを組み立てます。
+
+        Executionの価格およびサイズは、Decimalと固定小数点の整数のどちらでも構いません。
+        精度が指定されない場合、シンボル毎の精度 (`Precision.of`) が使われます。
+        固定小数点の整数は、その精度であるものとして扱われます。
+        """
+        batch = ExecutionBatch._from_objects(symbol, executions, price_precision, size_precision)
+
+        synchronized = [e.synchronized_execution for e in executions]
+        mask = np.array([s is not None and not s.is_empty() for s in synchronized], dtype=bool)
+        if mask.any():
+            placeholder: SynchronizedExecution = synchronized[int(np.argmax(mask))]
+            batch.synchronized = ExecutionBatch._from_objects(
+                placeholder.symbol,
+                [s if m else placeholder for m, s in zip(mask.tolist(), synchronized)],
+                price_precision,
+                size_precision,
+            )
+            batch.synchronized_mask = mask
+
+        return batch
+
+    @staticmethod
+    def encode_bitflyer_responses(symbol: Symbol,
+                                  dictobjs: Sequence[Mapping[str, Any]],
+                                  price_precision: Optional[int] = None,
+                                  size_precision: Optional[int] = None) -> 'ExecutionBatch':
+        """
+        bitFlyerの約定のJSONオブジェクトのシーケンスから、タイムスタンプ、価格およびサイズを列単位でまとめて変換した
+        バッチを組み立てます。
+
+        価格およびサイズは、精度を超える桁が丸められます。精度が指定されない場合、シンボル毎の精度 (`Precision.of`) が使われます。
+        """
+        precision = Precision.of(symbol)
+        price_precision = precision.price if price_precision is None else price_precision
+        size_precision = precision.size if size_precision is None else size_precision
+
+        return ExecutionBatch(
+            symbol=symbol,
+            ids=np.array([d['id'] for d in dictobjs], dtype=np.int64),
+            timestamps=np.array([d['exec_date'].rstrip('Z') for d in dictobjs], dtype='datetime64[ns]').view(np.int64),
+            sides=np.array([_BITFLYER_SIDE_TO_CODE[d['side']] for d in dictobjs], dtype=np.int8),
+            prices=_to_fixed_point_array([d['price'] for d in dictobjs], price_precision),
+            sizes=_to_fixed_point_array([d['size'] for d in dictobjs], size_precision),
+            buy_child_order_acceptance_ids=np.array(
+                [d['buy_child_order_acceptance_id'] for d in dictobjs], dtype=object
+            ),
+            sell_child_order_acceptance_ids=np.array(
+                [d['sell_child_order_acceptance_id'] for d in dictobjs], dtype=object
+            ),
+            price_precision=price_precision,
+            size_precision=size_precision,
+        )
+
+    @staticmethod
+    def _from_objects(symbol: Symbol,
+                      objects: Sequence[Union[Execution, 'SynchronizedExecution']],
+                      price_precision: Optional[int],
+                      size_precision: Optional[int]) -> 'ExecutionBatch':
+        precision = Precision.of(symbol)
+        price_precision = precision.price if price_precision is None else price_precision
+        size_precision = precision.size if size_precision is None else size_precision
+
+        def _fixed(value: Union[int, Decimal], _precision: int) -> int:
+            return value if isinstance(value, int) else to_fixed_point(value, _precision)
+
+        return ExecutionBatch(
+            symbol=symbol,
+            ids=np.array([o._id for o in objects], dtype=np.int64),
+            timestamps=np.array([o.timestamp for o in objects], dtype='datetime64[ns]').view(np.int64),
+            sides=np.array([_SIDE_TO_CODE[o.side] for o in objects], dtype=np.int8),
+            prices=np.array([_fixed(o.price, price_precision) for o in objects], dtype=np.int64),
+            sizes=np.array([_fixed(o.size, size_precision) for o in objects], dtype=np.int64),
+            buy_child_order_acceptance_ids=np.array([o.buy_child_order_acceptance_id for o in objects], dtype=object),
+            sell_child_order_acceptance_ids=np.array(
+                [o.sell_child_order_acceptance_id for o in objects], dtype=object
+            ),
+            price_precision=price_precision,
+            size_precision=size_precision,
+        )
+
+    @staticmethod
+    def concatenate(batches: Sequence['ExecutionBatch']) -> 'ExecutionBatch':
+        """
+        同じシンボルおよび精度のバッチを連結します。シンボルまたは精度の異なるバッチがある場合は、ValueErrorを送出します。
+        """
+        for b in batches[1:]:
+            if (b.symbol, b.price_precision, b.size_precision) != \
+                    (batches[0].symbol, batches[0].price_precision, batches[0].size_precision):
+                raise ValueError(f'cannot concatenate batches of different symbol or precision: '
+                                 f'{batches[0].symbol}, {batches[0].price_precision}, {batches[0].size_precision} '
+                                 f'and {b.symbol}, {b.price_precision}, {b.size_precision}')
+
+        batches = [b for b in batches if len(b)] or batches[:1]
+        first = batches[0]
+        if len(batches) == 1:
+            return first
+
+        def _concat(name: str) -> Optional[np.ndarray]:
+            columns = [getattr(b, name) for b in batches]
+            if any(c is None for c in columns):
+                return None
+            return np.concatenate(columns)
+
+        batch = ExecutionBatch(
+            symbol=first.symbol,
+            ids=_concat('ids'),
+            timestamps=_concat('timestamps'),
+            sides=_concat('sides'),
+            prices=_concat('prices'),
+            sizes=_concat('sizes'),
+            buy_child_order_acceptance_ids=_concat('buy_child_order_acceptance_ids'),
+            sell_child_order_acceptance_ids=_concat('sell_child_order_acceptance_ids'),
+            price_precision=first.price_precision,
+            size_precision=first.size_precision,
+        )
+
+        if any(b.synchronized is not None for b in batches):
+            placeholder = next(b.synchronized for b in batches if b.synchronized is not None)
+            batch.synchronized = ExecutionBatch.concatenate([
+                b.synchronized if b.synchronized is not None else placeholder[np.zeros(len(b), dtype=np.int64)]
+                for b in batches
+            ])
+            batch.synchronized_mask = np.concatenate([
+                b.synchronized_mask if b.synchronized is not None else np.zeros(len(b), dtype=bool)
+                for b in batches
+            ])
+
+        return batch
+
+
+def _to_fixed_point_array(values: Sequence[Union[int, float]], precision: int) -> np.ndarray:
+    """
+    JSONの数値のリストを、10の`precision`乗倍した整数の配列に変換します。
+    """
+    return np.rint(np.array(values, dtype=np.float64) * 10 ** precision).astype(np.int64)
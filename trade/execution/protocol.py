@@ -0,0 +1,206 @@
+import re
+import struct
+from enum import Enum
+from itertools import groupby
+from json import dumps
+from typing import Dict, Any, Optional, Sequence, List, Tuple
+from urllib.parse import urlparse, urlencode, parse_qsl, urlunparse
+
+import numpy as np
+
+from trade.execution.model import SwitchedToRealtime, Execution, ExecutionBatch
+from trade.model import Symbol, Precision, to_fixed_point
+from trade.side import Side
+
+# WarmUpExecutionWebSocketProxyServer と RealtimeWebSocketStream の間のフレーム形式
+#
+# 約定のフレームは、bitFlyerの約定のJSONオブジェクト（`channel`を含む）です。
+# バッチのフレームは、約定のJSONオブジェクトの配列です。接続するURIのクエリで`batch_size`を指定したクライアントにだけ、
+# 最大`batch_size`件の約定をひとつのフレームで送ります。
+# 制御のフレームは、種類をあらわす`type`を持つJSONオブジェクトです。約定のJSONオブジェクトは`type`を持ちません。
+#
+#     {"type": "SwitchedToRealtime", "symbol": "FXBTCJPY", "timestamp": "2019-07-07T08:59:58.877569400"}
+#
+# URIのクエリで`encoding=binary`を指定したクライアントには、約定をバイナリのフレーム (WebSocketのバイナリメッセージ) で送ります。
+# 制御のフレームは、この場合もJSONのテキストメッセージです。バイナリのフレームは、リトルエンディアンの次の並びです。
+#
+#     ヘッダ       : バージョン (uint8)、フラグ (uint8)、約定数 (uint32)
+#     約定数個     : id (int64)、timestamp (int64, UNIXエポックからのナノ秒)、
+#                    price (int64)、size (int64) (シンボル毎の精度 `Precision.of` による固定小数点)、
+#                    side (int8, BUY: 1, SELL: -1, NOTHING: 0)、symbol (uint8, `Symbol`の定義順の番号)
+#     約定数個     : フラグに`FLAG_ACCEPTANCE_IDS`がある場合のみ、buyおよびsellのacceptance id
+#                    (それぞれ長さ (uint8) とASCII文字列。Noneは長さ0)
+CONTROL_TYPE = 'type'
+
+# 1フレームに含める約定の最大数を要求する、URIのクエリのパラメータ
+BATCH_SIZE_PARAMETER = 'batch_size'
+
+# 約定のフレームの形式を要求する、URIのクエリのパラメータ
+ENCODING_PARAMETER = 'encoding'
+
+# バイナリのフレームにacceptance idを含めるかを要求する、URIのクエリのパラメータ (1または0)
+ACCEPTANCE_IDS_PARAMETER = 'acceptance_ids'
+
+
+class Encoding(Enum):
+    """
+    約定のフレームの形式
+    """
+
+    JSON = 'json'
+    BINARY = 'binary'
+
+
+BINARY_VERSION = 1
+FLAG_ACCEPTANCE_IDS = 0x01
+
+_BINARY_HEADER = struct.Struct('<BBI')
+_BINARY_RECORD = struct.Struct('<qqqqbB')
+_BINARY_RECORD_DTYPE = np.dtype([
+    ('id', '<i8'), ('timestamp', '<i8'), ('price', '<i8'), ('size', '<i8'), ('side', 'i1'), ('symbol', 'u1'),
+])
+_BINARY_SIDE_TO_CODE: Dict[Optional[Side], int] = {Side.BUY: 1, Side.SELL: -1, Side.NOTHING: 0, None: 0}
+_SYMBOLS: List[Symbol] = list(Symbol)
+_SYMBOL_CODES: Dict[Symbol, int] = {symbol: code for code, symbol in enumerate(_SYMBOLS)}
+
+# 移行期間中に受け付ける、SwitchedToRealtime.__repr__ による旧形式のフレーム
+_LEGACY_SWITCHED_TO_REALTIME = re.compile(
+    r'SwitchedToRealtime\(symbol=Symbol\.(\w+), timestamp=numpy\.datetime64\("([^"]+)", "ns"(?:, utc=True)?\)\)'
+)
+
+
+def encode_control_frame(control: SwitchedToRealtime) -> str:
+    """
+    制御のオブジェクトを、制御のフレームに変換して返します。
+    """
+    if isinstance(control, SwitchedToRealtime):
+        return dumps({
+            CONTROL_TYPE: SwitchedToRealtime.__name__,
+            'symbol': control.symbol.value,
+            'timestamp': str(np.datetime64(control.timestamp, 'ns')),
+        })
+
+    raise TypeError(f'unsupported control: {control!r}')
+
+
+def encode_batch_frame(raw_responses: Sequence[str]) -> str:
+    """
+    約定のJSONオブジェクトの文字列を、再エンコードせずにバッチのフレームに連結して返します。
+    """
+    return '[' + ','.join(raw_responses) + ']'
+
+
+def build_client_uri(uri: str, parameters: Dict[str, Any]) -> str:
+    """
+    値がNoneでないパラメータを、URIのクエリに追加して返します。
+    """
+    parsed = urlparse(uri)
+    query = parse_qsl(parsed.query) + [(key, str(value)) for key, value in parameters.items() if value is not None]
+    return urlunparse(parsed._replace(query=urlencode(query)))
+
+
+def is_control_message(message: Dict[str, Any]) -> bool:
+    """
+    デコードしたフレームが、制御のフレームであるかを返します。
+    """
+    return CONTROL_TYPE in message
+
+
+def decode_control_message(message: Dict[str, Any]) -> Optional[SwitchedToRealtime]:
+    """
+    デコードした制御のフレームを、制御のオブジェクトに変換して返します。
+    このバージョンが知らない種類の制御のフレームの場合は、Noneを返します。
+    """
+    if message[CONTROL_TYPE] == SwitchedToRealtime.__name__:
+        return SwitchedToRealtime(
+            symbol=Symbol(message['symbol']), timestamp=np.datetime64(message['timestamp'], 'ns')
+        )
+
+    return None
+
+
+def decode_legacy_control_frame(frame: str) -> Optional[SwitchedToRealtime]:
+    """
+    `eval`せずに、旧形式のSwitchedToRealtimeのフレームを変換して返します。旧形式でない場合は、Noneを返します。
+    """
+    match = _LEGACY_SWITCHED_TO_REALTIME.fullmatch(frame)
+    if not match:
+        return None
+
+    return SwitchedToRealtime(symbol=Symbol[match.group(1)], timestamp=np.datetime64(match.group(2), 'ns'))
+
+
+def encode_binary_record(execution: Execution) -> Tuple[bytes, bytes]:
+    """
+    約定を、バイナリのフレームの固定長のレコードと、acceptance idの部分に変換して返します。
+
+    約定の価格およびサイズは、Decimalとシンボル毎の精度による固定小数点の整数のどちらでも構いません。
+    """
+    precision = Precision.of(execution.symbol)
+    price, size = execution.price, execution.size
+    record = _BINARY_RECORD.pack(
+        execution._id,
+        np.datetime64(execution.timestamp, 'ns').item(),
+        price if isinstance(price, int) else to_fixed_point(price, precision.price),
+        size if isinstance(size, int) else to_fixed_point(size, precision.size),
+        _BINARY_SIDE_TO_CODE[execution.side],
+        _SYMBOL_CODES[execution.symbol],
+    )
+    return record, _encode_acceptance_id(execution.buy_child_order_acceptance_id) + \
+        _encode_acceptance_id(execution.sell_child_order_acceptance_id)
+
+
+def encode_binary_frame(records: Sequence[bytes], acceptance_ids: Optional[Sequence[bytes]] = None) -> bytes:
+    """
+    `encode_binary_record`で変換したレコードを、バイナリのフレームに連結して返します。
+    """
+    header = _BINARY_HEADER.pack(BINARY_VERSION, FLAG_ACCEPTANCE_IDS if acceptance_ids is not None else 0, len(records))
+    return b''.join([header, *records, *(acceptance_ids or [])])
+
+
+def decode_binary_frame(frame: bytes) -> List[ExecutionBatch]:
+    """
+    バイナリのフレームを、連続した同じシンボルの約定毎のExecutionBatchに変換して返します。
+    """
+    version, flags, count = _BINARY_HEADER.unpack_from(frame)
+    if version != BINARY_VERSION:
+        raise ValueError(f'unsupported binary frame version: {version}')
+
+    records = np.frombuffer(frame, dtype=_BINARY_RECORD_DTYPE, count=count, offset=_BINARY_HEADER.size)
+    buy_ids: Optional[np.ndarray] = None
+    sell_ids: Optional[np.ndarray] = None
+    if flags & FLAG_ACCEPTANCE_IDS:
+        ids = _decode_acceptance_ids(frame, _BINARY_HEADER.size + records.nbytes, count * 2)
+        buy_ids, sell_ids = np.array(ids[0::2], dtype=object), np.array(ids[1::2], dtype=object)
+
+    batches: List[ExecutionBatch] = list()
+    begin = 0
+    for code, group in groupby(records['symbol'].tolist()):
+        end = begin + len(list(group))
+        symbol = _SYMBOLS[code]
+        batches.append(ExecutionBatch(
+            symbol=symbol,
+            ids=records['id'][begin:end].copy(),
+            timestamps=records['timestamp'][begin:end].copy(),
+            sides=records['side'][begin:end].copy(),
+            prices=records['price'][begin:end].copy(),
+            sizes=records['size'][begin:end].copy(),
+            buy_child_order_acceptance_ids=None if buy_ids is None else buy_ids[begin:end],
+            sell_child_order_acceptance_ids=None if sell_ids is None else sell_ids[begin:end],
+        ))
+        begin = end
+    return batches
+
+
+def _encode_acceptance_id(acceptance_id: Optional[str]) -> bytes:
+    encoded = (acceptance_id or '').encode('ascii')
+    return bytes((len(encoded),)) + encoded
+
+
+def _decode_acceptance_ids(frame: bytes, offset: int, count: int) -> List[Optional[str]]:
+    ids: List[Optional[str]] = list()
+    for _ in range(count):
+        length = frame[offset]
+        ids.append(frame[offset + 1:offset + 1 + length].decode('ascii') or None)
+        offset += 1 + length
+    return ids
@@ -1,20 +1,62 @@
 import asyncio
+from bisect import bisect_right
 from collections import deque
+from dataclasses import dataclass
+from enum import Enum
 from functools import partial
 from logging import Logger
-from typing import Deque, Iterable, Dict
+from typing import Deque, Dict, List, TypeVar, Generic, Optional, Union
 
 import numpy as np
 import pandas as pd
 
-from trade.execution.model import Execution
+from trade.execution.model import Execution, SwitchedToRealtime
+
+
+class SlowConsumerPolicy(Enum):
+    """
+    クライアントの未取得の要素数が上限を超えた時の動作
+    """
+
+    # 以後の取得で`SlowConsumerError`を送出します
+    DISCONNECT = 'disconnect'
+
+    # 古い要素から捨て、未取得の要素数を上限に保ちます
+    DROP_OLDEST = 'drop-oldest'
+
+    # 最新の要素だけを残して捨てます
+    CONFLATE = 'conflate'
+
+
+class SlowConsumerError(Exception):
+    """
+    クライアントの未取得の要素数が上限を超えたため、切断されたことをあらわす
+    """
+    pass
+
+
+@dataclass
+class ClientStats:
+    """
+    クライアント毎の統計
+    """
+
+    # 未取得の要素数
+    depth: int
+
+    # 上限を超えたために捨てた要素数
+    dropped: int
+
+    # SlowConsumerPolicy.DISCONNECT により切断されたか
+    disconnected: bool
 
 
 class TimeWindowExecutionQueue:
     """
     保持期間付きの、約定を要素とするキュー
 
-    `spawn_queue`を呼び出すと、クライアント専用に保持期間分の要素が確保されます。
+    `spawn_queue`を呼び出すと、クライアント専用の読み出し位置（カーソル）が保持期間の先頭に作られます。
+    要素はすべてのクライアントが共有するバッファに一度だけ保持され、クライアント毎には複製されません。
     保持期間分およびリアルタイムの要素取得は`get`メソッドで行います。
     要素の追加は`put_nowait`メソッドで行います。追加された要素は、すべてのクライアントが取得できます。
     クライアントがこれ以上要素の取得を行わないことを`dispose_queue`メソッドの呼び出しで伝えてください。
@@ -28,11 +70,19 @@ class TimeWindowExecutionQueue:
     その後は、要素が追加されるまで取得は待機されます。
 
     SwitchedToRealtimeオブジェクトを返す前までは、取得する要素は時系列順であることが保証されます。
-    その後の要素取得は、追加された順です（FIFO）。
+    同じtimestampの要素は、追加された順です。
+    ただし、クライアントが既に取得した要素より古い要素が追加された場合、その要素は次に取得されます。
+    SwitchedToRealtimeオブジェクトを返した後の要素取得は、追加された順です（FIFO）。
 
     保持期間内において、古くなった要素は自動的にキューから削除されます。
     削除は、`put_nowait`が呼び出された時に行われます。
     要素が古いことは、次の方法で判定されます。「保持期間 < (追加しようとする約定timestamp - 左端要素の約定timestamp)」
+    保持期間から外れた要素は、すべてのクライアントのカーソルがその要素を過ぎた後にバッファから回収されます。
+    SwitchedToRealtimeオブジェクトを返した後のクライアントは、追加された順に要素を保持する別の共有バッファから取得します。
+
+    `max_depth`が指定された場合、SwitchedToRealtimeオブジェクトを返した後のクライアントの未取得の要素数が
+    これを超えると、`put_nowait`が`SlowConsumerPolicy`に従って要素を捨てるか、クライアントを切断します。
+    保持期間分の要素の取得中は、上限は適用されません。
 
     # time windows が 3 のとき、
     t0, t1, t2, t3
@@ -41,161 +91,338 @@ class TimeWindowExecutionQueue:
 
     """
     - upstream is WebSocket server like BitFlyer web socket server
-    - self._deque is collections.Deque - timed window
-    - self._queues is asyncio.Queue for clients
+    - self._buffer is _SharedBuffer - shared by all clients, [self._window_begin, self._buffer.end) is timed window
+    - self._cursors is read position (^) for each clients
+    - self._arrivals is _SharedBuffer in the order of arrival - read by clients switched to realtime (after `SW`)
 
     # Warming up...
 
     upstream        : e1
-    self._deque     :
+    self._buffer    :
 
     upstream        : e1
-    self._deque     :  e1
+    self._buffer    :  e1
 
     upstream        : e1  e2
-    self._deque     :  e1
-
-    upstream        : e1  e2
-    self._deque     :  e1  e2
-
-    upstream        : e1  e2
-    self._deque     :      e2             <- rotated
+    self._buffer    :  e1  e2
 
     upstream        : e1  e2  e3
-    self._deque     :      e2
-
-    upstream        : e1  e2  e3
-    self._deque     :      e2  e3
+    self._buffer    :      e2  e3         <- rotated, e1 is reclaimed because no cursor points to it
 
     <-- Connect from subscriber-A
 
-    upstream        : e1  e2  e3  e4
-    self._deque     :      e2  e3
-    self._queues[A] :
-
-    upstream        : e1  e2  e3  e4
-    self._deque     :      e2  e3  e4
-    self._queues[A] :       e2  e3
-
-    --> Popped `e2`,`e3` by subscriber-A
-
-    upstream        : e1  e2  e3  e4
-    self._deque     :      e2  e3  e4
-    self._queues[A] :               e4
+    upstream        : e1  e2  e3
+    self._buffer    :      e2  e3
+    self._cursors[A]:      ^
 
-    --> Popped `e4` by subscriber-A
+    --> Popped `e2` by subscriber-A
 
     upstream        : e1  e2  e3  e4
-    self._deque     :      e2  e3  e4
-    self._queues[A] :
+    self._buffer    :      e2  e3  e4     <- e2 left the window, but is kept while A can still read it
+    self._cursors[A]:          ^
 
-    --> Append `SW`
+    --> Popped `e3`,`e4` by subscriber-A
 
     upstream        : e1  e2  e3  e4
-    self._deque     :      e2  e3  e4
-    self._queues[A] :               SW
+    self._buffer    :          e3  e4
+    self._cursors[A]:                  ^
 
     --> Popped `SW` by subscriber-A
 
-    upstream        : e1  e2  e3  e4
-    self._deque     :      e2  e3  e4
-    self._queues[A] :
-
     upstream        : e1  e2  e3  e4  e5
-    self._deque     :      e2  e3  e4  e5
-    self._queues[A] :                   e5
+    self._buffer    :              e4  e5
+    self._cursors[A]:                  ^
 
     <-- Close from subscriber-A
 
     upstream        : e1  e2  e3  e4  e5
-    self._deque     :      e2  e3  e4  e5
+    self._buffer    :              e4  e5
     """
 
     def __init__(self, logger: Logger,
                  time_window: str,
                  switched_to_realtime_partial: partial,
-                 loop=None):
+                 loop=None,
+                 max_depth: Optional[int] = None,
+                 slow_consumer_policy: SlowConsumerPolicy = SlowConsumerPolicy.DISCONNECT):
         self._logger = logger
         self._time_window = pd.to_timedelta(time_window).to_timedelta64()
+        self._time_window_ns: int = int(self._time_window.astype('timedelta64[ns]').astype(np.int64))
         self._switched_to_realtime_partial = switched_to_realtime_partial
         self._loop = loop
         self._window_satisfied = False
+        self._max_depth = max_depth
+        self._slow_consumer_policy = slow_consumer_policy
+
+        # Buffer shared by all clients, holding execution within the time window and not yet read by any client
+        self._buffer: _SharedBuffer[Execution] = _SharedBuffer()
+
+        # Buffer shared by clients switched to realtime, holding executions in the order of arrival
+        self._arrivals: _SharedBuffer[Execution] = _SharedBuffer()
+
+        # Position of the first execution within the time window
+        self._window_begin = 0
+
+        # Read position for each clients
+        self._cursors: Dict[str, _Cursor] = dict()
+
+    def spawn_queue(self, client_id: str,
+                    max_depth: Optional[int] = None,
+                    slow_consumer_policy: Optional[SlowConsumerPolicy] = None):
+        """
+        `max_depth`および`slow_consumer_policy`が指定された場合、このクライアントについてコンストラクタの指定を上書きします。
+        """
+        self._cursors[client_id] = _Cursor(
+            self._window_begin,
+            max_depth=max_depth if max_depth is not None else self._max_depth,
+            slow_consumer_policy=slow_consumer_policy or self._slow_consumer_policy,
+            loop=self._loop,
+        )
 
-        # Queue for holding execution within the time window
-        self._deque: Deque[Execution] = deque()
+    def dispose_queue(self, client_id: str):
+        del self._cursors[client_id]
 
-        # Queue for each clients
-        self._queues: Dict[str, _Queue] = dict()
+    def put_nowait(self, execution: Execution):
+        buffer = self._buffer
+        timestamp = _to_nanoseconds(execution.timestamp)
+
+        # Inserting execution, after the executions of the same timestamp
+        position = buffer.bisect_right(timestamp, lo=self._window_begin)
+        self._insert(position, execution, timestamp)
+        self._arrivals.append(execution, timestamp)
+
+        # Dispose old executions
+        n_pops = 0
+        oldest = buffer.key(buffer.end - 1) - self._time_window_ns
+        while buffer.key(self._window_begin) < oldest:
+            self._window_begin += 1
+            n_pops += 1
+
+        if not self._window_satisfied:
+            if n_pops:
+                self._window_satisfied = True
+                self._logger.info('time window satisfied')
+
+        # Wake up all clients
+        for client_id, cursor in self._cursors.items():
+            if cursor.switched_to_realtime and cursor.max_depth is not None and not cursor.disconnected \
+                    and cursor.max_depth < cursor.depth(self._arrivals.end):
+                self._overflow(client_id, cursor)
+            cursor.event.set()
+
+        # Reclaim executions read by all clients
+        window_begin, arrivals_begin = self._window_begin, self._arrivals.end
+        for cursor in self._cursors.values():
+            if cursor.disconnected:
+                continue
+            if cursor.switched_to_realtime:
+                arrivals_begin = min(arrivals_begin, cursor.position)
+            else:
+                window_begin = min(window_begin, cursor.position)
+        buffer.reclaim(window_begin)
+        self._arrivals.reclaim(arrivals_begin)
+
+    def _overflow(self, client_id: str, cursor: '_Cursor'):
+        depth = cursor.depth(self._arrivals.end)
+
+        if cursor.slow_consumer_policy == SlowConsumerPolicy.DISCONNECT:
+            self._logger.warning(f'disconnecting slow consumer: {client_id}, depth: {depth}')
+            cursor.disconnected = True
+            n_drops = depth
+        elif cursor.slow_consumer_policy == SlowConsumerPolicy.DROP_OLDEST:
+            n_drops = depth - cursor.max_depth
+        else:
+            n_drops = depth - 1
+
+        # 未取得の要素のうち、読み出し位置より前に挿入された要素が最も古い
+        n_pending = min(n_drops, len(cursor.pending))
+        for _ in range(n_pending):
+            cursor.pending.popleft()
+        cursor.position += n_drops - n_pending
+        cursor.dropped += n_drops
+
+    def _insert(self, position: int, execution: Execution, timestamp: int):
+        if position == self._buffer.end:
+            self._buffer.append(execution, timestamp)
+            return
+
+        self._buffer.insert(position, execution, timestamp)
+        for cursor in self._cursors.values():
+            if position < cursor.position and not cursor.disconnected and not cursor.switched_to_realtime:
+                # 読み出し位置より前に挿入された要素は、そのクライアントが次に取得します
+                cursor.position += 1
+                cursor.pending.append(execution)
 
-        self._switched_to_realtime: Dict[str, bool] = dict()
+    async def get(self, client_id: str):
+        cursor = self._cursors[client_id]
+
+        while True:
+            if cursor.disconnected:
+                raise SlowConsumerError(client_id)
+
+            execution = self._get_nowait(cursor)
+            if execution is not None:
+                return execution
+
+            # Put SW
+            if not cursor.switched_to_realtime:
+                # 以後は、追加された順のバッファから取得します
+                cursor.switched_to_realtime = True
+                cursor.position = self._arrivals.end
+                return self._switched_to_realtime_partial(timestamp=np.datetime64('now', 'ns', utc=True))
+
+            cursor.event.clear()
+            await cursor.event.wait()
+
+    async def get_batch(self, client_id: str, max_size: int) -> List[Union[Execution, SwitchedToRealtime]]:
+        """
+        要素が取得できるまで待ち、待たずに取得できる最大`max_size`個の要素のリストを返します。
+        SwitchedToRealtimeオブジェクトは、それだけのリストで返されます。
+        """
+        first = await self.get(client_id)
+        if isinstance(first, SwitchedToRealtime):
+            return [first]
+
+        cursor = self._cursors[client_id]
+        batch = [first]
+        while len(batch) < max_size:
+            execution = self._get_nowait(cursor)
+            if execution is None:
+                break
+            batch.append(execution)
+        return batch
+
+    def _get_nowait(self, cursor: '_Cursor') -> Optional[Execution]:
+        if cursor.pending:
+            return cursor.pending.popleft()
+
+        buffer = self._arrivals if cursor.switched_to_realtime else self._buffer
+        if cursor.position < buffer.end:
+            execution = buffer[cursor.position]
+            cursor.position += 1
+            return execution
+
+        return None
 
-    def spawn_queue(self, client_id: str):
-        self._queues[client_id] = _Queue(loop=self._loop)
-        self._queues[client_id].init(self._deque)
-        self._switched_to_realtime[client_id] = False
+    def spawned_queue_count(self):
+        return len(self._cursors)
 
-    def dispose_queue(self, client_id: str):
-        del self._queues[client_id]
+    def client_stats(self) -> Dict[str, ClientStats]:
+        return {
+            client_id: ClientStats(
+                depth=cursor.depth(self._arrivals.end if cursor.switched_to_realtime else self._buffer.end),
+                dropped=cursor.dropped, disconnected=cursor.disconnected,
+            )
+            for client_id, cursor in self._cursors.items()
+        }
 
-    def put_nowait(self, execution: Execution):
-        if not self._deque:
-            self._deque.append(execution)
+    def execution_count(self):
+        return self._buffer.end - self._window_begin
 
-        else:
-            # Inserting execution
-            idx = len(self._deque)
-            while 0 < idx:
-                left = self._deque[idx - 1]
 
-                if left.timestamp < execution.timestamp:
-                    self._deque.insert(idx, execution)
-                    break
+class _Cursor:
+    """
+    クライアント毎の読み出し位置
+    """
+
+    def __init__(self, position: int,
+                 max_depth: Optional[int],
+                 slow_consumer_policy: SlowConsumerPolicy,
+                 loop=None):
+        # SwitchedToRealtimeを返した後は、追加された順のバッファの位置です
+        self.position = position
 
-                if left.timestamp == execution.timestamp:
-                    self._deque.append(execution)
-                    break
+        # 読み出し位置より前に挿入された要素
+        self.pending: Deque[Execution] = deque()
 
-                idx -= 1
-            else:
-                self._deque.appendleft(execution)
-
-            # Dispose old executions
-            n_pops = 0
-            most_right = self._deque[-1]
-            for n, deque_execution in enumerate(self._deque):
-                delta = most_right.timestamp - deque_execution.timestamp
-                if delta <= self._time_window:
-                    break
-                n_pops += 1
-            [self._deque.popleft() for _ in range(n_pops)]
-
-            if not self._window_satisfied:
-                if n_pops:
-                    self._window_satisfied = True
-                    self._logger.info('time window satisfied')
-
-        # Put to all client queues
-        [q.put_nowait(execution) for q in self._queues.values()]
+        self.switched_to_realtime = False
+        self.event = asyncio.Event(loop=loop)
 
-    async def get(self, client_id: str):
-        # Put SW
-        if not self._switched_to_realtime[client_id]:
-            if self._queues[client_id].qsize() == 0:
-                self._queues[client_id].put_nowait(
-                    self._switched_to_realtime_partial(timestamp=np.datetime64('now', 'ns', utc=True))
-                )
-                self._switched_to_realtime[client_id] = True
+        self.max_depth = max_depth
+        self.slow_consumer_policy = slow_consumer_policy
+        self.dropped = 0
+        self.disconnected = False
 
-        return await self._queues[client_id].get()
+    def depth(self, end: int) -> int:
+        if self.disconnected:
+            return 0
+        return end - self.position + len(self.pending)
 
-    def spawned_queue_count(self):
-        return len(self._queues)
 
-    def execution_count(self):
-        return len(self._deque)
+_DATETIME64_NS = np.dtype('datetime64[ns]')
+
+
+def _to_nanoseconds(timestamp: np.datetime64) -> int:
+    if timestamp.dtype == _DATETIME64_NS:
+        # ナノ秒単位のdatetime64のitemは、エポックからのナノ秒の整数です
+        return timestamp.item()
+    return int(timestamp.astype(_DATETIME64_NS).astype(np.int64))
+
+
+T = TypeVar('T')
+
+
+class _SharedBuffer(Generic[T]):
+    """
+    追加された順に増え続ける位置で要素を参照する、すべてのクライアントが共有するバッファ
+
+    要素は整数のキー（ナノ秒のタイムスタンプ）と共に保持され、`bisect_right`でキーの順の挿入位置を二分探索します。
+    先頭の要素を回収しても、他の要素の位置は変わりません。
+    回収した領域は、先頭の空きが全体の半分を超えた時にまとめて解放されます（償却O(1)）。
+    """
+
+    def __init__(self):
+        self._items: List[T] = list()
+        self._keys: List[int] = list()
+
+        # Index of the first item in self._items
+        self._head = 0
+
+        # Position of the first item
+        self._begin = 0
+
+    @property
+    def begin(self) -> int:
+        return self._begin
+
+    @property
+    def end(self) -> int:
+        return self._begin + len(self._items) - self._head
+
+    def __len__(self) -> int:
+        return len(self._items) - self._head
+
+    def __getitem__(self, position: int) -> T:
+        return self._items[self._head + position - self._begin]
+
+    def key(self, position: int) -> int:
+        return self._keys[self._head + position - self._begin]
+
+    def bisect_right(self, key: int, lo: int) -> int:
+        """
+        位置`lo`以降のキーが昇順であるとき、同じキーの要素の後ろになる、`key`の挿入位置を返します。
+        """
+        return bisect_right(self._keys, key, self._head + lo - self._begin) - self._head + self._begin
+
+    def append(self, item: T, key: int):
+        self._items.append(item)
+        self._keys.append(key)
+
+    def insert(self, position: int, item: T, key: int):
+        self._items.insert(self._head + position - self._begin, item)
+        self._keys.insert(self._head + position - self._begin, key)
 
+    def reclaim(self, position: int):
+        """
+        `position`より前の要素を回収します。
+        """
+        if position <= self._begin:
+            return
 
-class _Queue(asyncio.Queue):
+        self._head += position - self._begin
+        self._begin = position
 
-    def init(self, iterable: Iterable):
-        self._queue = deque(iterable)
+        if len(self._items) < self._head * 2:
+            del self._items[:self._head]
+            del self._keys[:self._head]
+            self._head = 0
@@ -0,0 +1,70 @@
+from logging import Logger
+from typing import AsyncIterable, AsyncIterator, List, Optional
+
+from trade.execution.model import Execution, ExecutionBatch
+
+
+class BatchStream(AsyncIterable[ExecutionBatch]):
+    """
+    Executionストリームを、`batch_size`件ごとのExecutionBatchストリームに変換するアダプター
+
+    シンボルが切り替わった場合、その時点までのバッチが返されます。
+    """
+
+    def __init__(self, logger: Logger,
+                 upstream: AsyncIterable[Execution],
+                 batch_size: int = 10_000,
+                 price_precision: Optional[int] = None,
+                 size_precision: Optional[int] = None):
+        self._logger = logger
+        self._upstream = upstream
+        self._batch_size = batch_size
+        self._price_precision = price_precision
+        self._size_precision = size_precision
+
+    async def __aiter__(self) -> AsyncIterator[ExecutionBatch]:
+        if not self._upstream.__aiter__():
+            return
+
+        executions: List[Execution] = list()
+
+        async for execution in self._upstream:
+            if executions and executions[-1].symbol is not execution.symbol:
+                yield self._build(executions)
+                executions = list()
+
+            executions.append(execution)
+
+            if len(executions) == self._batch_size:
+                yield self._build(executions)
+                executions = list()
+
+        if executions:
+            yield self._build(executions)
+
+    def _build(self, executions: List[Execution]) -> ExecutionBatch:
+        return ExecutionBatch.from_executions(
+            symbol=executions[0].symbol, executions=executions,
+            price_precision=self._price_precision, size_precision=self._size_precision
+        )
+
+
+class UnbatchStream(AsyncIterable[Execution]):
+    """
+    ExecutionBatchストリームを、Executionストリームに展開するアダプター
+
+    `fixed_point`がTrueの場合、価格およびサイズは固定小数点の整数のまま展開されます。
+    """
+
+    def __init__(self, logger: Logger, upstream: AsyncIterable[ExecutionBatch], fixed_point: bool = False):
+        self._logger = logger
+        self._upstream = upstream
+        self._fixed_point = fixed_point
+
+    async def __aiter__(self) -> AsyncIterator[Execution]:
+        if not self._upstream.__aiter__():
+            return
+
+        async for batch in self._upstream:
+            for execution in batch.executions(fixed_point=self._fixed_point):
+                yield execution
@@ -1,9 +1,10 @@
 from logging import Logger
 from typing import AsyncIterable, AsyncIterator, Optional, List, Callable
 
+import numpy as np
 import pandas as pd
 
-from trade.execution.model import Execution
+from trade.execution.model import Execution, ExecutionBatch
 
 
 class DropWhileStream(AsyncIterable[Execution]):
@@ -33,6 +34,24 @@ class DropWhileStream(AsyncIterable[Execution]):
                 yield execution
 
 
+class FilterStream(AsyncIterable[Execution]):
+    """
+    predicate (述語) がTrueである要素だけを返す、Executionストリームアダプター
+    """
+
+    def __init__(self, logger: Logger,
+                 upstream: AsyncIterable[Execution],
+                 predicate: Callable[[Execution], bool]):
+        self._logger = logger
+        self._upstream = upstream
+        self._predicate = predicate
+
+    async def __aiter__(self) -> AsyncIterator[Execution]:
+        async for execution in self._upstream:
+            if self._predicate(execution):
+                yield execution
+
+
 class NewPricesStream(AsyncIterable[Execution]):
     """
     タイムウインドウ内の新高値および新安値 を返すExecutionストリームアダプター
@@ -134,3 +153,175 @@ class OHLCStream(AsyncIterable[Execution]):
 
             executions.append(execution)
             prev_units = units
+
+
+class DropWhileBatchStream(AsyncIterable[ExecutionBatch]):
+    """
+    DropWhileStreamのバッチ版
+
+    predicate (述語) はバッチを受け取り、行ごとの真偽値の配列を返します。
+    """
+
+    def __init__(self, logger: Logger,
+                 upstream: AsyncIterable[ExecutionBatch],
+                 predicate: Callable[[ExecutionBatch], np.ndarray]):
+        self._logger = logger
+        self._upstream = upstream
+        self._predicate = predicate
+
+    async def __aiter__(self) -> AsyncIterator[ExecutionBatch]:
+        if not self._upstream.__aiter__():
+            return
+
+        done = False
+
+        async for batch in self._upstream:
+            if not done:
+                dropping = np.asarray(self._predicate(batch), dtype=bool)
+                if dropping.all():
+                    continue
+
+                done = True
+                yield batch[int(np.argmin(dropping)):]
+            else:
+                yield batch
+
+
+class NewPricesBatchStream(AsyncIterable[ExecutionBatch]):
+    """
+    NewPricesStreamのバッチ版
+
+    タイムウインドウ毎の高値・安値の累積をNumPyで計算し、NewPricesStreamが返すExecutionと同じ行だけを含むバッチを返します。
+    """
+
+    def __init__(self, logger: Logger,
+                 upstream: AsyncIterable[ExecutionBatch],
+                 time_window: str):
+        self._logger = logger
+        self._upstream = upstream
+        self._time_window = pd.to_timedelta(time_window)
+
+    async def __aiter__(self) -> AsyncIterator[ExecutionBatch]:
+        if not self._upstream.__aiter__():
+            return
+
+        prev_units: Optional[int] = None
+        high: Optional[int] = None
+        low: Optional[int] = None
+
+        async for batch in self._upstream:
+            if not len(batch):
+                continue
+
+            prices = batch.prices
+            units = batch.timestamps // self._time_window.value
+
+            new_window = np.empty(len(batch), dtype=bool)
+            new_window[0] = prev_units is None or prev_units != units[0]
+            new_window[1:] = units[1:] != units[:-1]
+            group = np.cumsum(new_window) - new_window[0]
+
+            # 行ごとの、直前までの高値・安値 (ウインドウの先頭行は未定義)
+            prev_high = np.empty_like(prices)
+            prev_low = np.empty_like(prices)
+            prev_high[1:] = _group_cumulative_max(prices, group)[:-1]
+            prev_low[1:] = -_group_cumulative_max(-prices, group)[:-1]
+
+            if not new_window[0]:
+                continuing = group == 0
+                prev_high[0], prev_low[0] = high, low
+                prev_high[continuing] = np.maximum(prev_high[continuing], high)
+                prev_low[continuing] = np.minimum(prev_low[continuing], low)
+
+            selected = new_window | (prev_high < prices) | (prices < prev_low)
+
+            last_window = group == group[-1]
+            high = int(prices[last_window].max())
+            low = int(prices[last_window].min())
+            if not new_window[0] and group[-1] == 0:
+                high, low = max(high, int(prev_high[0])), min(low, int(prev_low[0]))
+            prev_units = int(units[-1])
+
+            yield batch[selected]
+
+
+class OHLCBatchStream(AsyncIterable[ExecutionBatch]):
+    """
+    OHLCStreamのバッチ版
+
+    ローテーションが済んだタイムウインドウ毎に、OHLCStreamと同じ順序で4行を返します。
+    末尾のタイムウインドウは次のバッチに持ち越され、最後まで返されません。
+    """
+
+    def __init__(self, logger: Logger, upstream: AsyncIterable[ExecutionBatch], time_window: str):
+        self._logger = logger
+        self._upstream = upstream
+        self._time_window = pd.to_timedelta(time_window)
+
+    async def __aiter__(self) -> AsyncIterator[ExecutionBatch]:
+        if not self._upstream.__aiter__():
+            return
+
+        pending: Optional[ExecutionBatch] = None
+
+        async for batch in self._upstream:
+            if pending is not None:
+                batch = ExecutionBatch.concatenate([pending, batch])
+            if not len(batch):
+                continue
+
+            units = batch.timestamps // self._time_window.value
+            starts = np.concatenate([[0], np.flatnonzero(units[1:] != units[:-1]) + 1])
+
+            # 末尾のタイムウインドウは未完全なので、OHLCの候補となる行だけを持ち越す
+            pending = _reduce_to_ohlc_candidates(batch[starts[-1]:])
+            if len(starts) == 1:
+                continue
+
+            starts, ends = starts[:-1], starts[1:]
+            rows = np.arange(ends[-1])
+            prices = batch.prices[:ends[-1]]
+            lengths = ends - starts
+
+            opens = starts
+            closes = ends - 1
+            highs = _group_first_index(prices == np.repeat(np.maximum.reduceat(prices, starts), lengths), rows, starts)
+            lows = _group_first_index(prices == np.repeat(np.minimum.reduceat(prices, starts), lengths), rows, starts)
+
+            high_first = batch.timestamps[highs] <= batch.timestamps[lows]
+            indices = np.stack([
+                opens,
+                np.where(high_first, highs, lows),
+                np.where(high_first, lows, highs),
+                closes,
+            ], axis=1).ravel()
+
+            yield batch[indices]
+
+
+def _group_cumulative_max(values: np.ndarray, group: np.ndarray) -> np.ndarray:
+    """
+    昇順に並んだグループ番号`group`ごとに、`values`の累積最大値を返します。
+    """
+    if not len(values):
+        return values
+
+    lowest = values.min()
+    span = int(values.max() - lowest) + 1
+    offsets = group.astype(np.int64) * span
+    return np.maximum.accumulate(values - lowest + offsets) - offsets + lowest
+
+
+def _reduce_to_ohlc_candidates(batch: ExecutionBatch) -> ExecutionBatch:
+    """
+    始値、最初の高値、最初の安値、終値の行だけを残したバッチを返します。
+    """
+    prices = batch.prices
+    return batch[np.unique([0, int(np.argmax(prices)), int(np.argmin(prices)), len(prices) - 1])]
+
+
+def _group_first_index(flags: np.ndarray, rows: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    """
+    `starts`で区切られたグループごとに、`flags`が真である最初の行番号を返します。
+    """
+    return np.minimum.reduceat(np.where(flags, rows, len(rows)), starts)
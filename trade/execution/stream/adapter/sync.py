@@ -1,7 +1,9 @@
 from logging import Logger
 from typing import Optional, AsyncIterable, AsyncIterator
 
-from trade.execution.model import Execution, SynchronizedExecution
+import numpy as np
+
+from trade.execution.model import Execution, SynchronizedExecution, ExecutionBatch
 
 
 class SynchronizedStream(AsyncIterable[Execution]):
@@ -72,3 +74,71 @@ class SynchronizedStream(AsyncIterable[Execution]):
                     if prev_secondary.timestamp <= primary.timestamp:
                         yield Execution.wrap(execution=primary, synchronized_execution=prev_secondary)
                     break
+
+
+class SynchronizedBatchStream(AsyncIterable[ExecutionBatch]):
+    """
+    SynchronizedStreamのバッチ版
+
+    プライマリのバッチの各行について、`secondary.timestamp <= primary.timestamp`を満たす最も近傍なセカンダリの行を
+    `numpy.searchsorted`で求め、`ExecutionBatch.synchronized`としてセットします。
+    出力される行は、SynchronizedStreamと同じです。
+
+    このクラスの利用者は、それぞれの入力イテレータがイテレーションするバッチのタイムスタンプが昇順であることに責務を持ちます。
+    """
+
+    def __init__(self, logger: Logger,
+                 primary_iterable: AsyncIterable[ExecutionBatch],
+                 secondary_iterable: AsyncIterable[ExecutionBatch]):
+        self._logger = logger
+        self._primary_iter = primary_iterable
+        self._secondary_iter = secondary_iterable
+
+    async def __aiter__(self) -> AsyncIterator[ExecutionBatch]:
+        primary_iter = self._primary_iter.__aiter__()
+        if not primary_iter:
+            return
+        secondary_iter = self._secondary_iter.__aiter__()
+        if not secondary_iter:
+            return
+
+        secondary: Optional[ExecutionBatch] = None
+        secondary_exhausted = False
+
+        async for primary in primary_iter:
+            if not len(primary):
+                continue
+
+            # プライマリの末尾より新しいセカンダリの行が得られるまで読み進める
+            while not secondary_exhausted and (secondary is None or secondary.timestamps[-1] <= primary.timestamps[-1]):
+                try:
+                    batch = await secondary_iter.__anext__()
+                except StopAsyncIteration:
+                    secondary_exhausted = True
+                    break
+                secondary = batch if secondary is None else ExecutionBatch.concatenate([secondary, batch])
+
+            if secondary is None or not len(secondary):
+                return
+
+            n_preceding = np.searchsorted(secondary.timestamps, primary.timestamps, side='right')
+
+            # より新しいセカンダリの行が存在しないプライマリの行は、最初の1行だけを出力して終了する
+            n_rows = len(primary)
+            terminating = n_preceding == len(secondary)
+            if terminating.any():
+                n_rows = int(np.argmax(terminating))
+                if 0 < n_preceding[n_rows]:
+                    n_rows += 1
+
+            n_preceding = n_preceding[:n_rows]
+            output = primary[:n_rows]
+            output.synchronized = secondary[np.maximum(n_preceding - 1, 0)]
+            output.synchronized_mask = 0 < n_preceding
+            yield output
+
+            if terminating.any():
+                return
+
+            # 以降のプライマリの行が参照し得るのは、直近の行以降だけ
+            secondary = secondary[max(int(n_preceding[-1]) - 1, 0):]
@@ -1,10 +1,11 @@
 import unittest
 
-from trade.execution.stream.adapter.tests import test_filter, test_sync
+from trade.execution.stream.adapter.tests import test_batch, test_filter, test_sync
 
 
 def test_suite():
     suite = unittest.TestSuite()
+    suite.addTest(test_batch.test_suite())
     suite.addTest(test_filter.test_suite())
     suite.addTest(test_sync.test_suite())
     return suite
@@ -0,0 +1,71 @@
+import unittest
+from decimal import Decimal
+
+import numpy as np
+
+from trade.execution.stream.adapter.batch import BatchStream, UnbatchStream
+from trade.log import get_logger
+from trade.model import Symbol
+from trade.test_helper import make_execution, build_iterator
+
+
+class BatchStreamTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def test_aiter(self):
+        executions = [make_execution(symbol=Symbol.FXBTCJPY, _id=n, timestamp_forward=np.timedelta64(n, 's'))
+                      for n in range(5)]
+
+        reader = BatchStream(
+            logger=get_logger(self.test_aiter.__name__),
+            upstream=build_iterator(list(executions)),
+            batch_size=2,
+        )
+
+        batches = [batch async for batch in reader]
+        self.assertEqual([2, 2, 1], [len(batch) for batch in batches])
+        self.assertEqual(executions, [e for batch in batches for e in batch])
+
+    async def test_aiter_symbol_switched(self):
+        executions = [
+            make_execution(symbol=Symbol.FXBTCJPY, _id=0),
+            make_execution(symbol=Symbol.BTCJPY, _id=1, price=Decimal('101')),
+            make_execution(symbol=Symbol.BTCJPY, _id=2, price=Decimal('102')),
+        ]
+
+        reader = BatchStream(
+            logger=get_logger(self.test_aiter_symbol_switched.__name__),
+            upstream=build_iterator(list(executions)),
+            batch_size=10,
+        )
+
+        batches = [batch async for batch in reader]
+        self.assertEqual([Symbol.FXBTCJPY, Symbol.BTCJPY], [batch.symbol for batch in batches])
+        self.assertEqual(executions, [e for batch in batches for e in batch])
+
+
+class UnbatchStreamTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def test_aiter(self):
+        executions = [make_execution(symbol=Symbol.FXBTCJPY, _id=n) for n in range(3)]
+
+        reader = UnbatchStream(
+            logger=get_logger(self.test_aiter.__name__),
+            upstream=BatchStream(
+                logger=get_logger(self.test_aiter.__name__),
+                upstream=build_iterator(list(executions)),
+                batch_size=2,
+            )
+        )
+
+        self.assertEqual(executions, [e async for e in reader])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(BatchStreamTestCase))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(UnbatchStreamTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite', verbosity=2, buffer=True)
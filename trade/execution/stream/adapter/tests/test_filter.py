@@ -1,3 +1,4 @@
+import random
 import unittest
 from datetime import datetime
 from decimal import Decimal
@@ -7,10 +8,12 @@ from typing import AsyncIterable, AsyncIterator
 import numpy as np
 
 from trade.execution.model import Execution
-from trade.execution.stream.adapter.filter import OHLCStream, DropWhileStream, NewPricesStream
+from trade.execution.stream.adapter.batch import UnbatchStream
+from trade.execution.stream.adapter.filter import OHLCStream, DropWhileStream, NewPricesStream, DropWhileBatchStream, \
+    NewPricesBatchStream, OHLCBatchStream, FilterStream
 from trade.log import get_logger
 from trade.model import Symbol
-from trade.test_helper import make_execution, build_iterator
+from trade.test_helper import make_execution, build_iterator, build_batch_iterator
 
 _me = partial(make_execution, symbol=Symbol.FXBTCJPY)
 
@@ -83,6 +86,20 @@ class DropWhileStreamTestCase(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(e3, actual[1])
 
 
+class FilterStreamTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def test_aiter(self):
+        executions = [_me(_id=n, timestamp_forward=np.timedelta64(n, 's')) for n in range(5)]
+
+        reader = FilterStream(
+            logger=get_logger(self.test_aiter.__name__),
+            upstream=build_iterator(list(executions)),
+            predicate=lambda e: e._id % 2 == 0
+        )
+
+        self.assertEqual([executions[0], executions[2], executions[4]], [execution async for execution in reader])
+
+
 class NewPricesStreamTestCase(unittest.IsolatedAsyncioTestCase):
 
     async def test_aiter_empty(self):
@@ -352,11 +369,95 @@ class OHLCStreamTestCase(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(e7, actual[7])
 
 
+def _random_executions(n: int, seed: int):
+    rand = random.Random(seed)
+    executions = list()
+    forward = 0
+    for _id in range(n):
+        forward += rand.randint(0, 7)
+        executions.append(
+            _me(_id=_id, price=Decimal(rand.randint(90, 110)), timestamp_forward=np.timedelta64(forward, 's'))
+        )
+    return executions
+
+
+class _BatchStreamTestCaseBase(unittest.IsolatedAsyncioTestCase):
+    """
+    バッチ版のストリームが、Execution版のストリームと同じExecutionを返すことを検証します
+    """
+
+    async def assert_equivalent(self, build_stream, build_batch_stream, executions):
+        expected = [e async for e in build_stream(build_iterator(list(executions)))]
+
+        for batch_size in (1, 2, 3, 17, len(executions)):
+            with self.subTest(batch_size=batch_size):
+                actual = [e async for e in UnbatchStream(
+                    logger=get_logger(self.__class__.__name__),
+                    upstream=build_batch_stream(build_batch_iterator(list(executions), batch_size)),
+                )]
+                self.assertEqual(expected, actual)
+
+
+class DropWhileBatchStreamTestCase(_BatchStreamTestCaseBase):
+
+    async def test_aiter(self):
+        logger = get_logger(self.test_aiter.__name__)
+        executions = _random_executions(100, seed=0)
+
+        await self.assert_equivalent(
+            lambda upstream: DropWhileStream(logger, upstream=upstream, predicate=lambda e: e._id < 42),
+            lambda upstream: DropWhileBatchStream(logger, upstream=upstream, predicate=lambda b: b.ids < 42),
+            executions,
+        )
+
+    async def test_aiter_dropped_all(self):
+        logger = get_logger(self.test_aiter_dropped_all.__name__)
+        executions = _random_executions(10, seed=0)
+
+        await self.assert_equivalent(
+            lambda upstream: DropWhileStream(logger, upstream=upstream, predicate=lambda e: True),
+            lambda upstream: DropWhileBatchStream(
+                logger, upstream=upstream, predicate=lambda b: np.ones(len(b), dtype=bool)
+            ),
+            executions,
+        )
+
+
+class NewPricesBatchStreamTestCase(_BatchStreamTestCaseBase):
+
+    async def test_aiter(self):
+        logger = get_logger(self.test_aiter.__name__)
+
+        for seed in range(5):
+            await self.assert_equivalent(
+                lambda upstream: NewPricesStream(logger, upstream=upstream, time_window='1minute'),
+                lambda upstream: NewPricesBatchStream(logger, upstream=upstream, time_window='1minute'),
+                _random_executions(300, seed=seed),
+            )
+
+
+class OHLCBatchStreamTestCase(_BatchStreamTestCaseBase):
+
+    async def test_aiter(self):
+        logger = get_logger(self.test_aiter.__name__)
+
+        for seed in range(5):
+            await self.assert_equivalent(
+                lambda upstream: OHLCStream(logger, upstream=upstream, time_window='1minute'),
+                lambda upstream: OHLCBatchStream(logger, upstream=upstream, time_window='1minute'),
+                _random_executions(300, seed=seed),
+            )
+
+
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.TestLoader().loadTestsFromTestCase(DropWhileStreamTestCase))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(FilterStreamTestCase))
     suite.addTest(unittest.TestLoader().loadTestsFromTestCase(NewPricesStreamTestCase))
     suite.addTest(unittest.TestLoader().loadTestsFromTestCase(OHLCStreamTestCase))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(DropWhileBatchStreamTestCase))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(NewPricesBatchStreamTestCase))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(OHLCBatchStreamTestCase))
     return suite
 
 
@@ -3,11 +3,12 @@ from typing import AsyncIterable, AsyncIterator
 
 import numpy as np
 
-from trade.execution.model import Execution
-from trade.execution.stream.adapter.sync import SynchronizedStream
+from trade.execution.model import Execution, SynchronizedExecution
+from trade.execution.stream.adapter.batch import UnbatchStream
+from trade.execution.stream.adapter.sync import SynchronizedStream, SynchronizedBatchStream
 from trade.log import get_logger
 from trade.model import Symbol
-from trade.test_helper import make_execution, make_execution_s
+from trade.test_helper import make_execution, make_execution_s, build_batch_iterator
 
 
 class SynchronizedStreamTestCase(unittest.IsolatedAsyncioTestCase):
@@ -233,9 +234,99 @@ class SynchronizedStreamTestCase(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(Execution.wrap(p6_t101, synchronized_execution=s101_t101), actual[5])
 
 
+class SynchronizedBatchStreamTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def _read(self, method_name, primaries, secondaries, batch_size):
+        reader = UnbatchStream(
+            logger=get_logger(method_name),
+            upstream=SynchronizedBatchStream(
+                logger=get_logger(method_name),
+                primary_iterable=build_batch_iterator(list(primaries), batch_size),
+                secondary_iterable=build_batch_iterator(list(secondaries), batch_size),
+            )
+        )
+        return [e async for e in reader]
+
+    async def test_aiter(self):
+        """
+        iter-p : p0(t0)  p2(t1)  p4(t2)  SI
+        iter-s : s1(t1)  s3(t1)  s5(t1)  s6(t2)  s7(t3)
+
+        output : (p0(t0), N)  (p2(t1), s5(t1))  (p4(t2), s6(t2))
+        """
+        p = [make_execution(symbol=Symbol.FXBTCJPY, _id=_id, timestamp_forward=np.timedelta64(t, 'ns'))
+             for _id, t in [(0, 0), (2, 1), (4, 2)]]
+        s = [make_execution(symbol=Symbol.BTCJPY, _id=_id, timestamp_forward=np.timedelta64(t, 'ns'))
+             for _id, t in [(1, 1), (3, 1), (5, 1), (6, 2), (7, 3)]]
+
+        for batch_size in (1, 2, 5):
+            with self.subTest(batch_size=batch_size):
+                actual = await self._read(self.test_aiter.__name__, p, s, batch_size)
+
+                self.assertEqual(3, len(actual))
+                self.assertEqual(Execution.wrap(p[0], synchronized_execution=None), actual[0])
+                self.assertEqual(
+                    Execution.wrap(p[1], synchronized_execution=SynchronizedExecution.from_execution(s[2])), actual[1]
+                )
+                self.assertEqual(
+                    Execution.wrap(p[2], synchronized_execution=SynchronizedExecution.from_execution(s[3])), actual[2]
+                )
+
+    async def test_aiter_primary_delaying(self):
+        """
+        iter-p : p100(t100)  p101(t101)  SI
+        iter-s : s0(t0)      s2(t1)      s3(t99)  s4(t100)  s5(t100)  s6(t101)  SI
+
+        output : (p100(t100), s5(t100))  (p101(t101), s6(t101))
+        """
+        p = [make_execution(symbol=Symbol.FXBTCJPY, _id=_id, timestamp_forward=np.timedelta64(t, 'ns'))
+             for _id, t in [(100, 100), (101, 101)]]
+        s = [make_execution(symbol=Symbol.BTCJPY, _id=_id, timestamp_forward=np.timedelta64(t, 'ns'))
+             for _id, t in [(0, 0), (2, 1), (3, 99), (4, 100), (5, 100), (6, 101)]]
+
+        for batch_size in (1, 2, 6):
+            with self.subTest(batch_size=batch_size):
+                actual = await self._read(self.test_aiter_primary_delaying.__name__, p, s, batch_size)
+
+                self.assertEqual(2, len(actual))
+                self.assertEqual(
+                    Execution.wrap(p[0], synchronized_execution=SynchronizedExecution.from_execution(s[4])), actual[0]
+                )
+                self.assertEqual(
+                    Execution.wrap(p[1], synchronized_execution=SynchronizedExecution.from_execution(s[5])), actual[1]
+                )
+
+    async def test_aiter_secondary_delaying(self):
+        """
+        iter-p : p0(t0)      p2(t1)      p3(t99)  p4(t100)  p5(t100)  p6(t101)
+        iter-s : s100(t100)  s101(t101)  SI
+
+        output : (p0(t0), None)  (p2(t1), None)  (p3(t99), None)  (p4(t100), s100(t100))  (p5(t100), s100(t100))
+                 (p6(t101), s101(t101))  SI
+        """
+        p = [make_execution(symbol=Symbol.FXBTCJPY, _id=_id, timestamp_forward=np.timedelta64(t, 'ns'))
+             for _id, t in [(0, 0), (2, 1), (3, 99), (4, 100), (5, 100), (6, 101)]]
+        s = [make_execution(symbol=Symbol.BTCJPY, _id=_id, timestamp_forward=np.timedelta64(t, 'ns'))
+             for _id, t in [(100, 100), (101, 101)]]
+
+        for batch_size in (1, 4, 6):
+            with self.subTest(batch_size=batch_size):
+                actual = await self._read(self.test_aiter_secondary_delaying.__name__, p, s, batch_size)
+
+                self.assertEqual(6, len(actual))
+                for n in range(3):
+                    self.assertEqual(Execution.wrap(p[n], synchronized_execution=None), actual[n])
+                for n, m in [(3, 0), (4, 0), (5, 1)]:
+                    self.assertEqual(
+                        Execution.wrap(p[n], synchronized_execution=SynchronizedExecution.from_execution(s[m])),
+                        actual[n]
+                    )
+
+
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.TestLoader().loadTestsFromTestCase(SynchronizedStreamTestCase))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(SynchronizedBatchStreamTestCase))
     return suite
 
 
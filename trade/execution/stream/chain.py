@@ -1,7 +1,14 @@
+import asyncio
+import itertools
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from logging import Logger
-from typing import AsyncIterable, Sequence, AsyncIterator, Optional
+from typing import AsyncIterable, Sequence, AsyncIterator, Optional, Callable, List, Iterator, Deque, Iterable
 
-from trade.execution.model import Execution
+import numpy as np
+
+from trade.execution.model import Execution, ExecutionBatch
 
 
 class ChainedStream(AsyncIterable[Execution]):
@@ -11,9 +18,10 @@ class ChainedStream(AsyncIterable[Execution]):
     先頭のupstreamの全Executionオブジェクトを返し、次に2番目のupstreamの全Executionオブジェクトを返し、と全upstreamsの
     全Executionオブジェクトを返します。
     upstreamがイテレーションされた時に、Executionオブジェクトのタイムスタンプが昇順でない場合、ValueError例外が送出されます。
+    `upstreams`は遅延評価されるイテラブルでも構いません。その場合、各upstreamは直前のupstreamを消費し終えてから作られます。
     """
 
-    def __init__(self, logger: Logger, upstreams: Sequence[AsyncIterable[Execution]]):
+    def __init__(self, logger: Logger, upstreams: Iterable[AsyncIterable[Execution]]):
         self._logger = logger
         self._iterables = upstreams
 
@@ -33,3 +41,95 @@ class ChainedStream(AsyncIterable[Execution]):
                 yield execution
             else:
                 iter_final = execution
+
+
+class ChainedBatchStream(AsyncIterable[ExecutionBatch]):
+    """
+    連結された、ExecutionBatchストリーム
+
+    ChainedStreamのバッチ版です。
+    upstreamが切り替わった時に、最初のExecutionのタイムスタンプが直前のupstreamの最後のExecutionのタイムスタンプより
+    小さい場合、ValueError例外が送出されます。
+    """
+
+    def __init__(self, logger: Logger, upstreams: Iterable[AsyncIterable[ExecutionBatch]]):
+        self._logger = logger
+        self._iterables = upstreams
+
+    async def __aiter__(self) -> AsyncIterator[ExecutionBatch]:
+        iter_final: Optional[int] = None
+
+        for iterable in self._iterables:
+
+            batch_final: Optional[int] = None
+
+            async for batch in iterable:
+                if not len(batch):
+                    continue
+
+                if iter_final is not None:
+                    if batch.timestamps[0] < iter_final:
+                        raise ValueError(f'Time stamp order is not ascend.'
+                                         f' (last: {np.datetime64(iter_final, "ns")}'
+                                         f', this: {np.datetime64(int(batch.timestamps[0]), "ns")})')
+                    iter_final = None
+
+                batch_final = int(batch.timestamps[-1])
+                yield batch
+
+            iter_final = batch_final
+
+
+class ParallelChainedBatchStream(AsyncIterable[ExecutionBatch]):
+    """
+    プロセスプールで並列にデコードされた、連結されたExecutionBatchストリーム
+
+    `tasks`の各要素は、ひとつのupstream (チャンク) をデコードしてExecutionBatchのリストを返す、pickle可能な呼び出し可能
+    オブジェクトです (例: `functools.partial(decode_sqlite_chunk, logger, path)`)。
+    現在のチャンクが消費されている間に、続く`lookahead`個のチャンクがワーカープロセスでデコードされます。
+    ExecutionBatchはチャンクの順に返され、タイムスタンプの順序はChainedBatchStreamと同様に検査されます。
+    """
+
+    def __init__(self, logger: Logger,
+                 tasks: Sequence[Callable[[], List[ExecutionBatch]]],
+                 lookahead: Optional[int] = None):
+        self._logger = logger
+        self._tasks = tasks
+        self._lookahead = lookahead or os.cpu_count() or 1
+
+    async def __aiter__(self) -> AsyncIterator[ExecutionBatch]:
+        loop = asyncio.get_running_loop()
+        pool = ProcessPoolExecutor(max_workers=self._lookahead)
+        tasks = iter(self._tasks)
+        pending: Deque['asyncio.Future[List[ExecutionBatch]]'] = deque()
+
+        def _submit():
+            # 現在のチャンクに加えて、lookahead個のチャンクをデコード中にします
+            for task in itertools.islice(tasks, self._lookahead + 1 - len(pending)):
+                pending.append(loop.run_in_executor(pool, task))
+
+        def _upstreams() -> Iterator[AsyncIterable[ExecutionBatch]]:
+            _submit()
+            while pending:
+                future = pending.popleft()
+                _submit()
+                yield _FutureBatchStream(future)
+
+        try:
+            async for batch in ChainedBatchStream(self._logger, upstreams=_upstreams()):
+                yield batch
+        finally:
+            for future in pending:
+                future.cancel()
+            # デコード中のチャンクの完了を、イベントループをブロックせずに待ちます
+            await loop.run_in_executor(None, pool.shutdown)
+
+
+class _FutureBatchStream(AsyncIterable[ExecutionBatch]):
+
+    def __init__(self, future: 'asyncio.Future[List[ExecutionBatch]]'):
+        self._future = future
+
+    async def __aiter__(self) -> AsyncIterator[ExecutionBatch]:
+        for batch in await self._future:
+            yield batch
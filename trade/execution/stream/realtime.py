@@ -1,47 +1,98 @@
 import asyncio
+from itertools import groupby
 from json import loads
 from logging import Logger
-from typing import AsyncIterator, Dict, Any, Callable, Union, Mapping, AsyncIterable
+from typing import AsyncIterator, Dict, Any, Callable, Union, Mapping, AsyncIterable, Optional, List, Iterator
 
 import websockets
 
-from trade.execution.model import SwitchedToRealtime, Execution
+from trade.execution.model import SwitchedToRealtime, Execution, ExecutionBatch
+from trade.execution.protocol import decode_legacy_control_frame, is_control_message, decode_control_message, \
+    build_client_uri, BATCH_SIZE_PARAMETER, ENCODING_PARAMETER, ACCEPTANCE_IDS_PARAMETER, Encoding, decode_binary_frame
 from trade.model import Symbol
 
 
 class RealtimeWebSocketStream(AsyncIterable[Execution]):
+    """
+    WarmUpExecutionWebSocketProxyServer を源とする、Executionストリーム
+
+    `batch_size`が指定された場合、最大`batch_size`件の約定をひとつのフレームで送るようプロキシに要求します。
+    `yield_batches`がTrueの場合、約定のフレームを、連続した同じシンボルの約定毎のExecutionBatchで返します。
+    この場合、`execution_encoder`は使われません。
+    `encoding`が`Encoding.BINARY`の場合、約定をバイナリのフレームで送るようプロキシに要求します。
+    バイナリのフレームの約定は`execution_encoder`を使わずに変換され、`acceptance_ids`がFalseの場合、
+    acceptance idはNoneになります。
+    """
 
     def __init__(self, logger: Logger,
                  uri: str,
                  symbol_resolver: Callable[[str], Symbol],
-                 execution_encoder: Callable[[Symbol, Mapping[str, Union[str, int]]], Execution]):
+                 execution_encoder: Callable[[Symbol, Mapping[str, Union[str, int]]], Execution],
+                 batch_size: Optional[int] = None,
+                 yield_batches: bool = False,
+                 encoding: Encoding = Encoding.JSON,
+                 acceptance_ids: bool = True):
         self._logger = logger
-        self._uri = uri
+        binary = encoding == Encoding.BINARY
+        self._uri = build_client_uri(uri, {
+            BATCH_SIZE_PARAMETER: batch_size,
+            ENCODING_PARAMETER: encoding.value if binary else None,
+            ACCEPTANCE_IDS_PARAMETER: 0 if binary and not acceptance_ids else None,
+        })
         self._symbol_resolver = symbol_resolver
         self._execution_encoder = execution_encoder
+        self._yield_batches = yield_batches
 
-    async def __aiter__(self) -> AsyncIterator[Execution]:
+    async def __aiter__(self) -> AsyncIterator[Union[Execution, ExecutionBatch, SwitchedToRealtime]]:
         async with websockets.connect(self._uri) as websocket:
 
-            # noinspection PyUnresolvedReferences
-            import numpy
-
-            str_response: str
+            str_response: Union[str, bytes]
 
             async for str_response in websocket:
-                if str_response.startswith(SwitchedToRealtime.__name__):
-                    # self._logger.debug(f'< {str_response}')
+                if isinstance(str_response, bytes):
+                    for batch in decode_binary_frame(str_response):
+                        if self._yield_batches:
+                            yield batch
+                        else:
+                            for execution in batch:
+                                yield execution
+                    continue
+
+                if str_response.startswith('['):
+                    messages: List[Dict[str, Any]] = loads(str_response)
+                    for item in self._decode(messages):
+                        yield item
+                    continue
 
-                    switched_to_realtime = eval(str_response)
-                    yield switched_to_realtime
+                if not str_response.startswith('{'):
+                    # 移行期間中の、旧形式の制御のフレーム
+                    control = decode_legacy_control_frame(str_response)
+                    if control is None:
+                        raise ValueError(f'unexpected frame: {str_response[:100]}')
+                    yield control
                     continue
 
                 message: Dict[str, Any] = loads(str_response)
+                if is_control_message(message):
+                    control = decode_control_message(message)
+                    if control is None:
+                        self._logger.warning(f'ignored unknown control frame: {str_response}')
+                        continue
+                    yield control
+                    continue
+
+                for item in self._decode([message]):
+                    yield item
+
+    def _decode(self, messages: List[Dict[str, Any]]) -> Iterator[Union[Execution, ExecutionBatch]]:
+        if not self._yield_batches:
+            for message in messages:
                 symbol: Symbol = self._symbol_resolver(message['channel'])
-                execution = self._execution_encoder(symbol, message)
-                # self._logger.debug(f'< {execution}')
+                yield self._execution_encoder(symbol, message)
+            return
 
-                yield execution
+        for channel, group in groupby(messages, key=lambda m: m['channel']):
+            yield ExecutionBatch.encode_bitflyer_responses(self._symbol_resolver(channel), list(group))
 
 
 if __name__ == '__main__':
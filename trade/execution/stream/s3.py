@@ -1,49 +1,436 @@
+import asyncio
+import calendar
+import hashlib
 import json
 import lzma
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import datetime, date
+from io import BytesIO
 from logging import Logger
-from typing import AsyncIterable, AsyncIterator, Iterator, Any, Dict, Optional, List
+from typing import AsyncIterable, AsyncIterator, Iterator, Any, Dict, Optional, List, Iterable, Tuple, \
+    Sequence
 
 import boto3
 import numpy as np
 import pandas as pd
 from botocore.response import StreamingBody
 
-from trade.execution.model import Execution
-from trade.model import Exchange, Symbol, normalize_exchange_name
+from trade.execution.model import Execution, ExecutionBatch
+from trade.model import Exchange, Symbol, normalize_exchange_name, Precision
+
+try:
+    # 利用できる場合は、標準のjsonより速いorjsonでデコードします
+    from orjson import loads as _loads
+except ImportError:
+    def _loads(line: bytes) -> Any:
+        # json.loads はbytesの符号化方式を判定するため、UTF-8としてデコードしてから渡します
+        return json.loads(line.decode('utf-8'))
+
+# bitFlyerの約定のチャネル名に含まれるバイト列
+_EXECUTIONS_CHANNEL = b'lightning_executions_'
 
 
 class S3Stream(AsyncIterable[Execution]):
     """
     AWS S3オブジェクト を源とする、Executionストリーム
+
+    `fixed_point`がTrueの場合、価格およびサイズは固定小数点の整数としてセットされます。
+    S3オブジェクトは`chunk_size`バイトずつ読み込みながら伸長し、行が揃う毎にExecutionを返します。
+    `body`が指定された場合、S3オブジェクトを取得せずに、これを読み込みます。
+    `cache`が指定された場合、S3オブジェクトはS3Cacheを介して取得します。
     """
 
-    def __init__(self, logger: Logger, bucket: str, key: str, symbol: Symbol):
+    def __init__(self, logger: Logger, bucket: str, key: str, symbol: Symbol, fixed_point: bool = False,
+                 chunk_size: int = 1024 * 1024, body: Optional[StreamingBody] = None,
+                 cache: Optional['S3Cache'] = None):
         self._logger = logger
         self._symbol = symbol
+        self._fixed_point = fixed_point
+        self._chunk_size = chunk_size
 
-        self._logger.info(f'started to get: bucket: {bucket}, key: {key}')
-        self._s3_streaming: StreamingBody = boto3.resource('s3').Bucket(bucket).Object(key).get()['Body']
+        if body is None and cache is not None:
+            body = cache.open(bucket, key)['Body']
+        if body is None:
+            self._logger.info(f'started to get: bucket: {bucket}, key: {key}')
+            body = boto3.resource('s3').Bucket(bucket).Object(key).get()['Body']
+        self._s3_streaming: StreamingBody = body
 
     def __del__(self):
-        self._s3_streaming.close()
+        # __init__でオブジェクトの取得に失敗した場合 (オフラインのキャッシュにない場合など) は、閉じるものがありません
+        s3_streaming: Optional[StreamingBody] = getattr(self, '_s3_streaming', None)
+        if s3_streaming is not None:
+            s3_streaming.close()
+
+    def _iter_blocks(self) -> Iterator[bytes]:
+        """
+        伸長したS3オブジェクトを、行の境界で区切ったブロックのイテレータとして返します。
+        チャンクの境界をまたぐ行は、次のブロックに含まれます。
+        """
+        decompressor = lzma.LZMADecompressor()
+        decompressing = False
+        rest = b''
+
+        for chunk in self._s3_streaming.iter_chunks(self._chunk_size):
+            while chunk or decompressing and not decompressor.needs_input:
+                # 伸長後の大きさを制限し、圧縮率の高いチャンクでもメモリの使用量を抑えます
+                binary = decompressor.decompress(chunk, max_length=self._chunk_size)
+                decompressing = True
+                chunk = b''
+
+                binary = rest + binary
+                end = binary.rfind(b'\n') + 1
+                rest = binary[end:]
+                if end:
+                    yield binary[:end]
+
+                if decompressor.eof:
+                    # lzma.decompress と同じく、連結された複数のストリームを伸長します
+                    chunk = decompressor.unused_data
+                    decompressor = lzma.LZMADecompressor()
+                    decompressing = False
+
+        if decompressing:
+            raise EOFError('Compressed data ended before the end-of-stream marker was reached')
+
+        if rest:
+            yield rest
+
+    def _iter_messages(self) -> Iterator[Dict[str, Any]]:
+        """
+        約定のメッセージのイテレータを返します。約定を含まない行は、行に分割せずにバイト列のまま読み飛ばします。
+        """
+        for block in self._iter_blocks():
+            lines: List[bytes] = list()
+
+            # TODO: bitFlyerの他はどうする？
+            begin = block.find(_EXECUTIONS_CHANNEL)
+            while begin >= 0:
+                begin = block.rfind(b'\n', 0, begin) + 1
+                end = block.find(b'\n', begin)
+                if end < 0:
+                    end = len(block)
+                lines.append(block[begin:end])
+                begin = block.find(_EXECUTIONS_CHANNEL, end)
+
+            if not lines:
+                continue
+
+            # ブロック内の約定の行を、ひとつのJSON配列としてまとめてデコードします
+            for _json in _loads(b'[' + b','.join(lines) + b']'):
+                yield from _json['message']
 
     async def __aiter__(self) -> AsyncIterator[Execution]:
-        buf: List[bytes] = list()
-        for chunk in self._s3_streaming.iter_chunks(1024 * 1000 * 1000):
-            buf.append(chunk)
+        for message in self._iter_messages():
+            execution = Execution.encode_bitflyer_response(
+                symbol=self._symbol, dictobj=message, fixed_point=self._fixed_point
+            )
+            yield execution
 
-        binary = lzma.decompress(b''.join(buf))
 
-        for line in [line.decode('utf-8') for line in binary.splitlines()]:
-            if 'lightning_executions_' not in line:  # TODO: bitFlyerの他はどうする？
-                continue
-            _json = json.loads(line)
-            for message in _json['message']:
-                execution = Execution.encode_bitflyer_response(symbol=self._symbol, dictobj=message)
+class S3BatchStream(AsyncIterable[ExecutionBatch]):
+    """
+    AWS S3オブジェクト を源とする、ExecutionBatchストリーム
+
+    `batch_size`件の約定ごとに、タイムスタンプ、価格およびサイズを列単位でまとめて変換したExecutionBatchを返します。
+    価格およびサイズは、精度を超える桁が丸められます。その他の引数はS3Streamと同様です。
+    """
+
+    def __init__(self, logger: Logger, bucket: str, key: str, symbol: Symbol, batch_size: int = 10_000,
+                 price_precision: Optional[int] = None, size_precision: Optional[int] = None, **kwargs):
+        self._symbol = symbol
+        self._batch_size = batch_size
+        precision = Precision.of(symbol)
+        self._price_precision = precision.price if price_precision is None else price_precision
+        self._size_precision = precision.size if size_precision is None else size_precision
+        self._stream = S3Stream(logger, bucket=bucket, key=key, symbol=symbol, **kwargs)
+
+    async def __aiter__(self) -> AsyncIterator[ExecutionBatch]:
+        messages: List[Dict[str, Any]] = list()
+        for message in self._stream._iter_messages():
+            messages.append(message)
+            if len(messages) == self._batch_size:
+                yield self._decode(messages)
+                messages = list()
+        if messages:
+            yield self._decode(messages)
+
+    def _decode(self, messages: List[Dict[str, Any]]) -> ExecutionBatch:
+        return ExecutionBatch.encode_bitflyer_responses(
+            self._symbol, messages, price_precision=self._price_precision, size_precision=self._size_precision
+        )
+
+
+class S3Prefetcher:
+    """
+    S3オブジェクトの先読み
+
+    `open`で開かれたキーと、`keys`の順でそれに続く最大`prefetch`個のS3オブジェクトを、並行してダウンロードします。
+    ダウンロードを始めたがまだ読み終えていないオブジェクトの合計が`memory_budget`バイトを超える場合、
+    次に読まれるオブジェクトの他は、ダウンロードを待ちます。次に読まれるオブジェクトは予算を超えてもダウンロードするため、
+    メモリの使用量は最大で、予算とオブジェクトひとつ分の合計です。
+    """
+
+    def __init__(self, logger: Logger, bucket: str, keys: Iterable[str], symbol: Symbol, fixed_point: bool = False,
+                 prefetch: int = 2, memory_budget: int = 512 * 1024 * 1024, cache: Optional['S3Cache'] = None):
+        self._logger = logger
+        self._cache = cache
+        self._bucket = bucket
+        self._keys: List[str] = list(keys)
+        self._indexes: Dict[str, int] = {key: index for index, key in enumerate(self._keys)}
+        self._symbol = symbol
+        self._fixed_point = fixed_point
+        self._prefetch = prefetch
+        self._memory_budget = memory_budget
+
+        self._executor = ThreadPoolExecutor(max_workers=prefetch + 1, thread_name_prefix=self.__class__.__name__)
+        self._futures: Dict[int, Future] = dict()
+
+        self._condition = threading.Condition()
+        self._reserved = 0
+        self._next_index = 0
+        self._closed = False
+
+    @property
+    def keys(self) -> List[str]:
+        return self._keys
+
+    def open(self, key: str) -> AsyncIterable[Execution]:
+        """
+        キーのExecutionストリームを返し、続くS3オブジェクトのダウンロードを始めます。
+        """
+        index = self._indexes[key]
+        with self._condition:
+            self._next_index = index
+            self._condition.notify_all()
+
+        for i in range(index, min(index + 1 + self._prefetch, len(self._keys))):
+            if i not in self._futures:
+                self._futures[i] = self._executor.submit(self._download, i)
+
+        return _PrefetchedS3Stream(self, index)
+
+    def close(self):
+        """
+        待っているダウンロードを取り消し、実行中のダウンロードの終了を待ちます。
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for future in self._futures.values():
+            future.cancel()
+        self._executor.shutdown(wait=True)
+
+    def _download(self, index: int) -> Tuple[bytes, int]:
+        key = self._keys[index]
+        if self._cache is not None:
+            response: Dict[str, Any] = self._cache.open(self._bucket, key)
+        else:
+            response: Dict[str, Any] = boto3.resource('s3').Bucket(self._bucket).Object(key).get()
+        size: int = response['ContentLength']
+
+        with self._condition:
+            while self._memory_budget < self._reserved + size and index != self._next_index:
+                if self._closed:
+                    response['Body'].close()
+                    raise RuntimeError(f'{self.__class__.__name__} is closed')
+                self._condition.wait()
+            self._reserved += size
+
+        try:
+            self._logger.info(f'started to prefetch: bucket: {self._bucket}, key: {key}, size: {size}')
+            return response['Body'].read(), size
+        except BaseException:
+            self._release(size)
+            raise
+        finally:
+            response['Body'].close()
+
+    def _release(self, size: int):
+        with self._condition:
+            self._reserved -= size
+            self._condition.notify_all()
+
+    async def _read(self, index: int) -> AsyncIterator[Execution]:
+        binary, size = await asyncio.wrap_future(self._futures.pop(index))
+        try:
+            stream = S3Stream(
+                self._logger, bucket=self._bucket, key=self._keys[index], symbol=self._symbol,
+                fixed_point=self._fixed_point, body=StreamingBody(BytesIO(binary), size),
+            )
+            del binary
+            async for execution in stream:
                 yield execution
+        finally:
+            self._release(size)
+
+
+class _PrefetchedS3Stream(AsyncIterable[Execution]):
+
+    def __init__(self, prefetcher: S3Prefetcher, index: int):
+        self._prefetcher = prefetcher
+        self._index = index
+
+    def __aiter__(self) -> AsyncIterator[Execution]:
+        return self._prefetcher._read(self._index)
+
+
+class S3Cache:
+    """
+    S3オブジェクトのローカルキャッシュ
+
+    バケット、キーおよびETagから求めたファイル名で、S3オブジェクトを`directory`に保存します。
+    保存したオブジェクトの合計が`max_size`バイトを超えると、最も長く使われていないオブジェクトから削除します。
+    キー毎の最新のETagは、list_s3_keysの一覧またはダウンロードから記録します。
+    インデックスはダウンロードや削除などで変わった時に保存し、キャッシュにあったオブジェクトを開いた時の
+    使用順の変更は、`close`で保存します。
+    `offline`がTrueの場合、S3にアクセスせず、保存したオブジェクトだけを使います。
+    """
+
+    INDEX_FILENAME = 'index.json'
+
+    def __init__(self, logger: Logger, directory: str, max_size: int = 10 * 1024 * 1024 * 1024,
+                 offline: bool = False):
+        self._logger = logger
+        self._directory = directory
+        self._max_size = max_size
+        self._offline = offline
+        self._lock = threading.Lock()
+
+        os.makedirs(self._directory, exist_ok=True)
+
+        # ファイル名からサイズへの辞書。最も長く使われていないオブジェクトが先頭です
+        self._objects: 'OrderedDict[str, int]' = OrderedDict()
+        # 'bucket/key' からETagへの辞書
+        self._etags: Dict[str, str] = dict()
+        try:
+            with open(os.path.join(self._directory, self.INDEX_FILENAME)) as f:
+                d = json.load(f)
+            self._objects.update((o['filename'], o['size']) for o in d['objects'])
+            self._etags.update(d['etags'])
+        except FileNotFoundError:
+            pass
+        self._size = sum(self._objects.values())
+        # 保存していないインデックスの変更があるか
+        self._dirty = False
+
+    @property
+    def offline(self) -> bool:
+        return self._offline
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def close(self):
+        """
+        保存していないインデックスの変更 (オブジェクトの使用順など) を保存します。
+        """
+        with self._lock:
+            if self._dirty:
+                self._save()
+
+    @staticmethod
+    def _filename(bucket: str, key: str, etag: str) -> str:
+        return hashlib.sha256(f'{bucket}/{key}/{etag}'.encode('utf-8')).hexdigest()
+
+    def list_keys(self, bucket: str, s3_key_prefix: Optional[str]) -> List[str]:
+        """
+        保存されたオブジェクトのうち、プレフィックスに一致するキーの一覧を返します。
+        """
+        keys: List[str] = list()
+        with self._lock:
+            for bucket_key, etag in self._etags.items():
+                _bucket, key = bucket_key.split('/', maxsplit=1)
+                if _bucket == bucket and key.startswith(s3_key_prefix or '') \
+                        and self._filename(bucket, key, etag) in self._objects:
+                    keys.append(key)
+        return sorted(keys)
+
+    def update_etags(self, bucket: str, etags: Dict[str, str]):
+        with self._lock:
+            self._etags.update((f'{bucket}/{key}', etag) for key, etag in etags.items())
+            self._save()
+
+    def open(self, bucket: str, key: str) -> Dict[str, Any]:
+        """
+        S3オブジェクトを開きます。保存されていない場合は、ダウンロードして保存します。
+
+        :return: boto3のObject.getと同じく、Body, ContentLength, ETagを持つ辞書
+        """
+        with self._lock:
+            etag = self._etags.get(f'{bucket}/{key}')
+            cached = etag and self._open_cached(bucket, key, etag)
+        if cached:
+            return cached
+        if self._offline:
+            raise FileNotFoundError(f'not cached: bucket: {bucket}, key: {key}')
+
+        response: Dict[str, Any] = boto3.resource('s3').Bucket(bucket).Object(key).get()
+        etag = response['ETag']
+        filename = self._filename(bucket, key, etag)
+        with self._lock:
+            self._etags[f'{bucket}/{key}'] = etag
+            self._dirty = True
+            cached = self._open_cached(bucket, key, etag)
+        if cached:
+            response['Body'].close()
+            return cached
+
+        self._logger.info(f'started to get: bucket: {bucket}, key: {key}, etag: {etag}')
+        path = os.path.join(self._directory, filename)
+        temp_path = f'{path}.{threading.get_ident()}.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                for chunk in response['Body'].iter_chunks(1024 * 1024):
+                    f.write(chunk)
+            os.replace(temp_path, path)
+        finally:
+            response['Body'].close()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        with self._lock:
+            size = os.path.getsize(path)
+            self._size += size - self._objects.get(filename, 0)
+            self._objects[filename] = size
+            self._evict(excluded=filename)
+            self._save()
+            return self._open_cached(bucket, key, etag)
+
+    def _open_cached(self, bucket: str, key: str, etag: str) -> Optional[Dict[str, Any]]:
+        filename = self._filename(bucket, key, etag)
+        if filename not in self._objects:
+            return None
+        self._objects.move_to_end(filename)
+        self._dirty = True
+        size = self._objects[filename]
+        return dict(
+            Body=StreamingBody(open(os.path.join(self._directory, filename), 'rb'), size), ContentLength=size, ETag=etag
+        )
+
+    def _evict(self, excluded: str):
+        for filename in list(self._objects):
+            if self._size <= self._max_size:
+                break
+            if filename == excluded:
+                continue
+            self._logger.info(f'evicted: {filename}')
+            os.remove(os.path.join(self._directory, filename))
+            self._size -= self._objects.pop(filename)
+
+    def _save(self):
+        path = os.path.join(self._directory, self.INDEX_FILENAME)
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(dict(
+                objects=[dict(filename=filename, size=size) for filename, size in self._objects.items()],
+                etags=self._etags,
+            ), f)
+        os.replace(f'{path}.tmp', path)
+        self._dirty = False
 
 
 class _ObjectNameV1:
@@ -111,27 +498,14 @@ def build_s3_key_prefix(logger: Logger,
     return ''.join(e)
 
 
-def list_s3_keys(logger: Logger,
-                 bucket: str,
-                 s3_key_prefix: Optional[str],
-                 datetime_from: Optional[np.datetime64]) -> Iterator[str]:
+def _list_s3_objects(bucket: str, s3_key_prefix: Optional[str], s3: Optional[Any] = None) -> Dict[str, str]:
     """
-    S3 Keyのイテレータを返します。
-
-    :param logger: ロガーオブジェクト
-    :param bucket: 対象S3バケット
-    :param s3_key_prefix: 指定された場合、この値がS3キーの絞り込みのために使われます。S3 List objectの回数削減に
-    役立ちます。
-    :param datetime_from: 指定された場合、この値をExecutionタイムスタンプとして含むS3オブジェクトのキー、およびより新しい
-    Executionが保存されているS3オブジェクトのキーだけを返します。
-    :return: S3 Keyのイテレータ。Keyの昇順にソートされています。
+    S3 KeyからETagへの辞書を返します。
     """
-    logger.info(f's3 key prefix: {s3_key_prefix}')
-
-    s3 = boto3.client('s3')
+    s3 = s3 or boto3.client('s3')
     params = {'Bucket': bucket, 'Prefix': s3_key_prefix, 'MaxKeys': 1000}
     continuation_token: Optional[str] = None
-    keys: List[str] = list()
+    etags: Dict[str, str] = dict()
 
     while True:
         if continuation_token:
@@ -140,7 +514,7 @@ def list_s3_keys(logger: Logger,
         response: Dict[Any, Any] = s3.list_objects_v2(**params)
 
         if 'Contents' not in response:
-            return
+            return dict()
 
         for content in response['Contents']:
             key: str = content['Key']
@@ -148,7 +522,7 @@ def list_s3_keys(logger: Logger,
             if key.endswith('/'):
                 continue
 
-            keys.append(key)
+            etags[key] = content['ETag']
 
         if 'IsTruncated' in response:
             if not response['IsTruncated']:
@@ -159,7 +533,90 @@ def list_s3_keys(logger: Logger,
         else:
             continuation_token = None
 
-    keys.sort()
+    return etags
+
+
+def list_s3_keys(logger: Logger,
+                 bucket: str,
+                 s3_key_prefix: Optional[str],
+                 datetime_from: Optional[np.datetime64],
+                 cache: Optional[S3Cache] = None) -> Iterator[str]:
+    """
+    S3 Keyのイテレータを返します。
+
+    :param logger: ロガーオブジェクト
+    :param bucket: 対象S3バケット
+    :param s3_key_prefix: 指定された場合、この値がS3キーの絞り込みのために使われます。S3 List objectの回数削減に
+    役立ちます。
+    :param datetime_from: 指定された場合、この値をExecutionタイムスタンプとして含むS3オブジェクトのキー、およびより新しい
+    Executionが保存されているS3オブジェクトのキーだけを返します。
+    :param cache: 指定された場合、一覧のETagをこのキャッシュに記録します。キャッシュがオフラインの場合は、S3にアクセスせず、
+    キャッシュに保存されたオブジェクトのキーを返します。
+    :return: S3 Keyのイテレータ。Keyの昇順にソートされています。
+    """
+    logger.info(f's3 key prefix: {s3_key_prefix}')
+
+    yield from _filter_s3_keys(sorted(_list_s3_keys(bucket, s3_key_prefix, cache)), datetime_from)
+
+
+def list_s3_keys_by_day(logger: Logger,
+                        bucket: str,
+                        symbol: Symbol,
+                        exchange: Exchange,
+                        channel: str,
+                        version: int,
+                        days: Sequence[date],
+                        datetime_from: Optional[np.datetime64],
+                        concurrency: int = 8,
+                        cache: Optional[S3Cache] = None) -> Iterator[str]:
+    """
+    日毎のS3 Keyプレフィックスを並行して一覧し、S3 Keyのイテレータを返します。
+
+    各日の一覧は`concurrency`個まで並行して取得され、それより前の日の一覧がそろい次第、Keyの昇順で返されます。
+    `datetime_from`および`cache`の扱いは、list_s3_keysと同様です。
+
+    :param days: 一覧する日。昇順にソートされている必要があります。
+    """
+    prefixes = [
+        build_s3_key_prefix(logger, symbol, exchange, channel, version, year=day.year, month=day.month, day=day.day)
+        for day in days
+    ]
+    logger.info(f's3 key prefixes: {prefixes[:1]} ... {prefixes[-1:]}, concurrency: {concurrency}')
+
+    # クライアントはスレッドセーフですが、生成はスレッドセーフではないため、先に生成して共有します
+    s3 = None if cache is not None and cache.offline else boto3.client('s3')
+
+    def _list(prefix: str) -> List[str]:
+        return sorted(_list_s3_keys(bucket, prefix, cache, s3))
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='list_s3_keys_by_day') as executor:
+        yield from _filter_s3_keys((key for keys in executor.map(_list, prefixes) for key in keys), datetime_from)
+
+
+def days_of(year: int, month: Optional[int] = None) -> List[date]:
+    """
+    年、または年と月に含まれる日のリストを返します。
+    """
+    months = [month] if month else range(1, 13)
+    return [date(year, m, d) for m in months for d in range(1, calendar.monthrange(year, m)[1] + 1)]
+
+
+def _list_s3_keys(bucket: str, s3_key_prefix: Optional[str], cache: Optional[S3Cache],
+                  s3: Optional[Any] = None) -> List[str]:
+    if cache is not None and cache.offline:
+        return cache.list_keys(bucket, s3_key_prefix)
+
+    etags = _list_s3_objects(bucket, s3_key_prefix, s3)
+    if cache is not None:
+        cache.update_etags(bucket, etags)
+    return list(etags)
+
+
+def _filter_s3_keys(keys: Iterable[str], datetime_from: Optional[np.datetime64]) -> Iterator[str]:
+    """
+    ソートされたS3 Keyのうち、`datetime_from`をExecutionタイムスタンプとして含むS3オブジェクトのキー、
+    およびより新しいExecutionが保存されているS3オブジェクトのキーだけを返します。
+    """
     prev = None
     firstly = True
 
@@ -184,7 +641,6 @@ def list_s3_keys(logger: Logger,
 
 if __name__ == '__main__':
     import sys
-    import asyncio
     from trade.log import get_logger
 
 
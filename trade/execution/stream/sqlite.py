@@ -1,37 +1,111 @@
+import asyncio
+import json
 import os
 import sqlite3
+import threading
+from bisect import bisect_left, insort
+from dataclasses import dataclass, field
 from decimal import Decimal
+from enum import Enum
 from logging import Logger
-from typing import Iterator, AsyncIterable, AsyncIterator
+from typing import Iterator, AsyncIterable, AsyncIterator, Optional, List, Sequence, Any, Tuple, Union, Dict, Iterable
 
 import numpy as np
 
-from trade.execution.model import Execution, SynchronizedExecution
+from trade.execution.model import Execution, SynchronizedExecution, ExecutionBatch
 from trade.execution import Chunk
-from trade.model import Symbol, Exchange, normalize_exchange_name
+from trade.model import Symbol, Exchange, normalize_exchange_name, Precision, to_fixed_point
 from trade.side import Side
 
 
+class Projection(Enum):
+    """
+    SQLiteデータベースから読み込むカラムの組
+    """
+
+    # symbol, id, timestamp, side, price, size のみ。その他の属性は`None`になります。
+    CORE = 'core'
+
+    # 全てのカラム
+    SYNCHRONIZED = 'synchronized'
+
+
+class SchemaVersion(Enum):
+    """
+    SQLiteデータベースのスキーマのバージョン
+
+    バージョンは`PRAGMA user_version`に記録されます。記録されていない (0の) データベースはV1として扱います。
+    """
+
+    # timestampはISO 8601文字列、sideは文字列
+    V1 = 1
+
+    # timestampはUNIXエポックからのナノ秒の整数、sideは整数 (`SIDE_CODES`)、価格とサイズは数値、
+    # idは`INTEGER PRIMARY KEY`
+    V2 = 2
+
+    @staticmethod
+    def detect(connection: sqlite3.Connection) -> 'SchemaVersion':
+        user_version, = connection.execute('PRAGMA user_version').fetchone()
+        return SchemaVersion.V2 if user_version == SchemaVersion.V2.value else SchemaVersion.V1
+
+
+# スキーマV2のsideカラムの値
+SIDE_CODES = {Side.BUY: 1, Side.SELL: -1, Side.NOTHING: 0}
+
+
 class SqliteStreamReader(AsyncIterable[Execution]):
     """
     SQLiteデータベースを源とする、Executionストリーム
+
+    `fixed_point`がTrueの場合、価格およびサイズはシンボル毎の精度 (`Precision.of`) による、
+    固定小数点の整数としてセットされます。
+
+    `datetime_from`/`datetime_until`および`id_from`/`id_until`が指定された場合、その範囲 (終端を含まない) の行だけを
+    読み込みます。範囲はSQLのWHERE句として評価されるため、ライターが作成するインデックスが使われます。
+
+    `projection`が`Projection.CORE`の場合、SELECTするカラムを絞り込み、同期された約定などのデコードを省略します。
+
+    スキーマのバージョン (`SchemaVersion`) は、読み込みの開始時にデータベースから判別されます。
     """
 
-    def __init__(self, logger: Logger, connection: sqlite3.Connection):
+    def __init__(self, logger: Logger, connection: sqlite3.Connection, fixed_point: bool = False,
+                 datetime_from: Optional[np.datetime64] = None,
+                 datetime_until: Optional[np.datetime64] = None,
+                 id_from: Optional[int] = None,
+                 id_until: Optional[int] = None,
+                 projection: Projection = Projection.SYNCHRONIZED):
         self._logger = logger
         self._connection = connection
         self._connection.row_factory = sqlite3.Row
+        self._fixed_point = fixed_point
+        self._range = (datetime_from, datetime_until, id_from, id_until)
+        self._projection = projection
 
     async def __aiter__(self) -> AsyncIterator[Execution]:
+        for execution in self._iter():
+            yield execution
+
+    def _iter(self) -> Iterator[Execution]:
+        if self._projection is Projection.CORE:
+            return self._iter_core()
+        return self._iter_synchronized()
+
+    def _iter_synchronized(self) -> Iterator[Execution]:
         with self._connection:
-            for row in self._connection.execute('SELECT * FROM executions WHERE id IS NOT NULL ORDER BY id'):
+            schema_version = SchemaVersion.detect(self._connection)
+            decode_timestamp, decode_side = _DECODERS[schema_version]
+            where, parameters = _build_where(*self._range, schema_version=schema_version)
+
+            for row in self._connection.execute(f'SELECT * FROM executions WHERE {where} ORDER BY id', parameters):
+                symbol = Symbol(row['symbol'])
                 yield Execution(
-                    symbol=Symbol(row['symbol']),
+                    symbol=symbol,
                     _id=row['id'],
-                    timestamp=np.datetime64(row['timestamp'].rstrip('Z'), 'ns', utc=True),
-                    side=row['side'] and Side(row['side']) or Side.NOTHING,
-                    price=Decimal(str(row['price'])),
-                    size=Decimal(str(row['size'])),
+                    timestamp=decode_timestamp(row['timestamp']),
+                    side=decode_side(row['side']),
+                    price=_decode_number(row['price'], Precision.of(symbol).price if self._fixed_point else None),
+                    size=_decode_number(row['size'], Precision.of(symbol).size if self._fixed_point else None),
                     buy_child_order_acceptance_id=row['buy_child_order_acceptance_id'],
                     sell_child_order_acceptance_id=row['sell_child_order_acceptance_id'],
                     synchronized_execution_price_deviation=(
@@ -42,27 +116,375 @@ class SqliteStreamReader(AsyncIterable[Execution]):
                             row['synchronized_execution_time_delta']
                             and np.timedelta64(row['synchronized_execution_time_delta'], 'ns')
                     ),
-                    synchronized_execution=SynchronizedExecution(
-                        symbol=row['synchronized_symbol'] and Symbol(row['synchronized_symbol']),
-                        _id=row['synchronized_id'] and row['synchronized_id'],
-                        timestamp=(
-                                row['synchronized_timestamp']
-                                and np.datetime64(row['synchronized_timestamp'].rstrip('Z'), 'ns', utc=True)
-                        ),
-                        side=row['synchronized_side'] and Side(row['synchronized_side']),
-                        price=row['synchronized_price'] and Decimal(str(row['synchronized_price'])),
-                        size=row['synchronized_size'] and Decimal(str(row['synchronized_size'])),
-                        buy_child_order_acceptance_id=(
-                                row['synchronized_buy_child_order_acceptance_id']
-                                and row['synchronized_buy_child_order_acceptance_id']
-                        ),
-                        sell_child_order_acceptance_id=(
-                                row['synchronized_sell_child_order_acceptance_id']
-                                and row['synchronized_sell_child_order_acceptance_id']
-                        ),
-                    )
+                    synchronized_execution=_decode_synchronized_execution(row, self._fixed_point, schema_version)
                 )
 
+    def _iter_core(self) -> Iterator[Execution]:
+        with self._connection:
+            schema_version = SchemaVersion.detect(self._connection)
+            decode_timestamp, decode_side = _DECODERS[schema_version]
+            where, parameters = _build_where(*self._range, schema_version=schema_version)
+
+            cursor = self._connection.cursor()
+            cursor.row_factory = None
+            cursor.execute(f'SELECT {", ".join(_CORE_COLUMNS)} FROM executions WHERE {where} ORDER BY id', parameters)
+
+            for _symbol, _id, timestamp, side, price, size in cursor:
+                symbol = Symbol(_symbol)
+                yield Execution(
+                    symbol=symbol,
+                    _id=_id,
+                    timestamp=decode_timestamp(timestamp),
+                    side=decode_side(side),
+                    price=_decode_number(price, Precision.of(symbol).price if self._fixed_point else None),
+                    size=_decode_number(size, Precision.of(symbol).size if self._fixed_point else None),
+                    buy_child_order_acceptance_id=None,
+                    sell_child_order_acceptance_id=None,
+                )
+
+            cursor.close()
+
+
+class ThreadedSqliteStreamReader(SqliteStreamReader):
+    """
+    ワーカースレッドで読み込みとデコードを行う、SQLiteデータベースを源とするExecutionストリーム
+
+    ワーカースレッドは`chunk_size`件ごとのExecutionのリストを、最大`prefetch`個まで先読みします。
+    イベントループはsqlite3のカーソル操作でブロックされません。順序およびその他の引数は、SqliteStreamReaderと同じです。
+
+    接続は別のスレッドから使われるため、`check_same_thread=False`で作成されている必要があります。
+    """
+
+    def __init__(self, logger: Logger, connection: sqlite3.Connection,
+                 prefetch: int = 4,
+                 chunk_size: int = 1_000,
+                 **kwargs):
+        super().__init__(logger, connection, **kwargs)
+        if prefetch < 1:
+            raise ValueError(f'prefetch must be positive: {prefetch}')
+
+        self._prefetch = prefetch
+        self._chunk_size = chunk_size
+
+    async def __aiter__(self) -> AsyncIterator[Execution]:
+        loop = asyncio.get_running_loop()
+        queue: 'asyncio.Queue[Union[List[Execution], BaseException, None]]' = asyncio.Queue(maxsize=self._prefetch)
+        stopping = threading.Event()
+        # ワーカースレッドの終了を、イベントループに通知します
+        finished: 'asyncio.Future[None]' = loop.create_future()
+
+        def _put(item: Union[List[Execution], BaseException, None]):
+            # キューに空きができるまで、ワーカースレッドをブロックします
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        def _work():
+            try:
+                chunk: List[Execution] = list()
+                for execution in self._iter():
+                    chunk.append(execution)
+                    if len(chunk) == self._chunk_size:
+                        if stopping.is_set():
+                            return
+                        _put(chunk)
+                        chunk = list()
+                if chunk and not stopping.is_set():
+                    _put(chunk)
+                _put(None)
+            except BaseException as e:
+                if not stopping.is_set():
+                    _put(e)
+            finally:
+                loop.call_soon_threadsafe(finished.set_result, None)
+
+        worker = threading.Thread(target=_work, name=self.__class__.__name__, daemon=True)
+        worker.start()
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                for execution in item:
+                    yield execution
+
+        finally:
+            stopping.set()
+            # キューの空きを待っているワーカースレッドのために、終了するまでキューを読み捨てます
+            while not finished.done():
+                getter = asyncio.ensure_future(queue.get())
+                await asyncio.wait([getter, finished], return_when=asyncio.FIRST_COMPLETED)
+                getter.cancel()
+            # 終了を通知したワーカースレッドは、ブロックせずに合流します
+            worker.join()
+
+
+class SqliteBatchStreamReader(AsyncIterable[ExecutionBatch]):
+    """
+    SQLiteデータベースを源とする、ExecutionBatchストリーム
+
+    `batch_size`行ごとに、列単位でNumPy配列へ変換したExecutionBatchを返します。
+    読み込む範囲および`projection`の指定は、SqliteStreamReaderと同様です。
+    """
+
+    def __init__(self, logger: Logger,
+                 connection: sqlite3.Connection,
+                 batch_size: int = 10_000,
+                 price_precision: Optional[int] = None,
+                 size_precision: Optional[int] = None,
+                 datetime_from: Optional[np.datetime64] = None,
+                 datetime_until: Optional[np.datetime64] = None,
+                 id_from: Optional[int] = None,
+                 id_until: Optional[int] = None,
+                 projection: Projection = Projection.SYNCHRONIZED):
+        self._logger = logger
+        self._connection = connection
+        self._batch_size = batch_size
+        self._columns = _CORE_COLUMNS if projection is Projection.CORE else _BATCH_COLUMNS
+        self._price_precision = price_precision
+        self._size_precision = size_precision
+        self._range = (datetime_from, datetime_until, id_from, id_until)
+
+    async def __aiter__(self) -> AsyncIterator[ExecutionBatch]:
+        for batch in self._iter():
+            yield batch
+
+    def _iter(self) -> Iterator[ExecutionBatch]:
+        with self._connection:
+            schema_version = SchemaVersion.detect(self._connection)
+            where, parameters = _build_where(*self._range, schema_version=schema_version)
+
+            cursor = self._connection.cursor()
+            cursor.row_factory = None
+            cursor.execute(f'SELECT {", ".join(self._columns)} FROM executions WHERE {where} ORDER BY id', parameters)
+
+            while True:
+                rows = cursor.fetchmany(self._batch_size)
+                if not rows:
+                    break
+
+                for symbol, begin, end in _split_by_symbol([row[0] for row in rows]):
+                    yield self._decode(symbol, list(zip(*rows[begin:end])), schema_version)
+
+            cursor.close()
+
+    def _decode(self, symbol: str, columns: List[Sequence[Any]], schema_version: SchemaVersion) -> ExecutionBatch:
+        batch = _decode_batch(
+            symbol, columns[1:8], price_precision=self._price_precision, size_precision=self._size_precision,
+            schema_version=schema_version
+        )
+        if len(columns) == len(_CORE_COLUMNS):
+            return batch
+
+        synchronized_mask = np.array([v is not None for v in columns[10]], dtype=bool)
+        if synchronized_mask.any():
+            placeholder = int(np.argmax(synchronized_mask))
+            synchronized_columns = [
+                [v if m else c[placeholder] for m, v in zip(synchronized_mask.tolist(), c)] for c in columns[9:16]
+            ]
+            batch.synchronized = _decode_batch(
+                columns[8][placeholder], synchronized_columns,
+                price_precision=self._price_precision, size_precision=self._size_precision,
+                schema_version=schema_version
+            )
+            batch.synchronized_mask = synchronized_mask
+
+        return batch
+
+
+_CORE_COLUMNS = ('symbol', 'id', 'timestamp', 'side', 'price', 'size')
+
+_BATCH_COLUMNS = ('symbol', 'id', 'timestamp', 'side', 'price', 'size',
+                  'buy_child_order_acceptance_id', 'sell_child_order_acceptance_id',
+                  'synchronized_symbol', 'synchronized_id', 'synchronized_timestamp', 'synchronized_side',
+                  'synchronized_price', 'synchronized_size', 'synchronized_buy_child_order_acceptance_id',
+                  'synchronized_sell_child_order_acceptance_id')
+
+_SIDE_CODES = {'BUY': 1, 'SELL': -1, '': 0, None: 0}
+
+_SIDES_BY_CODE = {code: side for side, code in SIDE_CODES.items()}
+
+
+def _decode_iso_timestamp(value: str) -> np.datetime64:
+    return np.datetime64(value.rstrip('Z'), 'ns', utc=True)
+
+
+def _decode_epoch_timestamp(value: int) -> np.datetime64:
+    return np.datetime64(value, 'ns')
+
+
+def _decode_side_string(value: Optional[str]) -> Side:
+    return value and Side(value) or Side.NOTHING
+
+
+# スキーマのバージョン毎の、timestampおよびsideカラムのデコーダー
+_DECODERS = {
+    SchemaVersion.V1: (_decode_iso_timestamp, _decode_side_string),
+    SchemaVersion.V2: (_decode_epoch_timestamp, _SIDES_BY_CODE.__getitem__),
+}
+
+
+def encode_epoch_timestamp(dt: np.datetime64) -> int:
+    """
+    日時を、スキーマV2のtimestampカラムの値 (UNIXエポックからのナノ秒) に変換します。
+    """
+    return np.datetime64(dt, 'ns').item()
+
+
+def _build_where(datetime_from: Optional[np.datetime64],
+                 datetime_until: Optional[np.datetime64],
+                 id_from: Optional[int],
+                 id_until: Optional[int],
+                 schema_version: SchemaVersion = SchemaVersion.V1) -> Tuple[str, List[Any]]:
+    """
+    読み込む範囲から、WHERE句とそのパラメーターを返します。
+
+    スキーマV1のtimestampカラムはISO 8601文字列で、小数部の桁数や末尾の'Z'の有無は行によって異なり、
+    'Z'は数字や'.'より辞書順で後にあるため、文字列のままの比較は日時の比較と一致しません。
+    そのため、'Z'を除いて小数部を9桁に揃えた文字列 (`_V1_TIMESTAMP`) を、ナノ秒の日時の文字列と比較します。
+    この式ではインデックスを使えないため、秒の単位では文字列のままの比較が日時の比較と一致することを使って、
+    秒に切り捨てた日時によるインデックスの使える条件を併せて指定します。
+    スキーマV2では、エポックからのナノ秒の整数として比較します。
+    """
+    conditions, parameters = ['id IS NOT NULL'], list()
+    v2 = schema_version is SchemaVersion.V2
+
+    if datetime_from is not None:
+        if v2:
+            conditions.append('timestamp >= ?')
+            parameters.append(encode_epoch_timestamp(datetime_from))
+        else:
+            conditions.extend(['timestamp >= ?', f'{_V1_TIMESTAMP} >= ?'])
+            parameters.extend([_second_string(datetime_from), _nanosecond_string(datetime_from)])
+    if datetime_until is not None:
+        if v2:
+            conditions.append('timestamp < ?')
+            parameters.append(encode_epoch_timestamp(datetime_until))
+        else:
+            conditions.extend(['timestamp < ?', f'{_V1_TIMESTAMP} < ?'])
+            parameters.extend([_second_string(datetime_until, 1), _nanosecond_string(datetime_until)])
+    if id_from is not None:
+        conditions.append('id >= ?')
+        parameters.append(id_from)
+    if id_until is not None:
+        conditions.append('id < ?')
+        parameters.append(id_until)
+
+    return ' AND '.join(conditions), parameters
+
+
+# スキーマV1のtimestampカラムから'Z'を除き、小数部を9桁に揃えた式 ('YYYY-MM-DDTHH:MM:SS.fffffffff')
+_V1_TIMESTAMP = "substr(rtrim(timestamp, 'Z') || " \
+                "CASE WHEN instr(timestamp, '.') > 0 THEN '' ELSE '.' END || '000000000', 1, 29)"
+
+
+def _nanosecond_string(dt: np.datetime64) -> str:
+    return str(np.datetime64(dt, 'ns'))
+
+
+def _second_string(dt: np.datetime64, seconds: int = 0) -> str:
+    return str(np.datetime64(dt, 'ns').astype('datetime64[s]') + np.timedelta64(seconds, 's'))
+
+
+def _split_by_symbol(symbols: Sequence[str]) -> Iterator[Tuple[Symbol, int, int]]:
+    begin = 0
+    for n in range(1, len(symbols) + 1):
+        if n == len(symbols) or symbols[n] != symbols[begin]:
+            yield Symbol(symbols[begin]), begin, n
+            begin = n
+
+
+def _decode_batch(symbol: Union[Symbol, str],
+                  columns: Sequence[Sequence[Any]],
+                  price_precision: Optional[int],
+                  size_precision: Optional[int],
+                  schema_version: SchemaVersion = SchemaVersion.V1) -> ExecutionBatch:
+    """
+    id, timestamp, side, price, size, buy_child_order_acceptance_id, sell_child_order_acceptance_idの各列から、
+    ExecutionBatchを組み立てます。acceptance idの列は省略できます。
+    精度が指定されない場合、シンボル毎の精度 (`Precision.of`) が使われます。
+    """
+    symbol = Symbol(symbol)
+    precision = Precision.of(symbol)
+    price_precision = precision.price if price_precision is None else price_precision
+    size_precision = precision.size if size_precision is None else size_precision
+
+    ids, timestamps, sides, prices, sizes = columns[:5]
+    buy_ids, sell_ids = columns[5:7] if len(columns) == 7 else (None, None)
+    if schema_version is SchemaVersion.V2:
+        timestamps = np.array(timestamps, dtype=np.int64)
+        sides = np.array(sides, dtype=np.int8)
+    else:
+        timestamps = np.array([t.rstrip('Z') for t in timestamps], dtype='datetime64[ns]').view(np.int64)
+        sides = np.array([_SIDE_CODES[s] for s in sides], dtype=np.int8)
+
+    return ExecutionBatch(
+        symbol=symbol,
+        ids=np.array(ids, dtype=np.int64),
+        timestamps=timestamps,
+        sides=sides,
+        prices=np.rint(np.array(prices, dtype=np.float64) * 10 ** price_precision).astype(np.int64),
+        sizes=np.rint(np.array(sizes, dtype=np.float64) * 10 ** size_precision).astype(np.int64),
+        buy_child_order_acceptance_ids=None if buy_ids is None else np.array(buy_ids, dtype=object),
+        sell_child_order_acceptance_ids=None if sell_ids is None else np.array(sell_ids, dtype=object),
+        price_precision=price_precision,
+        size_precision=size_precision,
+    )
+
+
+def _decode_number(value: Union[int, float], precision: Optional[int]) -> Union[Decimal, int]:
+    """
+    SQLiteの数値を、`precision`が指定された場合はその精度の固定小数点の整数に、そうでなければDecimalに変換します。
+    """
+    if precision is None:
+        return Decimal(str(value))
+    return to_fixed_point(Decimal(str(value)), precision)
+
+
+_SYNCHRONIZED_COLUMNS = ('synchronized_symbol', 'synchronized_id', 'synchronized_timestamp', 'synchronized_side',
+                         'synchronized_price', 'synchronized_size', 'synchronized_buy_child_order_acceptance_id',
+                         'synchronized_sell_child_order_acceptance_id')
+
+
+def _decode_synchronized_execution(row: sqlite3.Row,
+                                   fixed_point: bool = False,
+                                   schema_version: SchemaVersion = SchemaVersion.V1) -> Optional[SynchronizedExecution]:
+    """
+    synchronizedではじまる名前のカラムからSynchronizedExecutionを返します。
+    該当するカラムが全てNULLの場合、オブジェクトを確保せずに`None`を返します。
+    """
+    for column in _SYNCHRONIZED_COLUMNS:
+        if row[column] is not None:
+            break
+    else:
+        return None
+
+    decode_timestamp, decode_side = _DECODERS[schema_version]
+    symbol = row['synchronized_symbol'] and Symbol(row['synchronized_symbol'])
+    precision = Precision.of(symbol) if fixed_point and symbol else None
+    return SynchronizedExecution(
+        symbol=symbol,
+        _id=row['synchronized_id'] and row['synchronized_id'],
+        timestamp=(
+                None if row['synchronized_timestamp'] is None else decode_timestamp(row['synchronized_timestamp'])
+        ),
+        side=None if row['synchronized_side'] is None else decode_side(row['synchronized_side']),
+        price=row['synchronized_price'] and _decode_number(
+            row['synchronized_price'], None if precision is None else precision.price
+        ),
+        size=row['synchronized_size'] and _decode_number(
+            row['synchronized_size'], None if precision is None else precision.size
+        ),
+        buy_child_order_acceptance_id=(
+                row['synchronized_buy_child_order_acceptance_id']
+                and row['synchronized_buy_child_order_acceptance_id']
+        ),
+        sell_child_order_acceptance_id=(
+                row['synchronized_sell_child_order_acceptance_id']
+                and row['synchronized_sell_child_order_acceptance_id']
+        ),
+    )
+
 
 class FileName:
     """
@@ -118,34 +540,239 @@ class FileName:
             return ''.join([date, 'T', time, '.', appendix])
 
 
-def list_sqlite_connections(path: str, datetime_from: np.datetime64 = None) -> Iterator[sqlite3.Connection]:
+@dataclass(order=True)
+class ChunkManifestEntry:
+    """
+    チャンクマニフェストの、ひとつのSQLiteデータベースファイルの記録
+    """
+    first_id: int
+    filename: str = field(compare=False)
+    chunk: Chunk = field(compare=False)
+    rows: int = field(compare=False)
+    size: int = field(compare=False)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(
+            filename=self.filename,
+            exchange=self.chunk.exchange.value, symbol=self.chunk.symbol.value,
+            first_id=self.chunk.first_id, first_datetime=str(self.chunk.first_datetime),
+            last_id=self.chunk.last_id, last_datetime=str(self.chunk.last_datetime),
+            rows=self.rows, size=self.size,
+        )
+
+    @staticmethod
+    def from_dict(d: Dict[str, Any]) -> 'ChunkManifestEntry':
+        return ChunkManifestEntry(
+            first_id=d['first_id'],
+            filename=d['filename'],
+            chunk=Chunk(
+                exchange=Exchange(d['exchange']), symbol=Symbol(d['symbol']),
+                first_id=d['first_id'], first_datetime=np.datetime64(d['first_datetime'], 'ns'),
+                last_id=d['last_id'], last_datetime=np.datetime64(d['last_datetime'], 'ns'),
+            ),
+            rows=d['rows'],
+            size=d['size'],
+        )
+
+    @staticmethod
+    def from_file(path: str) -> 'ChunkManifestEntry':
+        chunk = FileName.parse(os.path.basename(path))
+        connection = sqlite3.Connection(path)
+        try:
+            rows, = connection.execute('SELECT COUNT(*) FROM executions').fetchone()
+        finally:
+            connection.close()
+
+        return ChunkManifestEntry(
+            first_id=chunk.first_id, filename=os.path.basename(path), chunk=chunk, rows=rows,
+            size=os.path.getsize(path)
+        )
+
+
+class ChunkManifest:
+    """
+    データセットディレクトリのSQLiteデータベースファイルの一覧
+
+    各チャンクのexchange, symbol, idの範囲, 日時の範囲, 行数, ファイルサイズを`FILENAME`に記録します。
+    ファイル名の解析やディレクトリの走査をせずに、idまたは日時による二分探索でチャンクを選べます。
+    """
+
+    FILENAME = 'manifest.json'
+
+    def __init__(self, entries: Iterable[ChunkManifestEntry] = ()):
+        self._entries: List[ChunkManifestEntry] = sorted(entries)
+        self._build_keys()
+
+    @property
+    def entries(self) -> Sequence[ChunkManifestEntry]:
+        return self._entries
+
+    @staticmethod
+    def load(directory: str) -> Optional['ChunkManifest']:
+        """
+        マニフェストを読み込みます。マニフェストが存在しない場合は、`None`を返します。
+        """
+        try:
+            with open(os.path.join(directory, ChunkManifest.FILENAME)) as f:
+                return ChunkManifest(ChunkManifestEntry.from_dict(d) for d in json.load(f))
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def build(directory: str) -> 'ChunkManifest':
+        """
+        ディレクトリのSQLiteデータベースファイルを走査して、マニフェストを作成します。
+        """
+        return ChunkManifest(
+            ChunkManifestEntry.from_file(os.path.join(directory, filename)) for filename in _list_chunk_files(directory)
+        )
+
+    def save(self, directory: str):
+        path = os.path.join(directory, self.FILENAME)
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump([e.to_dict() for e in self._entries], f, indent=1)
+        os.replace(f'{path}.tmp', path)
+
+    def add(self, entry: ChunkManifestEntry):
+        """
+        チャンクを追加します。同じファイル名のチャンクは置き換えられます。
+        """
+        self._entries = [e for e in self._entries if e.filename != entry.filename]
+        insort(self._entries, entry)
+        self._build_keys()
+
+    def _build_keys(self):
+        """
+        `find`の二分探索に使う、チャンクのidと日時の一覧を作成します。
+        """
+        self._first_ids: List[int] = [e.first_id for e in self._entries]
+        self._last_ids: List[int] = [e.chunk.last_id for e in self._entries]
+        self._first_datetimes: List[np.datetime64] = [e.chunk.first_datetime for e in self._entries]
+        self._last_datetimes: List[np.datetime64] = [e.chunk.last_datetime for e in self._entries]
+
+    def find(self,
+             datetime_from: Optional[np.datetime64] = None,
+             datetime_until: Optional[np.datetime64] = None,
+             id_from: Optional[int] = None,
+             id_until: Optional[int] = None,
+             overlapping: bool = False) -> Sequence[ChunkManifestEntry]:
+        """
+        条件を満たすチャンクを、idの昇順に返します。
+
+        日時の条件は、list_sqlite_connectionsと同様に、チャンクの最初の日時について評価されます。
+        `overlapping`がTrueの場合は、チャンクの日時の範囲が [`datetime_from`, `datetime_until`) と重なるかについて
+        評価されます。
+        idの条件は、チャンクのidの範囲が [`id_from`, `id_until`) と重なるかについて評価されます。
+        チャンクはidと日時の両方について昇順なので、いずれも二分探索で求めます。
+        """
+        begin, end = 0, len(self._entries)
+
+        if datetime_from is not None:
+            datetimes = self._last_datetimes if overlapping else self._first_datetimes
+            begin = max(begin, bisect_left(datetimes, np.datetime64(datetime_from, 'ns')))
+        if datetime_until is not None:
+            end = min(end, bisect_left(self._first_datetimes, np.datetime64(datetime_until, 'ns')))
+
+        if id_from is not None:
+            begin = max(begin, bisect_left(self._last_ids, id_from))
+        if id_until is not None:
+            end = min(end, bisect_left(self._first_ids, id_until))
+
+        return self._entries[begin:end]
+
+
+def decode_sqlite_chunk(logger: Logger, path: str, batch_size: int = 10_000, **kwargs) -> List[ExecutionBatch]:
+    """
+    SQLiteデータベースファイルの全行を、ExecutionBatchのリストとして返します。
+
+    ParallelChainedBatchStreamのワーカープロセスで実行されるため、接続はこの関数の中で開かれます。
+    `kwargs`は、SqliteBatchStreamReaderに渡されます。
+    """
+    connection = sqlite3.Connection(path)
+    try:
+        return list(SqliteBatchStreamReader(logger, connection, batch_size=batch_size, **kwargs)._iter())
+    finally:
+        connection.close()
+
+
+def list_sqlite_connections(path: str,
+                            datetime_from: np.datetime64 = None,
+                            datetime_until: np.datetime64 = None,
+                            overlapping: bool = False) -> Iterator[sqlite3.Connection]:
     """
     SQLiteデータベース接続のイテレータを返します。
     :param path: データベースファイルが含まれるディレクトリのパス
     :param datetime_from: 指定された場合、この日時以降のデータベース接続のみ返されます
+    :param datetime_until: 指定された場合、この日時より前にはじまるデータベース接続のみ返されます
+    :param overlapping: Trueの場合、日時の範囲が [datetime_from, datetime_until) と重なるデータベース接続を返します。
+                        `datetime_from`より前にはじまり、`datetime_from`以降の約定を含むデータベースも含まれます。
+                        時間の境界で分割されたディレクトリ (SqliteExecutionWriterの`partitioning`) では、
+                        範囲に必要な区間のファイルだけが選ばれます。
     :return: SQLiteデータベース接続のイテレータ。Execution idの昇順にソートされています。
+             ThreadedSqliteStreamReaderで使えるよう、`check_same_thread=False`で作成されます。
     """
-    # When path is a file
-    if os.path.isfile(path):
-        first_dt: np.datetime64 = FileName.parse(os.path.basename(path)).first_datetime
-        if datetime_from and first_dt < datetime_from:
+    for _path in list_sqlite_paths(
+            path, datetime_from=datetime_from, datetime_until=datetime_until, overlapping=overlapping
+    ):
+        yield sqlite3.Connection(_path, check_same_thread=False)
+
+
+def list_sqlite_paths(path: str,
+                      datetime_from: np.datetime64 = None,
+                      datetime_until: np.datetime64 = None,
+                      id_from: Optional[int] = None,
+                      id_until: Optional[int] = None,
+                      overlapping: bool = False) -> Iterator[str]:
+    """
+    SQLiteデータベースファイルのパスのイテレータを返します。引数および順序は、list_sqlite_connectionsと同じです。
+
+    ディレクトリにChunkManifestがある場合、ディレクトリを走査せずにマニフェストから二分探索します。
+    `id_from`/`id_until`が指定された場合、idの範囲が [`id_from`, `id_until`) と重なるファイルのみ返されます。
+    """
+    if os.path.isdir(path):
+        manifest = ChunkManifest.load(path)
+        if manifest is not None:
+            for entry in manifest.find(datetime_from, datetime_until, id_from, id_until, overlapping=overlapping):
+                yield os.path.join(path, entry.filename)
             return
 
-        yield sqlite3.Connection(path)
+    def _matches(chunk: Chunk) -> bool:
+        if datetime_from and (chunk.last_datetime if overlapping else chunk.first_datetime) < datetime_from:
+            return False
+        if datetime_until and datetime_until <= chunk.first_datetime:
+            return False
+        if id_from is not None and chunk.last_id < id_from:
+            return False
+        if id_until is not None and id_until <= chunk.first_id:
+            return False
+        return True
+
+    # When path is a file
+    if os.path.isfile(path):
+        if _matches(FileName.parse(os.path.basename(path))):
+            yield path
         return
 
     # When path is a directory
 
     indices = dict()
-    for filename in os.listdir(path):
-        first_dt: np.datetime64 = FileName.parse(filename).first_datetime
-        if datetime_from and first_dt < datetime_from:
-            continue
-
-        e = filename.split('-', maxsplit=1)
-        first_id = int(e[0].split('_')[2])
-        indices[first_id] = '-'.join(e)
+    for filename in _list_chunk_files(path):
+        chunk = FileName.parse(filename)
+        if _matches(chunk):
+            indices[chunk.first_id] = filename
 
     for _id in sorted(indices.keys()):
         filename = indices[_id]
-        yield sqlite3.Connection(os.path.join(path, filename))
+        yield os.path.join(path, filename)
+
+
+TEMPORARY_FILENAME = 'temp.sqlite3'
+
+
+def _list_chunk_files(directory: str) -> Iterator[str]:
+    """
+    ディレクトリのSQLiteデータベースファイル名を返します。ライターの一時ファイルとマニフェストは除かれます。
+    """
+    for filename in os.listdir(directory):
+        if filename.endswith('.sqlite3') and filename != TEMPORARY_FILENAME:
+            yield filename
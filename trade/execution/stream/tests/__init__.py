@@ -1,6 +1,6 @@
 import unittest
 
-from trade.execution.stream.tests import test_chain, test_sqlite, test_s3
+from trade.execution.stream.tests import test_chain, test_sqlite, test_s3, test_realtime
 
 
 def test_suite():
@@ -8,6 +8,7 @@ def test_suite():
     suite.addTest(test_chain.test_suite())
     suite.addTest(test_sqlite.test_suite())
     suite.addTest(test_s3.test_suite())
+    suite.addTest(test_realtime.test_suite())
     return suite
 
 
@@ -1,14 +1,20 @@
 import asyncio
+import os
+import sqlite3
+import tempfile
 import unittest
-from typing import AsyncIterable, AsyncIterator
+from functools import partial
+from typing import AsyncIterable, AsyncIterator, List, Sequence
 
 import numpy as np
 
-from trade.execution.model import Execution
-from trade.execution.stream.chain import ChainedStream
+from trade.execution.model import Execution, ExecutionBatch
+from trade.execution.stream.chain import ChainedStream, ChainedBatchStream, ParallelChainedBatchStream
+from trade.execution.stream.sqlite import decode_sqlite_chunk
+from trade.execution.stream.tests.test_sqlite import e1, e2, _build_connection
 from trade.log import get_logger
 from trade.model import Symbol
-from trade.test_helper import make_execution
+from trade.test_helper import make_execution, build_batch_iterator
 
 
 class ChainedStreamTestCase(unittest.IsolatedAsyncioTestCase):
@@ -88,9 +94,101 @@ class ChainedStreamTestCase(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(e4, actual[4])
 
 
+class ChainedBatchStreamTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def test_aiter(self):
+        e = [make_execution(symbol=Symbol.FXBTCJPY, _id=_id, timestamp_forward=np.timedelta64(t, 'ns'))
+             for _id, t in [(0, 0), (1, 0), (2, 1), (3, 1), (4, 2)]]
+
+        reader = ChainedBatchStream(
+            logger=get_logger(self.test_aiter.__name__),
+            upstreams=[build_batch_iterator(e[:3], 2), build_batch_iterator(e[3:], 2)]
+        )
+
+        actual = list()
+        async for batch in reader:
+            actual.extend(batch)
+
+        self.assertEqual(e, actual)
+
+    async def test_aiter_timestamp_order_is_not_ascend(self):
+        e = [make_execution(symbol=Symbol.FXBTCJPY, _id=_id, timestamp_forward=np.timedelta64(t, 'ns'))
+             for _id, t in [(0, 0), (1, 0), (2, 1), (3, 0), (4, 1)]]
+
+        reader = ChainedBatchStream(
+            logger=get_logger(self.test_aiter_timestamp_order_is_not_ascend.__name__),
+            upstreams=[build_batch_iterator(e[:3], 2), build_batch_iterator(e[3:], 2)]
+        )
+
+        actual = list()
+
+        with self.assertRaises(ValueError):
+            async for batch in reader:
+                actual.extend(batch)
+
+        self.assertEqual(e[:3], actual)
+
+
+def _decode(executions: Sequence[Execution], batch_size: int) -> List[ExecutionBatch]:
+    return [ExecutionBatch.from_executions(symbol=Symbol.FXBTCJPY, executions=executions[n:n + batch_size])
+            for n in range(0, len(executions), batch_size)]
+
+
+class ParallelChainedBatchStreamTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def test_aiter(self):
+        e = [make_execution(symbol=Symbol.FXBTCJPY, _id=_id, timestamp_forward=np.timedelta64(_id, 'ns'))
+             for _id in range(10)]
+
+        for lookahead in (1, 2, 4):
+            with self.subTest(lookahead=lookahead):
+                reader = ParallelChainedBatchStream(
+                    logger=get_logger(self.test_aiter.__name__),
+                    tasks=[partial(_decode, e[n:n + 3], 2) for n in range(0, len(e), 3)],
+                    lookahead=lookahead
+                )
+
+                self.assertEqual(e, [execution async for batch in reader for execution in batch])
+
+    async def test_aiter_timestamp_order_is_not_ascend(self):
+        e = [make_execution(symbol=Symbol.FXBTCJPY, _id=_id, timestamp_forward=np.timedelta64(t, 'ns'))
+             for _id, t in [(0, 0), (1, 0), (2, 1), (3, 0), (4, 1)]]
+
+        reader = ParallelChainedBatchStream(
+            logger=get_logger(self.test_aiter_timestamp_order_is_not_ascend.__name__),
+            tasks=[partial(_decode, e[:3], 2), partial(_decode, e[3:], 2)],
+            lookahead=2
+        )
+
+        actual = list()
+        with self.assertRaises(ValueError):
+            async for batch in reader:
+                actual.extend(batch)
+
+        self.assertEqual(e[:3], actual)
+
+    async def test_aiter_sqlite(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'chunk.sqlite3')
+            source = _build_connection()
+            source.commit()
+            with sqlite3.connect(path) as con:
+                source.backup(con)
+
+            reader = ParallelChainedBatchStream(
+                logger=get_logger(self.test_aiter_sqlite.__name__),
+                tasks=[partial(decode_sqlite_chunk, get_logger(self.test_aiter_sqlite.__name__), path, 1)],
+            )
+            actual = [execution async for batch in reader for execution in batch]
+
+        self.assertEqual([e1, Execution.wrap(e2, synchronized_execution=e2.synchronized_execution)], actual)
+
+
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.TestLoader().loadTestsFromTestCase(ChainedStreamTestCase))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(ChainedBatchStreamTestCase))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(ParallelChainedBatchStreamTestCase))
     return suite
 
 
@@ -0,0 +1,109 @@
+import unittest
+from json import dumps
+from typing import List
+
+import numpy as np
+import sys
+import websockets
+
+from trade.execution.model import SwitchedToRealtime, Execution, encode_bitflyer_channel, ExecutionBatch
+from trade.execution.protocol import encode_control_frame, encode_batch_frame, encode_binary_record, \
+    encode_binary_frame, Encoding
+from trade.execution.stream.realtime import RealtimeWebSocketStream
+from trade.log import get_logger
+from trade.model import Symbol
+
+_EXECUTION = {
+    'id': 1128335614, 'side': 'BUY', 'price': 1072000.0, 'size': 0.01,
+    'exec_date': '2019-07-07T08:59:59.3210941Z',
+    'buy_child_order_acceptance_id': 'JRF20190707-085958-692751',
+    'sell_child_order_acceptance_id': 'JRF20190707-085958-403844',
+    'channel': 'lightning_executions_FX_BTC_JPY',
+}
+
+
+class RealtimeWebSocketStreamTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def _receive(self, frames: List[str], **kwargs) -> list:
+        async def handler(ws: websockets.WebSocketServerProtocol, path: str):
+            self.paths.append(path)
+            for frame in frames:
+                await ws.send(frame)
+
+        self.paths = list()
+        server = await websockets.serve(handler, 'localhost', 0)
+        try:
+            port = server.sockets[0].getsockname()[1]
+            stream = RealtimeWebSocketStream(
+                get_logger(self.__class__.__name__, stream=sys.stdout), uri=f'ws://localhost:{port}/',
+                symbol_resolver=encode_bitflyer_channel, execution_encoder=Execution.encode_bitflyer_response,
+                **kwargs
+            )
+            return [e async for e in stream]
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    async def test_control_frames(self):
+        control = SwitchedToRealtime(Symbol.FXBTCJPY, np.datetime64('2019-07-07T08:59:58.877569400', 'ns'))
+
+        received = await self._receive([
+            dumps(_EXECUTION),
+            repr(control),
+            dumps({'type': 'Heartbeat'}),
+            encode_control_frame(control),
+            dumps(_EXECUTION),
+        ])
+
+        self.assertEqual(4, len(received))
+        self.assertEqual([1128335614, 1128335614], [e._id for e in received[::3]])
+        self.assertEqual([control, control], received[1:3])
+
+    async def test_batch_frames(self):
+        executions = [dict(_EXECUTION, id=n) for n in range(1, 4)]
+        executions[2]['channel'] = 'lightning_executions_BTC_JPY'
+        frames = [encode_batch_frame([dumps(e) for e in executions[:2]]), encode_batch_frame([dumps(executions[2])])]
+
+        received = await self._receive(frames, batch_size=100)
+        self.assertEqual(['/?batch_size=100'], self.paths)
+        self.assertEqual([1, 2, 3], [e._id for e in received])
+        self.assertEqual([Symbol.FXBTCJPY, Symbol.FXBTCJPY, Symbol.BTCJPY], [e.symbol for e in received])
+
+        received = await self._receive(frames + [dumps(_EXECUTION)], batch_size=100, yield_batches=True)
+        self.assertEqual([2, 1, 1], [len(b) for b in received])
+        self.assertTrue(all(isinstance(b, ExecutionBatch) for b in received))
+        self.assertEqual(
+            [Execution.encode_bitflyer_response(Symbol.FXBTCJPY, e) for e in executions[:2]], list(received[0])
+        )
+
+    async def test_binary_frames(self):
+        execution = Execution.encode_bitflyer_response(Symbol.FXBTCJPY, _EXECUTION)
+        record, acceptance_ids = encode_binary_record(execution)
+        control = SwitchedToRealtime(Symbol.FXBTCJPY, np.datetime64('2019-07-07T08:59:58.877569400', 'ns'))
+
+        received = await self._receive(
+            [encode_binary_frame([record, record], [acceptance_ids, acceptance_ids]), encode_control_frame(control)],
+            encoding=Encoding.BINARY,
+        )
+        self.assertEqual(['/?encoding=binary'], self.paths)
+        self.assertEqual([execution, execution, control], received)
+
+        received = await self._receive(
+            [encode_binary_frame([record, record])], encoding=Encoding.BINARY, acceptance_ids=False, yield_batches=True,
+        )
+        self.assertEqual(['/?encoding=binary&acceptance_ids=0'], self.paths)
+        self.assertEqual([2], [len(b) for b in received])
+
+    async def test_unexpected_frame(self):
+        with self.assertRaisesRegex(ValueError, 'unexpected frame'):
+            await self._receive(['SwitchedToRealtime(symbol=__import__("os").getcwd())'])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(RealtimeWebSocketStreamTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite', verbosity=2, buffer=True)
@@ -1,15 +1,25 @@
+import asyncio
+import gc
+import hashlib
+import os
+import random
 import sys
+import tempfile
+import threading
+import time
 import unittest
+from datetime import date
 from decimal import Decimal
 from io import BytesIO
-from lzma import LZMACompressor
+from lzma import LZMACompressor, compress
 from unittest.mock import patch
 
 import numpy as np
 from botocore.response import StreamingBody
 
 from trade.execution.model import Execution
-from trade.execution.stream.s3 import _ObjectNameV1, _Attribute, S3Stream
+from trade.execution.stream.s3 import _ObjectNameV1, _Attribute, S3Stream, S3Prefetcher, S3Cache, list_s3_keys, \
+    S3BatchStream, list_s3_keys_by_day, days_of, build_s3_key_prefix
 from trade.log import get_logger
 from trade.model import Symbol, Exchange
 from trade.side import Side
@@ -18,15 +28,17 @@ from trade.side import Side
 class S3StreamTestCase(unittest.IsolatedAsyncioTestCase):
     class _MockStreamingBody(StreamingBody):
 
-        def __init__(self, raw_stream, content_length):
+        def __init__(self, raw_stream, content_length, compressed: bytes = None):
             super().__init__(raw_stream, content_length)
 
-            compressor = LZMACompressor()
-            chunk = list()
-            for b in raw_stream:
-                chunk.append(compressor.compress(b))
-            chunk.append(compressor.flush())
-            self._bytestream = BytesIO(b''.join(chunk))
+            if compressed is None:
+                compressor = LZMACompressor()
+                chunk = list()
+                for b in raw_stream:
+                    chunk.append(compressor.compress(b))
+                chunk.append(compressor.flush())
+                compressed = b''.join(chunk)
+            self._bytestream = BytesIO(compressed)
 
         def iter_chunks(self, chunk_size=1024):
             while True:
@@ -123,6 +135,371 @@ class S3StreamTestCase(unittest.IsolatedAsyncioTestCase):
             self.assertEqual(expected[1], actual[1])
 
 
+    async def test_aiter_chunk_boundaries(self):
+        lines = [
+            b'{"channel": "lightning_executions_FX_BTC_JPY", "message": ['
+            b'{"id": %d, "side": "BUY", "price": 445894, "size": 0.1'
+            b', "exec_date": "2018-12-04T09:23:12.5693268Z"'
+            b', "buy_child_order_acceptance_id": "JRF20181204-091751-414757"'
+            b', "sell_child_order_acceptance_id": "JRF20181204-092312-922802"}'
+            b']}' % _id
+            for _id in range(1, 101)
+        ]
+        # 2つの連結されたストリーム。最後の行は改行で終わらない
+        compressed = compress(b'\n'.join(lines[:50]) + b'\n') + compress(b'\n'.join(lines[50:]))
+
+        for chunk_size in (7, 256, 1024 * 1024):
+            with self.subTest(chunk_size=chunk_size), \
+                    patch('trade.execution.stream.s3.boto3.resource') as mock:
+                mock.return_value.Bucket.return_value.Object.return_value.get.return_value = dict(
+                    Body=self._MockStreamingBody(raw_stream=BytesIO(b''), content_length=0, compressed=compressed)
+                )
+
+                stream = S3Stream(
+                    logger=get_logger(self.test_aiter_chunk_boundaries.__name__, stream=sys.stdout),
+                    bucket='chart-mizunoyouki',
+                    key='FXBTCJPY_bitflyer_executionboard'
+                        '/v1/FXBTCJPY_bitflyer_executionboard-v1-2018-12-04T045319.0133528Z.log.xz',
+                    symbol=Symbol.FXBTCJPY,
+                    chunk_size=chunk_size,
+                )
+
+                self.assertEqual(list(range(1, 101)), [execution._id async for execution in stream])
+
+    async def test_aiter_truncated(self):
+        compressed = compress(b'{"channel": "lightning_board_FX_BTC_JPY", "message": {}}\n' * 100)
+
+        with patch('trade.execution.stream.s3.boto3.resource') as mock:
+            mock.return_value.Bucket.return_value.Object.return_value.get.return_value = dict(
+                Body=self._MockStreamingBody(raw_stream=BytesIO(b''), content_length=0, compressed=compressed[:-10])
+            )
+
+            stream = S3Stream(
+                logger=get_logger(self.test_aiter_truncated.__name__, stream=sys.stdout),
+                bucket='chart-mizunoyouki',
+                key='FXBTCJPY_bitflyer_executionboard'
+                    '/v1/FXBTCJPY_bitflyer_executionboard-v1-2018-12-04T045319.0133528Z.log.xz',
+                symbol=Symbol.FXBTCJPY,
+                chunk_size=16,
+            )
+
+            with self.assertRaises(EOFError):
+                async for _ in stream:
+                    pass
+
+
+def _build_log(ids: range) -> bytes:
+    return compress(b''.join(
+        b'{"channel": "lightning_executions_FX_BTC_JPY", "message": ['
+        b'{"id": %d, "side": "BUY", "price": 445894, "size": 0.1'
+        b', "exec_date": "2018-12-04T09:23:12.5693268Z"'
+        b', "buy_child_order_acceptance_id": "JRF20181204-091751-414757"'
+        b', "sell_child_order_acceptance_id": "JRF20181204-092312-922802"}'
+        b']}\n' % _id
+        for _id in ids
+    ))
+
+
+class _FakeS3:
+    """
+    boto3.resource('s3') の代わりに、辞書のオブジェクトを返すS3
+    """
+
+    def __init__(self, objects: dict, page_size: int = 1000):
+        self._objects = objects
+        self._page_size = page_size
+        self._lock = threading.Lock()
+        self.requested = list()
+        self.listed = list()
+
+    def Bucket(self, bucket):
+        return self
+
+    def Object(self, key):
+        return _FakeS3Object(self, key)
+
+    def etag(self, key: str) -> str:
+        return f'"{hashlib.md5(self._objects[key]).hexdigest()}"'
+
+    def list_objects_v2(self, Bucket, Prefix, MaxKeys, ContinuationToken='0'):
+        with self._lock:
+            self.listed.append(Prefix)
+        time.sleep(random.uniform(0, 0.005))
+
+        keys = [key for key in self._objects if key.startswith(Prefix)]
+        begin = int(ContinuationToken)
+        end = begin + min(MaxKeys, self._page_size)
+        response = dict(
+            Contents=[dict(Key=key, ETag=self.etag(key)) for key in keys[begin:end]], IsTruncated=end < len(keys)
+        )
+        if end < len(keys):
+            response['NextContinuationToken'] = str(end)
+        return response
+
+
+class _FakeS3Object:
+
+    def __init__(self, s3: _FakeS3, key: str):
+        self._s3 = s3
+        self._key = key
+
+    def get(self):
+        with self._s3._lock:
+            self._s3.requested.append(self._key)
+        # ダウンロードの終わる順序を入れ替える
+        time.sleep(random.uniform(0, 0.01))
+        binary = self._s3._objects[self._key]
+        return dict(
+            Body=StreamingBody(BytesIO(binary), len(binary)), ContentLength=len(binary), ETag=self._s3.etag(self._key)
+        )
+
+
+class S3BatchStreamTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def test_aiter(self):
+        lines = list()
+        for n in range(25):
+            messages = b', '.join(
+                b'{"id": %d, "side": "%s", "price": %d, "size": %s'
+                b', "exec_date": "2018-12-04T09:23:%02d.%sZ"'
+                b', "buy_child_order_acceptance_id": "JRF20181204-091751-%06d"'
+                b', "sell_child_order_acceptance_id": "JRF20181204-092312-%06d"}'
+                % (n * 4 + m, (b'BUY', b'SELL', b'')[m % 3], 445893 + n,
+                   (b'0.0853481', b'0.01', b'1', b'12.34567891')[m],
+                   n, (b'5693268', b'1', b'0000001', b'999999999')[m], n, m)
+                for m in range(4)
+            )
+            lines.append(b'{"channel": "lightning_executions_FX_BTC_JPY", "message": [%s]}\n' % messages)
+            lines.append(b'{"channel": "lightning_board_FX_BTC_JPY", "message": {"mid_price": 445899}}\n')
+        compressed = compress(b''.join(lines))
+
+        def _body() -> StreamingBody:
+            return StreamingBody(BytesIO(compressed), len(compressed))
+
+        logger = get_logger(self.test_aiter.__name__, stream=sys.stdout)
+        key = 'FXBTCJPY_bitflyer_executionboard' \
+              '/v1/FXBTCJPY_bitflyer_executionboard-v1-2018-12-04T045319.0133528Z.log.xz'
+        expected = [e async for e in S3Stream(logger, 'chart-mizunoyouki', key, Symbol.FXBTCJPY,
+                                              fixed_point=True, body=_body())]
+        self.assertEqual(100, len(expected))
+
+        for batch_size in (1, 7, 100, 10_000):
+            with self.subTest(batch_size=batch_size):
+                batches = [b async for b in S3BatchStream(logger, 'chart-mizunoyouki', key, Symbol.FXBTCJPY,
+                                                          batch_size=batch_size, body=_body())]
+                self.assertEqual(-(-100 // batch_size), len(batches))
+                actual = [e for b in batches for e in b.executions(fixed_point=True)]
+                self.assertEqual(expected, actual)
+                self.assertEqual([e.timestamp for e in expected], [e.timestamp for e in actual])
+                self.assertEqual([e.buy_child_order_acceptance_id for e in expected],
+                                 [e.buy_child_order_acceptance_id for e in actual])
+
+
+class S3PrefetcherTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def _read(self, prefetcher: S3Prefetcher, reserved: list) -> list:
+        ids = list()
+        try:
+            for key in prefetcher.keys:
+                async for execution in prefetcher.open(key):
+                    ids.append(execution._id)
+                    reserved.append(prefetcher._reserved)
+                    await asyncio.sleep(0)
+        finally:
+            prefetcher.close()
+        return ids
+
+    async def test_open(self):
+        objects = {f'key-{n:02}': _build_log(range(n * 10, n * 10 + 10)) for n in range(10)}
+        s3 = _FakeS3(objects)
+
+        with patch('trade.execution.stream.s3.boto3.resource', return_value=s3):
+            reserved = list()
+            prefetcher = S3Prefetcher(
+                get_logger(self.test_open.__name__, stream=sys.stdout), bucket='chart-mizunoyouki',
+                keys=sorted(objects), symbol=Symbol.FXBTCJPY, prefetch=3,
+            )
+            self.assertEqual(list(range(100)), await self._read(prefetcher, reserved))
+
+        self.assertEqual(sorted(objects), sorted(s3.requested))
+        self.assertEqual(0, reserved[-1] - len(objects['key-09']))
+        self.assertLessEqual(max(reserved), sum(len(objects[key]) for key in sorted(objects)[:4]))
+
+    async def test_open_memory_budget(self):
+        objects = {f'key-{n:02}': _build_log(range(n * 10, n * 10 + 10)) for n in range(5)}
+
+        with patch('trade.execution.stream.s3.boto3.resource', return_value=_FakeS3(objects)):
+            reserved = list()
+            prefetcher = S3Prefetcher(
+                get_logger(self.test_open_memory_budget.__name__, stream=sys.stdout), bucket='chart-mizunoyouki',
+                keys=sorted(objects), symbol=Symbol.FXBTCJPY, prefetch=3, memory_budget=1,
+            )
+            self.assertEqual(list(range(50)), await self._read(prefetcher, reserved))
+
+        # 予算を超えるため、読まれているオブジェクトの他はダウンロードされない
+        self.assertLessEqual(max(reserved), max(len(binary) for binary in objects.values()))
+
+    async def test_open_skipped_keys(self):
+        objects = {f'key-{n:02}': _build_log(range(n * 10, n * 10 + 10)) for n in range(5)}
+        s3 = _FakeS3(objects)
+
+        with patch('trade.execution.stream.s3.boto3.resource', return_value=s3):
+            prefetcher = S3Prefetcher(
+                get_logger(self.test_open_skipped_keys.__name__, stream=sys.stdout), bucket='chart-mizunoyouki',
+                keys=sorted(objects), symbol=Symbol.FXBTCJPY, prefetch=1,
+            )
+            try:
+                self.assertEqual(
+                    list(range(30, 40)), [execution._id async for execution in prefetcher.open('key-03')]
+                )
+            finally:
+                prefetcher.close()
+
+        # 開かれたキーより前のオブジェクトはダウンロードしない
+        self.assertEqual(['key-03', 'key-04'], sorted(s3.requested))
+
+
+class S3CacheTestCase(unittest.IsolatedAsyncioTestCase):
+
+    @staticmethod
+    def _read(cache: S3Cache, key: str) -> bytes:
+        body = cache.open('chart-mizunoyouki', key)['Body']
+        try:
+            return body.read()
+        finally:
+            body.close()
+
+    def test_open(self):
+        objects = {'key-00': _build_log(range(10))}
+        s3 = _FakeS3(objects)
+
+        with tempfile.TemporaryDirectory() as tempdir, \
+                patch('trade.execution.stream.s3.boto3.resource', return_value=s3):
+            cache = S3Cache(get_logger(self.test_open.__name__, stream=sys.stdout), directory=tempdir)
+            for _ in range(2):
+                self.assertEqual(objects['key-00'], self._read(cache, 'key-00'))
+            self.assertEqual(['key-00'], s3.requested)
+
+            # ETagが変わるまではS3にアクセスしない
+            cache = S3Cache(get_logger(self.test_open.__name__, stream=sys.stdout), directory=tempdir)
+            self.assertEqual(objects['key-00'], self._read(cache, 'key-00'))
+            self.assertEqual(['key-00'], s3.requested)
+
+            objects['key-00'] = _build_log(range(20))
+            cache.update_etags('chart-mizunoyouki', {'key-00': s3.etag('key-00')})
+            self.assertEqual(objects['key-00'], self._read(cache, 'key-00'))
+            self.assertEqual(['key-00', 'key-00'], s3.requested)
+
+    def test_open_saves_index_on_change(self):
+        objects = {f'key-{n:02}': _build_log(range(n * 10, n * 10 + 10)) for n in range(3)}
+        s3 = _FakeS3(objects)
+
+        with tempfile.TemporaryDirectory() as tempdir, \
+                patch('trade.execution.stream.s3.boto3.resource', return_value=s3):
+            cache = S3Cache(get_logger(self.test_open_saves_index_on_change.__name__, stream=sys.stdout),
+                            directory=tempdir)
+            for key in ('key-00', 'key-01'):
+                self._read(cache, key)
+            self.assertEqual(len(objects['key-00']) + len(objects['key-01']), cache.size)
+
+            # キャッシュにあったオブジェクトを開いても、インデックスは保存しない
+            with patch.object(cache, '_save', wraps=cache._save) as save:
+                self._read(cache, 'key-00')
+                self.assertFalse(save.called)
+                cache.close()
+                self.assertEqual(1, save.call_count)
+
+            # 使用順の変更はcloseで保存されているため、key-01 が最も長く使われていない
+            cache = S3Cache(get_logger(self.test_open_saves_index_on_change.__name__, stream=sys.stdout),
+                            directory=tempdir, max_size=len(objects['key-00']) + len(objects['key-02']))
+            self._read(cache, 'key-02')
+            self.assertEqual(['key-00', 'key-02'], cache.list_keys('chart-mizunoyouki', 'key-'))
+            self.assertEqual(len(objects['key-00']) + len(objects['key-02']), cache.size)
+
+    def test_open_evict(self):
+        objects = {f'key-{n:02}': _build_log(range(n * 10, n * 10 + 10)) for n in range(3)}
+        s3 = _FakeS3(objects)
+
+        with tempfile.TemporaryDirectory() as tempdir, \
+                patch('trade.execution.stream.s3.boto3.resource', return_value=s3):
+            cache = S3Cache(get_logger(self.test_open_evict.__name__, stream=sys.stdout), directory=tempdir,
+                            max_size=len(objects['key-00']) + len(objects['key-01']))
+            for key in ('key-00', 'key-01', 'key-00', 'key-02', 'key-00'):
+                self._read(cache, key)
+
+            # key-01 が最も長く使われていない
+            self.assertEqual(['key-00', 'key-01', 'key-02'], s3.requested)
+            self.assertEqual(['key-00', 'key-02'], cache.list_keys('chart-mizunoyouki', 'key-'))
+            self.assertEqual(3, len(os.listdir(tempdir)))  # 2つのオブジェクトとインデックス
+            self.assertLessEqual(cache.size, len(objects['key-00']) + len(objects['key-01']))
+
+    async def test_offline(self):
+        objects = {f'key-{n:02}': _build_log(range(n * 10, n * 10 + 10)) for n in range(3)}
+        s3 = _FakeS3(objects)
+        logger = get_logger(self.test_offline.__name__, stream=sys.stdout)
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            with patch('trade.execution.stream.s3.boto3.resource', return_value=s3), \
+                    patch('trade.execution.stream.s3.boto3.client', return_value=s3):
+                cache = S3Cache(logger, directory=tempdir)
+                for key in list_s3_keys(logger, 'chart-mizunoyouki', 'key-', np.datetime64('NaT'), cache=cache):
+                    if key != 'key-02':
+                        [_ async for _ in S3Stream(logger, 'chart-mizunoyouki', key, Symbol.FXBTCJPY, cache=cache)]
+
+            with patch('trade.execution.stream.s3.boto3') as mock:
+                cache = S3Cache(logger, directory=tempdir, offline=True)
+                keys = list(list_s3_keys(logger, 'chart-mizunoyouki', 'key-', np.datetime64('NaT'), cache=cache))
+                self.assertEqual(['key-00', 'key-01'], keys)
+                self.assertEqual(
+                    list(range(20)),
+                    [execution._id for key in keys
+                     async for execution in S3Stream(logger, 'chart-mizunoyouki', key, Symbol.FXBTCJPY, cache=cache)]
+                )
+                with self.assertRaises(FileNotFoundError):
+                    cache.open('chart-mizunoyouki', 'key-02')
+                with patch('sys.unraisablehook') as unraisablehook:
+                    with self.assertRaises(FileNotFoundError):
+                        S3Stream(logger, 'chart-mizunoyouki', 'key-02', Symbol.FXBTCJPY, cache=cache)
+                    gc.collect()
+                    # 初期化に失敗したストリームの__del__は、例外を送出しません
+                    self.assertFalse(unraisablehook.called)
+                self.assertEqual([], mock.method_calls)
+
+
+class ListS3KeysByDayTestCase(unittest.TestCase):
+
+    def test_list_s3_keys_by_day(self):
+        logger = get_logger(self.test_list_s3_keys_by_day.__name__, stream=sys.stdout)
+        prefix = build_s3_key_prefix(logger, Symbol.FXBTCJPY, Exchange.bitFlyer, 'executionboard', 1)
+        # 5日毎に、一日分のオブジェクトが無い
+        keys = [f'{prefix}2018-12-{day:02}T{hour:02}5319.0133528Z.log.xz'
+                for day in range(1, 32) if day % 5 for hour in range(0, 24, 3)]
+        s3 = _FakeS3({key: b'' for key in reversed(keys)}, page_size=3)
+
+        with patch('trade.execution.stream.s3.boto3.client', return_value=s3):
+            for datetime_from in (np.datetime64('NaT'), np.datetime64('2018-12-06T01:00:00', 'ns'),
+                                  np.datetime64('2018-12-20T22:00:00', 'ns'), np.datetime64('2019-01-01', 'ns')):
+                with self.subTest(datetime_from=datetime_from):
+                    expected = list(list_s3_keys(
+                        logger, 'chart-mizunoyouki', s3_key_prefix=f'{prefix}2018-12', datetime_from=datetime_from
+                    ))
+                    actual = list(list_s3_keys_by_day(
+                        logger, 'chart-mizunoyouki', Symbol.FXBTCJPY, Exchange.bitFlyer, 'executionboard', 1,
+                        days=days_of(2018, 12), datetime_from=datetime_from, concurrency=4,
+                    ))
+                    self.assertEqual(expected, actual)
+
+                    if np.isnat(datetime_from):
+                        self.assertEqual(keys, actual)
+
+            self.assertIn(f'{prefix}2018-12-31', s3.listed)
+
+    def test_days_of(self):
+        self.assertEqual(29, len(days_of(2020, 2)))
+        self.assertEqual(366, len(days_of(2020)))
+        self.assertEqual([date(2020, 1, 1), date(2020, 1, 2)], days_of(2020)[:2])
+
+
 class ObjectNameV1TestCase(unittest.TestCase):
 
     def test_parse(self):
@@ -139,6 +516,10 @@ class ObjectNameV1TestCase(unittest.TestCase):
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.TestLoader().loadTestsFromTestCase(S3StreamTestCase))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(S3BatchStreamTestCase))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(S3PrefetcherTestCase))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(S3CacheTestCase))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(ListS3KeysByDayTestCase))
     suite.addTest(unittest.TestLoader().loadTestsFromTestCase(ObjectNameV1TestCase))
     return suite
 
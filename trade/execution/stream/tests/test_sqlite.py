@@ -1,13 +1,17 @@
 import sqlite3
+import threading
 import unittest
 from decimal import Decimal
 
 import numpy as np
 
 from trade.execution.model import Execution, SynchronizedExecution
-from trade.execution.stream.sqlite import SqliteStreamReader, FileName
+from trade.execution.stream.sqlite import SqliteStreamReader, FileName, SqliteBatchStreamReader, Projection, \
+    ThreadedSqliteStreamReader, ChunkManifest, ChunkManifestEntry, SchemaVersion
+from trade.execution import Chunk
+from trade.executionwriter.sqlite import convert_to_schema_v2
 from trade.log import get_logger
-from trade.model import Symbol
+from trade.model import Symbol, Precision, Exchange
 from trade.side import Side
 
 e1 = Execution(symbol=Symbol.FXBTCJPY, _id=1, timestamp=np.datetime64('2019-07-07T08:59:58.877569400'),
@@ -32,56 +36,67 @@ e2 = Execution(symbol=Symbol.FXBTCJPY, _id=2, timestamp=np.datetime64('2019-07-0
                )
 
 
+def _build_connection() -> sqlite3.Connection:
+    con = sqlite3.connect(':memory:', check_same_thread=False)
+    cur = con.cursor()
+    cur.execute('CREATE TABLE executions ('
+                'symbol TEXT NOT NULL, '
+                'id INTEGER NOT NULL, '
+                'timestamp TIMESTAMP NOT NULL, '
+                'side TEXT, '
+                'price INTEGER NOT NULL, '
+                'size REAL, '
+                'buy_child_order_acceptance_id TEXT, '
+                'sell_child_order_acceptance_id TEXT, '
+                'synchronized_execution_price_deviation REAL, '
+                'synchronized_execution_time_delta INTEGER, '
+                'synchronized_symbol TEXT, '
+                'synchronized_id INTEGER, '
+                'synchronized_timestamp TIMESTAMP, '
+                'synchronized_side TEXT, '
+                'synchronized_price INTEGER, '
+                'synchronized_size REAL, '
+                'synchronized_buy_child_order_acceptance_id TEXT, '
+                'synchronized_sell_child_order_acceptance_id TEXT)')
+    cur.execute(
+        'INSERT INTO executions ('
+        'symbol, id, timestamp, side, price, size, buy_child_order_acceptance_id,  sell_child_order_acceptance_id'
+        ') VALUES ('
+        '"FXBTCJPY", 1, "2019-07-07T08:59:58.8775694", "BUY", 100, 0.01, '
+        '"JRF20190707-085958-692751", "JRF20190707-085958-403844")')
+    cur.execute(
+        'INSERT INTO executions ('
+        'symbol, id, timestamp, side, price, size, buy_child_order_acceptance_id,  sell_child_order_acceptance_id, '
+        'synchronized_execution_price_deviation, '
+        'synchronized_execution_time_delta, '
+        'synchronized_symbol, '
+        'synchronized_id, '
+        'synchronized_timestamp, '
+        'synchronized_side, '
+        'synchronized_price, '
+        'synchronized_size, '
+        'synchronized_buy_child_order_acceptance_id, '
+        'synchronized_sell_child_order_acceptance_id'
+        ') VALUES ('
+        '"FXBTCJPY", 2, "2019-07-07T08:59:59.8775694", "SELL", 10, 1.23, '
+        '"JRF20190707-085958-692752", "JRF20190707-085958-403845", '
+        '0.11111111111111112, -1000000001, '
+        '"BTCJPY", 3, "2019-07-07T09:00:00.877569401", "SELL", 9, 1.1, '
+        '"JRF20190707-085958-692753", "JRF20190707-085958-403846")'
+    )
+    return con
+
+
+def _build_connection_v2() -> sqlite3.Connection:
+    con = sqlite3.connect(':memory:', check_same_thread=False)
+    convert_to_schema_v2(_build_connection(), con)
+    return con
+
+
 class SqliteStreamTestCase(unittest.IsolatedAsyncioTestCase):
 
     async def test_aiter(self):
-        con = sqlite3.connect(':memory:')
-        cur = con.cursor()
-        cur.execute('CREATE TABLE executions ('
-                    'symbol TEXT NOT NULL, '
-                    'id INTEGER NOT NULL, '
-                    'timestamp TIMESTAMP NOT NULL, '
-                    'side TEXT, '
-                    'price INTEGER NOT NULL, '
-                    'size REAL, '
-                    'buy_child_order_acceptance_id TEXT, '
-                    'sell_child_order_acceptance_id TEXT, '
-                    'synchronized_execution_price_deviation REAL, '
-                    'synchronized_execution_time_delta INTEGER, '
-                    'synchronized_symbol TEXT, '
-                    'synchronized_id INTEGER, '
-                    'synchronized_timestamp TIMESTAMP, '
-                    'synchronized_side TEXT, '
-                    'synchronized_price INTEGER, '
-                    'synchronized_size REAL, '
-                    'synchronized_buy_child_order_acceptance_id TEXT, '
-                    'synchronized_sell_child_order_acceptance_id TEXT)')
-        cur.execute(
-            'INSERT INTO executions ('
-            'symbol, id, timestamp, side, price, size, buy_child_order_acceptance_id,  sell_child_order_acceptance_id'
-            ') VALUES ('
-            '"FXBTCJPY", 1, "2019-07-07T08:59:58.8775694", "BUY", 100, 0.01, '
-            '"JRF20190707-085958-692751", "JRF20190707-085958-403844")')
-        cur.execute(
-            'INSERT INTO executions ('
-            'symbol, id, timestamp, side, price, size, buy_child_order_acceptance_id,  sell_child_order_acceptance_id, '
-            'synchronized_execution_price_deviation, '
-            'synchronized_execution_time_delta, '
-            'synchronized_symbol, '
-            'synchronized_id, '
-            'synchronized_timestamp, '
-            'synchronized_side, '
-            'synchronized_price, '
-            'synchronized_size, '
-            'synchronized_buy_child_order_acceptance_id, '
-            'synchronized_sell_child_order_acceptance_id'
-            ') VALUES ('
-            '"FXBTCJPY", 2, "2019-07-07T08:59:59.8775694", "SELL", 10, 1.23, '
-            '"JRF20190707-085958-692752", "JRF20190707-085958-403845", '
-            '0.11111111111111112, -1000000001, '
-            '"BTCJPY", 3, "2019-07-07T09:00:00.877569401", "SELL", 9, 1.1, '
-            '"JRF20190707-085958-692753", "JRF20190707-085958-403846")'
-        )
+        con = _build_connection()
 
         actual = list()
         reader = SqliteStreamReader(
@@ -95,6 +110,243 @@ class SqliteStreamTestCase(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(e1, actual[0])
         self.assertEqual(e2, actual[1])
 
+    async def test_aiter_fixed_point(self):
+        reader = SqliteStreamReader(
+            logger=get_logger(self.__class__.__name__),
+            connection=_build_connection(),
+            fixed_point=True
+        )
+        actual = [execution async for execution in reader]
+
+        self.assertEqual([100, 10], [e.price for e in actual])
+        self.assertEqual([1_000_000, 123_000_000], [e.size for e in actual])
+        self.assertEqual(9, actual[1].synchronized_execution.price)
+        self.assertEqual(110_000_000, actual[1].synchronized_execution.size)
+        self.assertEqual(e2.synchronized_execution_price_deviation, actual[1].synchronized_execution_price_deviation)
+
+        precision = Precision.of(Symbol.FXBTCJPY)
+        self.assertEqual([e1.size, e2.size], [precision.decimal_size(e.size) for e in actual])
+
+
+    async def test_aiter_projection_core(self):
+        reader = SqliteStreamReader(
+            logger=get_logger(self.__class__.__name__),
+            connection=_build_connection(),
+            projection=Projection.CORE
+        )
+        actual = [execution async for execution in reader]
+
+        self.assertEqual(2, len(actual))
+        for expected, execution in zip([e1, e2], actual):
+            self.assertEqual(
+                (expected.symbol, expected._id, expected.timestamp, expected.side, expected.price, expected.size),
+                (execution.symbol, execution._id, execution.timestamp, execution.side, execution.price, execution.size)
+            )
+            self.assertIsNone(execution.buy_child_order_acceptance_id)
+            self.assertIsNone(execution.synchronized_execution)
+            self.assertIsNone(execution.synchronized_execution_price_deviation)
+
+    async def test_aiter_range(self):
+        for kwargs, expected in [
+            (dict(datetime_from=np.datetime64('2019-07-07T08:59:59')), [e2]),
+            (dict(datetime_from=np.datetime64('2019-07-07T08:59:59.877569400')), [e2]),
+            (dict(datetime_until=np.datetime64('2019-07-07T08:59:59.877569400')), [e1]),
+            (dict(datetime_from=np.datetime64('2019-07-07T09:00:00')), []),
+            (dict(id_from=2), [e2]),
+            (dict(id_until=2), [e1]),
+            (dict(id_from=1, datetime_until=np.datetime64('2019-07-07T09:00:00')), [e1, e2]),
+        ]:
+            with self.subTest(**kwargs):
+                reader = SqliteStreamReader(
+                    logger=get_logger(self.__class__.__name__),
+                    connection=_build_connection(),
+                    **kwargs
+                )
+                self.assertEqual(expected, [execution async for execution in reader])
+
+    async def test_aiter_range_trailing_z(self):
+        con = _build_connection()
+        for _id, timestamp in [(4, '2019-07-07T09:00:00Z'), (5, '2019-07-07T09:00:00.1Z'),
+                               (6, '2019-07-07T09:00:00.123Z')]:
+            con.execute('INSERT INTO executions (symbol, id, timestamp, side, price, size) '
+                        'VALUES ("FXBTCJPY", ?, ?, "BUY", 100, 0.01)', (_id, timestamp))
+
+        for kwargs, expected in [
+            (dict(datetime_from=np.datetime64('2019-07-07T09:00:00.5')), []),
+            (dict(datetime_from=np.datetime64('2019-07-07T09:00:00.12')), [6]),
+            (dict(datetime_from=np.datetime64('2019-07-07T09:00:00')), [4, 5, 6]),
+            (dict(datetime_until=np.datetime64('2019-07-07T09:00:00.5')), [1, 2, 4, 5, 6]),
+            (dict(datetime_until=np.datetime64('2019-07-07T09:00:00.1')), [1, 2, 4]),
+            (dict(datetime_from=np.datetime64('2019-07-07T08:59:59.8775694'),
+                  datetime_until=np.datetime64('2019-07-07T09:00:00.123')), [2, 4, 5]),
+        ]:
+            with self.subTest(**kwargs):
+                reader = SqliteStreamReader(
+                    logger=get_logger(self.__class__.__name__),
+                    connection=con,
+                    projection=Projection.CORE,
+                    **kwargs
+                )
+                self.assertEqual(expected, [execution._id async for execution in reader])
+
+
+class ThreadedSqliteStreamTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def test_aiter(self):
+        for prefetch, chunk_size in [(1, 1), (1, 2), (2, 1), (4, 1_000)]:
+            with self.subTest(prefetch=prefetch, chunk_size=chunk_size):
+                reader = ThreadedSqliteStreamReader(
+                    logger=get_logger(self.__class__.__name__),
+                    connection=_build_connection(),
+                    prefetch=prefetch,
+                    chunk_size=chunk_size,
+                )
+                self.assertEqual([e1, e2], [execution async for execution in reader])
+
+    async def test_aiter_options(self):
+        reader = ThreadedSqliteStreamReader(
+            logger=get_logger(self.__class__.__name__),
+            connection=_build_connection(),
+            chunk_size=1,
+            id_from=2,
+            fixed_point=True,
+        )
+        self.assertEqual([10], [execution.price async for execution in reader])
+
+    async def test_aiter_break(self):
+        reader = ThreadedSqliteStreamReader(
+            logger=get_logger(self.__class__.__name__),
+            connection=_build_connection(),
+            prefetch=1,
+            chunk_size=1,
+        )
+        iterator = reader.__aiter__()
+        self.assertEqual(e1, await iterator.__anext__())
+        await iterator.aclose()
+        self.assertFalse([t for t in threading.enumerate() if t.name == ThreadedSqliteStreamReader.__name__])
+
+    async def test_aiter_error(self):
+        con = _build_connection()
+        con.execute('DROP TABLE executions')
+        reader = ThreadedSqliteStreamReader(logger=get_logger(self.__class__.__name__), connection=con)
+
+        with self.assertRaises(sqlite3.OperationalError):
+            async for _ in reader:
+                pass
+
+
+class SqliteBatchStreamTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def test_aiter(self):
+        for batch_size in (1, 2, 3):
+            with self.subTest(batch_size=batch_size):
+                reader = SqliteBatchStreamReader(
+                    logger=get_logger(self.__class__.__name__),
+                    connection=_build_connection(),
+                    batch_size=batch_size,
+                )
+
+                batches = [batch async for batch in reader]
+                self.assertEqual(-(-2 // batch_size), len(batches))
+
+                actual = [execution for batch in batches for execution in batch]
+                self.assertEqual(2, len(actual))
+                self.assertEqual(e1, actual[0])
+                self.assertEqual(
+                    Execution.wrap(e2, synchronized_execution=e2.synchronized_execution), actual[1]
+                )
+
+    async def test_aiter_range(self):
+        reader = SqliteBatchStreamReader(
+            logger=get_logger(self.__class__.__name__),
+            connection=_build_connection(),
+            datetime_from=np.datetime64('2019-07-07T08:59:59'),
+        )
+        self.assertEqual([2], [_id for batch in [batch async for batch in reader] for _id in batch.ids.tolist()])
+
+    async def test_aiter_projection_core(self):
+        reader = SqliteBatchStreamReader(
+            logger=get_logger(self.__class__.__name__),
+            connection=_build_connection(),
+            projection=Projection.CORE,
+        )
+        batches = [batch async for batch in reader]
+
+        self.assertEqual(1, len(batches))
+        self.assertIsNone(batches[0].synchronized)
+        self.assertIsNone(batches[0].buy_child_order_acceptance_ids)
+        self.assertEqual(
+            [(e.symbol, e._id, e.timestamp, e.price, e.size) for e in [e1, e2]],
+            [(e.symbol, e._id, e.timestamp, e.price, e.size) for e in batches[0]]
+        )
+
+
+class SchemaV2TestCase(unittest.IsolatedAsyncioTestCase):
+
+    def test_detect(self):
+        self.assertIs(SchemaVersion.V1, SchemaVersion.detect(_build_connection()))
+        self.assertIs(SchemaVersion.V2, SchemaVersion.detect(_build_connection_v2()))
+
+    def test_convert_duplicate(self):
+        source = _build_connection()
+        source.execute('INSERT INTO executions (symbol, id, timestamp, side, price, size) '
+                       'VALUES ("FXBTCJPY", 2, "2019-07-07T08:59:59.8775694Z", "BUY", 11, 0.01)')
+        destination = sqlite3.connect(':memory:')
+
+        self.assertEqual(1, convert_to_schema_v2(source, destination))
+        self.assertEqual([(1,), (2,)], destination.execute('SELECT id FROM executions ORDER BY id').fetchall())
+        self.assertEqual(0, convert_to_schema_v2(_build_connection(), sqlite3.connect(':memory:')))
+
+    def test_convert(self):
+        self.assertEqual(
+            [
+                ('FXBTCJPY', 1, 1562489998877569400, 1, 100, 0.01),
+                ('FXBTCJPY', 2, 1562489999877569400, -1, 10, 1.23),
+            ],
+            _build_connection_v2().execute('SELECT symbol, id, timestamp, side, price, size FROM executions').fetchall()
+        )
+        self.assertEqual(
+            (1562490000877569401, -1),
+            _build_connection_v2().execute('SELECT synchronized_timestamp, synchronized_side FROM executions '
+                                           'WHERE id = 2').fetchone()
+        )
+
+    async def test_aiter(self):
+        for kwargs in [dict(), dict(fixed_point=True), dict(projection=Projection.CORE), dict(id_from=2)]:
+            with self.subTest(**kwargs):
+                self.assertEqual(
+                    [e async for e in SqliteStreamReader(get_logger(self.__class__.__name__), _build_connection(),
+                                                         **kwargs)],
+                    [e async for e in SqliteStreamReader(get_logger(self.__class__.__name__), _build_connection_v2(),
+                                                         **kwargs)]
+                )
+
+        reader = ThreadedSqliteStreamReader(get_logger(self.__class__.__name__), _build_connection_v2(), chunk_size=1)
+        self.assertEqual([e1, e2], [execution async for execution in reader])
+
+    async def test_aiter_range(self):
+        for kwargs, expected in [
+            (dict(datetime_from=np.datetime64('2019-07-07T08:59:59')), [e2]),
+            (dict(datetime_from=np.datetime64('2019-07-07T08:59:59.877569400')), [e2]),
+            (dict(datetime_until=np.datetime64('2019-07-07T08:59:59.877569400')), [e1]),
+            (dict(datetime_from=np.datetime64('2019-07-07T09:00:00')), []),
+        ]:
+            with self.subTest(**kwargs):
+                reader = SqliteStreamReader(get_logger(self.__class__.__name__), _build_connection_v2(), **kwargs)
+                self.assertEqual(expected, [execution async for execution in reader])
+
+    async def test_aiter_batch(self):
+        for kwargs in [
+            dict(), dict(projection=Projection.CORE), dict(datetime_from=np.datetime64('2019-07-07T08:59:59'))
+        ]:
+            with self.subTest(**kwargs):
+                self.assertEqual(
+                    [e for b in SqliteBatchStreamReader(get_logger(__name__), _build_connection(), **kwargs)._iter()
+                     for e in b],
+                    [e for b in SqliteBatchStreamReader(get_logger(__name__), _build_connection_v2(), **kwargs)._iter()
+                     for e in b]
+                )
+
 
 class FileNameTestCase(unittest.TestCase):
 
@@ -103,10 +355,56 @@ class FileNameTestCase(unittest.TestCase):
         self.assertEqual('2019-07-07T10:02:59.385583600', FileName.decode_safe_filename(safe_datetime_string))
 
 
+class ChunkManifestTestCase(unittest.TestCase):
+
+    def setUp(self):
+        def _entry(first_id: int, last_id: int) -> ChunkManifestEntry:
+            origin = np.datetime64('2019-07-07T00:00', 'ns')
+            chunk = Chunk(exchange=Exchange.bitFlyer, symbol=Symbol.FXBTCJPY,
+                          first_id=first_id, first_datetime=origin + np.timedelta64(first_id, 'm'),
+                          last_id=last_id, last_datetime=origin + np.timedelta64(last_id, 'm'))
+            return ChunkManifestEntry(first_id=first_id, filename=FileName.unparse(chunk), chunk=chunk, rows=10, size=0)
+
+        self._manifest = ChunkManifest([_entry(20, 29), _entry(0, 9), _entry(10, 19)])
+
+    def _find(self, **kwargs):
+        return [e.first_id for e in self._manifest.find(**kwargs)]
+
+    def test_find(self):
+        self.assertEqual([0, 10, 20], self._find())
+        self.assertEqual([10, 20], self._find(datetime_from=np.datetime64('2019-07-07T00:10')))
+        self.assertEqual([20], self._find(datetime_from=np.datetime64('2019-07-07T00:11')))
+        self.assertEqual([0], self._find(datetime_until=np.datetime64('2019-07-07T00:10')))
+        self.assertEqual([10, 20], self._find(id_from=19))
+        self.assertEqual([20], self._find(id_from=20))
+        self.assertEqual([0, 10], self._find(id_until=20))
+        self.assertEqual([10], self._find(id_from=15, id_until=16))
+        self.assertEqual([], self._find(id_from=30))
+
+    def test_find_overlapping(self):
+        self.assertEqual([10, 20], self._find(datetime_from=np.datetime64('2019-07-07T00:15'), overlapping=True))
+        self.assertEqual([0, 10], self._find(datetime_from=np.datetime64('2019-07-07T00:09'),
+                                             datetime_until=np.datetime64('2019-07-07T00:11'), overlapping=True))
+        self.assertEqual([], self._find(datetime_from=np.datetime64('2019-07-07T00:30'), overlapping=True))
+
+    def test_add(self):
+        entry = self._manifest.entries[1]
+        self._manifest.add(entry)
+        self.assertEqual([0, 10, 20], self._find())
+
+    def test_dict(self):
+        for entry in self._manifest.entries:
+            self.assertEqual(entry.to_dict(), ChunkManifestEntry.from_dict(entry.to_dict()).to_dict())
+
+
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.TestLoader().loadTestsFromTestCase(SqliteStreamTestCase))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(ThreadedSqliteStreamTestCase))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(SqliteBatchStreamTestCase))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(SchemaV2TestCase))
     suite.addTest(unittest.TestLoader().loadTestsFromTestCase(FileNameTestCase))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(ChunkManifestTestCase))
     return suite
 
 
@@ -1,11 +1,13 @@
 import unittest
 
-from trade.execution.tests import test_queue
+from trade.execution.tests import test_queue, test_model, test_protocol
 
 
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(test_queue.test_suite())
+    suite.addTest(test_model.test_suite())
+    suite.addTest(test_protocol.test_suite())
     return suite
 
 
@@ -0,0 +1,222 @@
+import unittest
+from decimal import Decimal
+
+import numpy as np
+
+from trade.execution.model import Execution, SynchronizedExecution, ExecutionBatch
+from trade.model import Symbol, Precision, to_fixed_point, from_fixed_point
+from trade.side import Side
+from trade.test_helper import make_execution, make_execution_s
+
+
+class ExecutionTestCase(unittest.TestCase):
+
+    def test_slots(self):
+        e = make_execution(symbol=Symbol.FXBTCJPY, _id=1)
+        self.assertFalse(hasattr(e, '__dict__'))
+
+        with self.assertRaises(AttributeError):
+            e.unknown_attribute = 1
+
+    def test_attrs_allocated_lazily(self):
+        e = make_execution(symbol=Symbol.FXBTCJPY, _id=1)
+        self.assertIsNone(e._attrs)
+        self.assertEqual(e, make_execution(symbol=Symbol.FXBTCJPY, _id=1))
+        self.assertIsNone(e._attrs)
+
+        e.attrs['raw_response'] = '{}'
+        self.assertEqual({'raw_response': '{}'}, e.attrs)
+        self.assertNotEqual(e, make_execution(symbol=Symbol.FXBTCJPY, _id=1))
+
+    def test_attrs(self):
+        e = Execution(symbol=Symbol.FXBTCJPY, _id=1, timestamp=np.datetime64('2019-07-07T08:59:58.877569400'),
+                      side=Side.BUY, price=Decimal('100'), size=Decimal('0.01'),
+                      buy_child_order_acceptance_id='B1', sell_child_order_acceptance_id='S1',
+                      raw_response='{}')
+        self.assertEqual({'raw_response': '{}'}, e.attrs)
+
+    def test_eq_empty_synchronized_execution(self):
+        e = make_execution(symbol=Symbol.FXBTCJPY, _id=1)
+        self.assertIsNone(e.synchronized_execution)
+
+        with_empty = make_execution(symbol=Symbol.FXBTCJPY, _id=1)
+        with_empty.synchronized_execution = SynchronizedExecution()
+        self.assertEqual(e, with_empty)
+        self.assertEqual(with_empty, e)
+
+        with_sync = make_execution(
+            symbol=Symbol.FXBTCJPY, _id=1, sync_execution=make_execution_s(symbol=Symbol.BTCJPY, _id=2)
+        )
+        self.assertNotEqual(e, with_sync)
+        self.assertNotEqual(with_sync, e)
+
+
+    def test_encode_bitflyer_response_fixed_point(self):
+        response = {
+            'id': 1, 'exec_date': '2019-07-07T08:59:58.8775694Z', 'side': 'BUY', 'price': 1234567.0, 'size': 0.0123,
+            'buy_child_order_acceptance_id': 'JRF20190707-085958-692751',
+            'sell_child_order_acceptance_id': 'JRF20190707-085958-403844',
+        }
+
+        e = Execution.encode_bitflyer_response(Symbol.FXBTCJPY, response)
+        fixed = Execution.encode_bitflyer_response(Symbol.FXBTCJPY, response, fixed_point=True)
+
+        self.assertEqual(1234567, fixed.price)
+        self.assertEqual(1_230_000, fixed.size)
+        self.assertEqual(e.price, Precision.of(Symbol.FXBTCJPY).decimal_price(fixed.price))
+        self.assertEqual(e.size, Precision.of(Symbol.FXBTCJPY).decimal_size(fixed.size))
+
+    def test_wrap_fixed_point(self):
+        e = make_execution(symbol=Symbol.FXBTCJPY, _id=1, price=Decimal('100'))
+        s = make_execution_s(symbol=Symbol.BTCJPY, _id=2, price=Decimal('90'))
+        fixed = Execution.wrap(make_execution(symbol=Symbol.FXBTCJPY, _id=1, price=100),
+                               synchronized_execution=make_execution_s(symbol=Symbol.BTCJPY, _id=2, price=90))
+
+        self.assertEqual(Execution.wrap(e, synchronized_execution=s).synchronized_execution_price_deviation,
+                         fixed.synchronized_execution_price_deviation)
+        self.assertIsInstance(fixed.synchronized_execution_price_deviation, Decimal)
+
+
+class PrecisionTestCase(unittest.TestCase):
+
+    def test_to_fixed_point(self):
+        self.assertEqual(1234567, to_fixed_point(Decimal('1234567'), 0))
+        self.assertEqual(1_230_000, to_fixed_point(Decimal('0.0123'), 8))
+        self.assertEqual(2, to_fixed_point(Decimal('0.000000019'), 8))
+        # np.rint と同じく、最近接偶数へ丸めます
+        for value in ['2.5', '3.5', '-2.5', '1.4999']:
+            with self.subTest(value=value):
+                self.assertEqual(int(np.rint(float(value))), to_fixed_point(Decimal(value), 0))
+        self.assertEqual(12_345, to_fixed_point('1234.5', 1))
+        self.assertEqual(12_345, to_fixed_point(123.45, 2))
+        self.assertEqual(500, to_fixed_point(5, 2))
+
+    def test_from_fixed_point(self):
+        self.assertEqual(Decimal('0.0123'), from_fixed_point(1_230_000, 8))
+        self.assertEqual(Decimal('1234567'), from_fixed_point(1234567, 0))
+
+    def test_decimal(self):
+        precision = Precision.of(Symbol.FXBTCJPY)
+
+        self.assertEqual(Decimal('0.01'), precision.decimal_size(1_000_000))
+        self.assertEqual(Decimal('100'), precision.decimal_price(100))
+        self.assertIs(Decimal, type(precision.decimal_price(100)))
+        self.assertEqual(Decimal('100.5'), precision.decimal_price(Decimal('100.5')))
+
+
+class SynchronizedExecutionTestCase(unittest.TestCase):
+
+    def test_slots(self):
+        self.assertFalse(hasattr(SynchronizedExecution(), '__dict__'))
+
+    def test_is_empty(self):
+        self.assertTrue(SynchronizedExecution().is_empty())
+        self.assertFalse(SynchronizedExecution(symbol=Symbol.BTCJPY).is_empty())
+        self.assertFalse(SynchronizedExecution(raw_response='{}').is_empty())
+
+    def test_eq_none(self):
+        self.assertTrue(SynchronizedExecution() == None)  # noqa: E711
+        self.assertFalse(make_execution_s(symbol=Symbol.BTCJPY, _id=2) == None)  # noqa: E711
+
+    def test_from_execution(self):
+        e = make_execution(symbol=Symbol.BTCJPY, _id=2)
+        self.assertEqual(make_execution_s(symbol=Symbol.BTCJPY, _id=2), SynchronizedExecution.from_execution(e))
+        self.assertIsNone(SynchronizedExecution.from_execution(e)._attrs)
+
+
+class ExecutionBatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self._executions = [
+            make_execution(symbol=Symbol.FXBTCJPY, _id=1, price=Decimal('100')),
+            make_execution(symbol=Symbol.FXBTCJPY, _id=2, price=Decimal('101'),
+                           timestamp_forward=np.timedelta64(1, 'ns'),
+                           sync_execution=make_execution_s(symbol=Symbol.BTCJPY, _id=3, price=Decimal('99'))),
+            make_execution(symbol=Symbol.FXBTCJPY, _id=4, price=Decimal('102'),
+                           timestamp_forward=np.timedelta64(2, 'ns')),
+        ]
+
+    def test_from_executions(self):
+        batch = ExecutionBatch.from_executions(symbol=Symbol.FXBTCJPY, executions=self._executions)
+
+        self.assertEqual(3, len(batch))
+        self.assertEqual([1, 2, 4], batch.ids.tolist())
+        self.assertEqual(np.int64, batch.timestamps.dtype)
+        self.assertEqual([1, 1, 1], batch.sides.tolist())
+        self.assertEqual([100, 101, 102], batch.prices.tolist())
+        self.assertEqual([10_000_000] * 3, batch.sizes.tolist())
+        self.assertEqual([False, True, False], batch.synchronized_mask.tolist())
+        self.assertEqual(Symbol.BTCJPY, batch.synchronized.symbol)
+
+    def test_iter(self):
+        batch = ExecutionBatch.from_executions(symbol=Symbol.FXBTCJPY, executions=self._executions)
+
+        actual = list(batch)
+        self.assertEqual(self._executions[0], actual[0])
+        self.assertEqual(
+            Execution.wrap(self._executions[1], synchronized_execution=self._executions[1].synchronized_execution),
+            actual[1]
+        )
+        self.assertEqual(self._executions[2], actual[2])
+        self.assertEqual('0.1', str(actual[0].size))
+
+    def test_executions_fixed_point(self):
+        batch = ExecutionBatch.from_executions(symbol=Symbol.FXBTCJPY, executions=self._executions)
+
+        actual = list(batch.executions(fixed_point=True))
+        self.assertEqual([100, 101, 102], [e.price for e in actual])
+        self.assertEqual([10_000_000] * 3, [e.size for e in actual])
+        self.assertEqual(99, actual[1].synchronized_execution.price)
+        self.assertEqual(list(batch)[1].synchronized_execution_price_deviation,
+                         actual[1].synchronized_execution_price_deviation)
+
+        self.assertEqual(list(batch), list(ExecutionBatch.from_executions(symbol=Symbol.FXBTCJPY, executions=actual)))
+
+        with self.assertRaises(ValueError):
+            list(ExecutionBatch.from_executions(
+                symbol=Symbol.FXBTCJPY, executions=self._executions, price_precision=2
+            ).executions(fixed_point=True))
+
+    def test_getitem(self):
+        batch = ExecutionBatch.from_executions(symbol=Symbol.FXBTCJPY, executions=self._executions)
+
+        self.assertEqual([2, 4], batch[1:].ids.tolist())
+        self.assertEqual([True, False], batch[1:].synchronized_mask.tolist())
+        self.assertEqual([4, 1], batch[np.array([2, 0])].ids.tolist())
+        self.assertEqual([1, 4], batch[np.array([True, False, True])].ids.tolist())
+
+    def test_concatenate(self):
+        head = ExecutionBatch.from_executions(symbol=Symbol.FXBTCJPY, executions=self._executions[:1])
+        tail = ExecutionBatch.from_executions(symbol=Symbol.FXBTCJPY, executions=self._executions[1:])
+
+        batch = ExecutionBatch.concatenate([head, tail])
+        self.assertEqual([1, 2, 4], batch.ids.tolist())
+        self.assertEqual([False, True, False], batch.synchronized_mask.tolist())
+        self.assertEqual(
+            list(ExecutionBatch.from_executions(symbol=Symbol.FXBTCJPY, executions=self._executions)), list(batch)
+        )
+
+    def test_concatenate_different(self):
+        head = ExecutionBatch.from_executions(symbol=Symbol.FXBTCJPY, executions=self._executions[:1])
+        for tail in [
+            ExecutionBatch.from_executions(symbol=Symbol.BTCJPY, executions=self._executions[1:]),
+            ExecutionBatch.from_executions(symbol=Symbol.FXBTCJPY, executions=self._executions[1:], price_precision=2),
+            ExecutionBatch.from_executions(symbol=Symbol.FXBTCJPY, executions=self._executions[1:], size_precision=4),
+        ]:
+            with self.subTest(symbol=tail.symbol, price_precision=tail.price_precision,
+                              size_precision=tail.size_precision):
+                with self.assertRaises(ValueError):
+                    ExecutionBatch.concatenate([head, tail])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(ExecutionTestCase))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(PrecisionTestCase))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(SynchronizedExecutionTestCase))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(ExecutionBatchTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite', verbosity=2, buffer=True)
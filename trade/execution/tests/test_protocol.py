@@ -0,0 +1,105 @@
+import unittest
+from json import loads
+
+import numpy as np
+
+from trade.execution.model import SwitchedToRealtime, Execution
+from trade.execution.protocol import encode_control_frame, is_control_message, decode_control_message, \
+    decode_legacy_control_frame, encode_batch_frame, build_client_uri, encode_binary_record, encode_binary_frame, \
+    decode_binary_frame
+from trade.model import Symbol
+
+
+class ControlFrameTestCase(unittest.TestCase):
+
+    def test_encode_decode(self):
+        control = SwitchedToRealtime(Symbol.FXBTCJPY, np.datetime64('2019-07-07T08:59:58.877569400', 'ns'))
+
+        message = loads(encode_control_frame(control))
+        self.assertEqual(
+            {'type': 'SwitchedToRealtime', 'symbol': 'FXBTCJPY', 'timestamp': '2019-07-07T08:59:58.877569400'},
+            message
+        )
+        self.assertTrue(is_control_message(message))
+        self.assertEqual(control, decode_control_message(message))
+
+    def test_encode_unsupported(self):
+        with self.assertRaises(TypeError):
+            encode_control_frame(Symbol.FXBTCJPY)
+
+    def test_decode_unknown(self):
+        self.assertIsNone(decode_control_message({'type': 'Heartbeat'}))
+        self.assertFalse(is_control_message({'id': 1, 'channel': 'lightning_executions_FX_BTC_JPY'}))
+
+    def test_decode_legacy(self):
+        control = SwitchedToRealtime(Symbol.BTCJPY, np.datetime64('2019-07-07T08:59:58.877569400', 'ns'))
+
+        self.assertEqual(control, decode_legacy_control_frame(repr(control)))
+        self.assertEqual(control, decode_legacy_control_frame(
+            'SwitchedToRealtime(symbol=Symbol.BTCJPY, '
+            'timestamp=numpy.datetime64("2019-07-07T08:59:58.877569400", "ns"))'
+        ))
+        self.assertIsNone(decode_legacy_control_frame('SwitchedToRealtime(symbol=__import__("os").getcwd())'))
+
+
+class BatchFrameTestCase(unittest.TestCase):
+
+    def test_encode_batch_frame(self):
+        self.assertEqual([{'id': 1}, {'id': 2}], loads(encode_batch_frame(['{"id": 1}', '{"id": 2}'])))
+
+    def test_build_client_uri(self):
+        self.assertEqual('ws://localhost:8765/', build_client_uri('ws://localhost:8765/', {'batch_size': None}))
+        self.assertEqual(
+            'ws://localhost:8765/?policy=conflate&batch_size=100',
+            build_client_uri('ws://localhost:8765/?policy=conflate', {'batch_size': 100})
+        )
+
+
+class BinaryFrameTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self._executions = [
+            Execution.encode_bitflyer_response(symbol, {
+                'id': _id, 'side': side, 'price': price, 'size': size, 'exec_date': '2019-07-07T08:59:59.3210941Z',
+                'buy_child_order_acceptance_id': f'JRF20190707-085958-69275{_id}',
+                'sell_child_order_acceptance_id': f'JRF20190707-085958-40384{_id}',
+            })
+            for symbol, _id, side, price, size in [
+                (Symbol.FXBTCJPY, 1, 'BUY', 1072000.0, 0.01),
+                (Symbol.FXBTCJPY, 2, 'SELL', 1071999.0, 1.23456789),
+                (Symbol.BTCJPY, 3, '', 1050000.0, 0.5),
+            ]
+        ]
+
+    def test_encode_decode(self):
+        parts = [encode_binary_record(e) for e in self._executions]
+        frame = encode_binary_frame([record for record, _ in parts], [ids for _, ids in parts])
+
+        batches = decode_binary_frame(frame)
+        self.assertEqual([Symbol.FXBTCJPY, Symbol.BTCJPY], [b.symbol for b in batches])
+        self.assertEqual(self._executions, [e for b in batches for e in b])
+
+    def test_without_acceptance_ids(self):
+        frame = encode_binary_frame([encode_binary_record(e)[0] for e in self._executions])
+        self.assertEqual(6 + 34 * 3, len(frame))
+
+        executions = [e for b in decode_binary_frame(frame) for e in b]
+        self.assertEqual([e._id for e in self._executions], [e._id for e in executions])
+        self.assertEqual([e.price for e in self._executions], [e.price for e in executions])
+        self.assertEqual([None] * 3, [e.buy_child_order_acceptance_id for e in executions])
+
+    def test_unsupported_version(self):
+        with self.assertRaisesRegex(ValueError, 'version'):
+            decode_binary_frame(b'\x02\x00\x00\x00\x00\x00')
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(ControlFrameTestCase))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(BatchFrameTestCase))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(BinaryFrameTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite', verbosity=2, buffer=True)
@@ -1,4 +1,5 @@
 import asyncio
+import random
 import unittest
 from datetime import datetime
 from decimal import Decimal
@@ -10,7 +11,7 @@ import numpy as np
 from trade.execution.model import Execution, SwitchedToRealtime
 from trade.side import Side
 from trade.model import Symbol
-from trade.execution.queue import TimeWindowExecutionQueue
+from trade.execution.queue import TimeWindowExecutionQueue, SlowConsumerPolicy, SlowConsumerError, ClientStats
 from trade.log import get_logger
 
 
@@ -329,6 +330,192 @@ class TimeWindowExecutionQueueTestCase(_QueueTestBase):
         q.dispose_queue('A')
         self.assertEqual(1, q.spawned_queue_count())
 
+    def test_shared_buffer(self):
+        q = TimeWindowExecutionQueue(
+            logger=get_logger(__name__), time_window='1days',
+            switched_to_realtime_partial=partial(SwitchedToRealtime, symbol=Symbol.FXBTCJPY), loop=self.loop)
+        q.put_nowait(self._e1)
+
+        with self.assertWarns(DeprecationWarning):
+            q.spawn_queue('A')
+        with self.assertWarns(DeprecationWarning):
+            q.spawn_queue('B')
+
+        async def queue_get(client_id, n):
+            return [await q.get(client_id) for _ in range(n)]
+
+        self.assertEqual([self._e1], self.loop.run_until_complete(queue_get('A', 1)))
+
+        # e1 は保持期間から外れるが、Bが取得するまで回収されない
+        q.put_nowait(self._e3)
+        self.assertEqual(1, q.execution_count())
+        self.assertEqual(2, len(q._buffer))
+
+        self.assertEqual([self._e1, self._e3], self.loop.run_until_complete(queue_get('B', 2)))
+        q.put_nowait(self._e3)
+        self.assertEqual(2, len(q._buffer))
+
+        q.dispose_queue('A')
+        q.dispose_queue('B')
+        q.put_nowait(self._e3)
+        self.assertEqual(3, q.execution_count())
+        self.assertEqual(3, len(q._buffer))
+
+    def test_insert_behind_cursor(self):
+        q = TimeWindowExecutionQueue(
+            logger=get_logger(__name__), time_window='3days',
+            switched_to_realtime_partial=partial(SwitchedToRealtime, symbol=Symbol.FXBTCJPY), loop=self.loop)
+        q.put_nowait(self._e1)
+        q.put_nowait(self._e3)
+
+        with self.assertWarns(DeprecationWarning):
+            q.spawn_queue('A')
+
+        async def queue_get(client_id, n):
+            return [await q.get(client_id) for _ in range(n)]
+
+        self.assertEqual([self._e1, self._e3], self.loop.run_until_complete(queue_get('A', 2)))
+
+        # Aが既に取得した e3 より古い e2 は、Aが次に取得し、新しいクライアントは時系列順に取得する
+        q.put_nowait(self._e2)
+        self.assertEqual([self._e2], self.loop.run_until_complete(queue_get('A', 1)))
+        self.assertTrue(isinstance(self.loop.run_until_complete(q.get('A')), SwitchedToRealtime))
+
+        with self.assertWarns(DeprecationWarning):
+            q.spawn_queue('B')
+        self.assertEqual([self._e1, self._e2, self._e3], self.loop.run_until_complete(queue_get('B', 3)))
+
+    def test_order_realtime_fifo(self):
+        def execution(_id: int, seconds: float) -> Execution:
+            return Execution(
+                symbol=Symbol.FXBTCJPY, _id=_id,
+                timestamp=np.datetime64('2000-01-01T00:00:00', 'ns') + np.timedelta64(int(seconds * 1000), 'ms'),
+                side=Side.BUY, price=Decimal('100'), size=Decimal('0.1'),
+                buy_child_order_acceptance_id=f'b{_id}', sell_child_order_acceptance_id=f's{_id}'
+            )
+
+        q = TimeWindowExecutionQueue(
+            logger=get_logger(__name__), time_window='60s',
+            switched_to_realtime_partial=partial(SwitchedToRealtime, symbol=Symbol.FXBTCJPY), loop=self.loop)
+        q.put_nowait(execution(1, 1))
+
+        with self.assertWarns(DeprecationWarning):
+            q.spawn_queue('A')
+
+        async def queue_get(client_id, n):
+            return [await q.get(client_id) for _ in range(n)]
+
+        self.loop.run_until_complete(queue_get('A', 1))
+        self.assertTrue(isinstance(self.loop.run_until_complete(q.get('A')), SwitchedToRealtime))
+
+        # 未取得の t6 より古い t5.5 が届いても、SwitchedToRealtimeを返した後は追加された順に取得する
+        for e in [execution(2, 5), execution(3, 6), execution(4, 5.5)]:
+            q.put_nowait(e)
+        self.assertEqual([2, 3, 4], [e._id for e in self.loop.run_until_complete(queue_get('A', 3))])
+
+        # 追加された順のバッファは、Aが取得した要素を次の追加で回収する
+        q.put_nowait(execution(5, 7))
+        self.assertEqual(1, len(q._arrivals))
+
+        # 新しいクライアントは、保持期間分を時系列順に取得する
+        with self.assertWarns(DeprecationWarning):
+            q.spawn_queue('B')
+        self.assertEqual([1, 2, 4, 3, 5], [e._id for e in self.loop.run_until_complete(queue_get('B', 5))])
+
+    def test_order_out_of_order_bursts(self):
+        q = TimeWindowExecutionQueue(
+            logger=get_logger(__name__), time_window='60s',
+            switched_to_realtime_partial=partial(SwitchedToRealtime, symbol=Symbol.FXBTCJPY), loop=self.loop)
+
+        _random = random.Random(0)
+        start = np.datetime64('2000-01-01T00:00:00', 'ns')
+        executions = list()
+        for n in range(2000):
+            # 10件毎に、最大1秒遅れたtimestampの約定が届く（同じtimestampの約定を含む）
+            delay = n % 10 == 0 and _random.randint(0, 10) * 100 or 0
+            executions.append(Execution(
+                symbol=Symbol.FXBTCJPY, _id=n, timestamp=start + np.timedelta64(n * 50 - delay, 'ms'),
+                side=Side.BUY, price=Decimal('100'), size=Decimal('0.1'),
+                buy_child_order_acceptance_id=f'b{n}', sell_child_order_acceptance_id=f's{n}'
+            ))
+        for e in executions:
+            q.put_nowait(e)
+
+        with self.assertWarns(DeprecationWarning):
+            q.spawn_queue('A')
+
+        async def queue_get():
+            return [await q.get('A') for _ in range(q.execution_count())]
+
+        results = self.loop.run_until_complete(queue_get())
+        expected = sorted(executions, key=lambda e: e.timestamp)
+        expected = [e for e in expected if expected[-1].timestamp - e.timestamp <= np.timedelta64(60, 's')]
+        self.assertEqual([e._id for e in expected], [e._id for e in results])
+
+    def test_slow_consumer_policy(self):
+        executions = [Execution(
+            symbol=Symbol.FXBTCJPY, _id=n, timestamp=np.datetime64(datetime(2000, 1, 1, 0, 0, n), 'ns', utc=True),
+            side=Side.BUY, price=Decimal(100 + n), size=Decimal('0.1'),
+            buy_child_order_acceptance_id=f'b{n}', sell_child_order_acceptance_id=f's{n}'
+        ) for n in range(12)]
+
+        for policy, expected_ids, expected_stats in [
+            (SlowConsumerPolicy.DROP_OLDEST, [9, 10, 11], ClientStats(depth=3, dropped=8, disconnected=False)),
+            # 上限を超える度に最新の約定だけを残す
+            (SlowConsumerPolicy.CONFLATE, [10, 11], ClientStats(depth=2, dropped=9, disconnected=False)),
+            (SlowConsumerPolicy.DISCONNECT, [], ClientStats(depth=0, dropped=4, disconnected=True)),
+        ]:
+            with self.subTest(policy=policy):
+                q = TimeWindowExecutionQueue(
+                    logger=get_logger(__name__), time_window='3s',
+                    switched_to_realtime_partial=partial(SwitchedToRealtime, symbol=Symbol.FXBTCJPY), loop=self.loop,
+                    max_depth=3, slow_consumer_policy=SlowConsumerPolicy.DISCONNECT)
+                q.put_nowait(executions[0])
+
+                with self.assertWarns(DeprecationWarning):
+                    q.spawn_queue('A', slow_consumer_policy=policy)
+
+                async def queue_get(n):
+                    return [await q.get('A') for _ in range(n)]
+
+                # 保持期間分の取得中は上限を適用しない
+                self.assertEqual(executions[0], self.loop.run_until_complete(queue_get(1))[0])
+                self.assertTrue(isinstance(self.loop.run_until_complete(q.get('A')), SwitchedToRealtime))
+
+                for e in executions[1:]:
+                    q.put_nowait(e)
+                self.assertEqual({'A': expected_stats}, q.client_stats())
+
+                if policy == SlowConsumerPolicy.DISCONNECT:
+                    self.assertRaises(SlowConsumerError, self.loop.run_until_complete, q.get('A'))
+                    # 切断されたクライアントは、保持期間から外れた約定の回収を妨げない
+                    self.assertEqual(4, len(q._buffer))
+                    continue
+
+                results = self.loop.run_until_complete(queue_get(len(expected_ids)))
+                self.assertEqual(expected_ids, [e._id for e in results])
+
+    def test_get_batch(self):
+        q = TimeWindowExecutionQueue(
+            logger=get_logger(__name__), time_window='3days',
+            switched_to_realtime_partial=partial(SwitchedToRealtime, symbol=Symbol.FXBTCJPY), loop=self.loop)
+        q.put_nowait(self._e1)
+        q.put_nowait(self._e2)
+        q.put_nowait(self._e3)
+
+        with self.assertWarns(DeprecationWarning):
+            q.spawn_queue('A')
+
+        self.assertEqual([self._e1, self._e2], self.loop.run_until_complete(q.get_batch('A', 2)))
+        self.assertEqual([self._e3], self.loop.run_until_complete(q.get_batch('A', 2)))
+
+        batch = self.loop.run_until_complete(q.get_batch('A', 2))
+        self.assertEqual(1, len(batch))
+        self.assertTrue(isinstance(batch[0], SwitchedToRealtime))
+
+        q.put_nowait(self._e3)
+        self.assertEqual([self._e3], self.loop.run_until_complete(q.get_batch('A', 2)))
+
     def test_blocking_get_until_time_window_satisfied(self):
         # TODO:
         pass
@@ -1,15 +1,23 @@
+import asyncio
+import json
 import os
+import shutil
 import sqlite3
+import threading
 from abc import abstractmethod
 from logging import Logger
-from typing import AsyncIterable, Iterable, Optional, List, Tuple
+from decimal import Decimal
+from typing import AsyncIterable, Iterable, Optional, List, Tuple, Union, Any, Sequence, Callable
 
 import numpy as np
 
 from trade.execution import Chunk
-from trade.execution.model import Execution
-from trade.execution.stream.sqlite import FileName
-from trade.model import Exchange, Symbol
+from trade.execution.model import Execution, SynchronizedExecution
+from trade.execution.stream.adapter.filter import FilterStream
+from trade.execution.stream.sqlite import FileName, ChunkManifest, ChunkManifestEntry, TEMPORARY_FILENAME, \
+    SchemaVersion, SIDE_CODES, encode_epoch_timestamp, list_sqlite_paths
+from trade.model import Exchange, Symbol, Precision
+from trade.side import Side
 
 
 class AbstractConnection:
@@ -19,7 +27,7 @@ class AbstractConnection:
         pass
 
     @abstractmethod
-    def close(self) -> str:
+    def close(self) -> Optional[str]:
         pass
 
 
@@ -31,53 +39,204 @@ class Connection(AbstractConnection):
             os.makedirs(self._basedir)
 
         self._exchange = exchange
-        self._temp_path = os.path.join(self._basedir, 'temp.sqlite3')
+        self._temp_path = os.path.join(self._basedir, TEMPORARY_FILENAME)
 
         self._con: Optional[sqlite3.Connection] = None
 
+    @property
+    def basedir(self) -> str:
+        return self._basedir
+
     def open_as_temporary(self) -> sqlite3.Connection:
-        self._con: Optional[sqlite3.Connection] = sqlite3.Connection(self._temp_path)
+        # ThreadedSqliteExecutionWriterは、書き出しのスレッドからこの接続を使います
+        self._con: Optional[sqlite3.Connection] = sqlite3.Connection(self._temp_path, check_same_thread=False)
         self._con.row_factory = sqlite3.Row
         return self._con
 
-    def close(self) -> str:
+    def close(self) -> Optional[str]:
+        """
+        一時ファイルを閉じ、チャンクのファイル名にリネームします。リネームしたパスを返します。
+        行が無い場合は、一時ファイルを削除してNoneを返します。
+        """
         cur = self._con.cursor()
 
-        first = cur.execute('SELECT * FROM executions WHERE id IS NOT NULL ORDER BY id LIMIT 1').fetchone()
-        last = cur.execute('SELECT * FROM executions WHERE id IS NOT NULL ORDER BY id DESC LIMIT 1').fetchone()
+        chunk, rows = _read_chunk(cur, self._exchange)
+
+        # バルクロードモードで後回しにされたインデックスを作成します
+        if chunk is not None:
+            create_indexes_if_not_exist(cur, SchemaVersion.detect(self._con))
 
         cur.close()
         self._con.commit()
         self._con.close()
 
-        chunk = Chunk(
-            exchange=self._exchange, symbol=Symbol(first['symbol']),
-            first_id=first['id'], first_datetime=np.datetime64(first['timestamp'], 'ns'),
-            last_id=last['id'], last_datetime=np.datetime64(last['timestamp'], 'ns')
-        )
+        if chunk is None:
+            if rows:
+                raise ValueError(f'no execution has id: {self._temp_path}')
+            os.remove(self._temp_path)
+            return None
+
+        # バルクロードモードではコミット時に同期されないため、リネームの前にファイルを永続化します
+        _fsync(self._temp_path)
+
         to_path = os.path.join(self._basedir, FileName.unparse(chunk))
 
         os.rename(self._temp_path, to_path)
+        _fsync(self._basedir)
+        self._update_manifest(ChunkManifestEntry(
+            first_id=chunk.first_id, filename=os.path.basename(to_path), chunk=chunk, rows=rows,
+            size=os.path.getsize(to_path)
+        ))
         return to_path
 
+    def last_committed_id(self) -> Optional[int]:
+        """
+        一時ファイルと、マニフェストに記録されたファイルにコミットされた、最大のExecution idを返します。
+        一時ファイルについては、コミットされていない行も含まれるため、書き出しの途中では呼び出さないでください。
+        """
+        ids: List[int] = list()
+
+        manifest = ChunkManifest.load(self._basedir)
+        if manifest is not None and manifest.entries:
+            ids.append(max(e.chunk.last_id for e in manifest.entries))
+
+        if self._con is not None:
+            try:
+                temporary_id, = self._con.execute('SELECT MAX(id) FROM executions').fetchone()
+            except sqlite3.OperationalError:
+                # テーブルが作成される前
+                temporary_id = None
+            if temporary_id is not None:
+                ids.append(temporary_id)
+
+        return max(ids, default=None)
+
+    def _update_manifest(self, entry: ChunkManifestEntry):
+        """
+        マニフェストにチャンクを追加します。マニフェストが無い場合は、既存のファイルを走査して作成します。
+        """
+        manifest = ChunkManifest.load(self._basedir)
+        if manifest is None:
+            manifest = ChunkManifest.build(self._basedir)
+        else:
+            manifest.add(entry)
+        manifest.save(self._basedir)
+
+
+def _read_chunk(cur: sqlite3.Cursor, exchange: Exchange) -> Tuple[Optional[Chunk], int]:
+    """
+    データベースの最初と最後のidの行からChunkを組み立て、行数と共に返します。idを持つ行が無い場合、ChunkはNoneです。
+    """
+    cur.row_factory = sqlite3.Row
+    first = cur.execute('SELECT * FROM executions WHERE id IS NOT NULL ORDER BY id LIMIT 1').fetchone()
+    last = cur.execute('SELECT * FROM executions WHERE id IS NOT NULL ORDER BY id DESC LIMIT 1').fetchone()
+    rows, = cur.execute('SELECT COUNT(*) FROM executions').fetchone()
+    if first is None:
+        return None, rows
+
+    return Chunk(
+        exchange=exchange, symbol=Symbol(first['symbol']),
+        first_id=first['id'], first_datetime=np.datetime64(first['timestamp'], 'ns'),
+        last_id=last['id'], last_datetime=np.datetime64(last['timestamp'], 'ns')
+    ), rows
+
+
+def _fsync(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class TimePartitioning:
+    """
+    チャンクを分割する時間の境界
+
+    `unit`は境界の単位 (`PERIODS`の値)、`utc_offset`は境界を決めるタイムゾーンのUTCからのずれです。
+    例えば日本時間の日毎の分割は、`TimePartitioning('D', TimePartitioning.TIMEZONES['JST'])`です。
+    """
+
+    PERIODS = {'hourly': 'h', 'daily': 'D'}
+    TIMEZONES = {'UTC': np.timedelta64(0, 'h'), 'JST': np.timedelta64(9, 'h')}
+
+    def __init__(self, unit: str = 'D', utc_offset: np.timedelta64 = np.timedelta64(0, 'h')):
+        if unit not in self.PERIODS.values():
+            raise ValueError(f'unsupported unit: {unit}')
+
+        self._unit = unit
+        self._utc_offset = utc_offset
+
+    def range(self, dt: np.datetime64) -> Tuple[np.datetime64, np.datetime64]:
+        """
+        日時を含む区間 [begin, end) を返します。
+        """
+        local = np.datetime64(dt, 'ns') + self._utc_offset
+        begin = np.datetime64(local.astype(f'datetime64[{self._unit}]'), 'ns') - self._utc_offset
+        return begin, begin + np.timedelta64(1, self._unit)
+
+
+# バルクロードモードで、チャンクの書き出し中に使うPRAGMA
+BULK_LOAD_PRAGMAS = (
+    'PRAGMA page_size = 65536',
+    'PRAGMA journal_mode = OFF',
+    'PRAGMA synchronous = OFF',
+    'PRAGMA cache_size = -262144',
+    'PRAGMA temp_store = MEMORY',
+)
+
 
 class SqliteExecutionWriter:
+    """
+    ExecutionをSQLiteデータベースへ書き出すライター
+
+    `schema_version`がV2の場合、スキーマV2 (`SchemaVersion`) で書き出します。
+    スキーマV2ではidが主キーのため、idの無いExecutionは書き出されず、重複したidの2件目以降は無視されます。
+    idの無い行はSqliteStreamReaderが読み込まない行ですが、重複したidの行はスキーマV1では全て読み込まれるため、
+    無視した行の数を警告としてログに出力します。
+
+    `bulk_load`がTrueの場合、チャンクの書き出し中はジャーナルと同期を無効にし (`BULK_LOAD_PRAGMAS`)、
+    インデックスの作成をConnection.closeまで遅らせます。Connection.closeはリネームの前にファイルを同期するため、
+    リネームされたチャンクは永続化されています。書き出し中に中断された一時ファイルは壊れている可能性があるため、
+    再開せずに削除してください。
+
+    `partitioning`が指定された場合、Executionの日時が時間の境界 (`TimePartitioning`) を越える度にもファイルを
+    分割します。分割は日時が進む方向にだけ行われ、前の区間の日時の約定は現在のファイルに含まれます。
+    `records_rotation`は、ひとつの区間のファイルの大きさの上限として働きます (`None`の場合は上限なし) 。
+    区間に揃ったファイルは、list_sqlite_connectionsの`overlapping`によって、必要な区間だけが選ばれます。
+    """
 
     def __init__(self, logger: Logger,
                  connection: AbstractConnection,
-                 records_rotation: int = 1_000_000,
-                 records_insertion: int = 100_000):
+                 records_rotation: Optional[int] = 1_000_000,
+                 records_insertion: int = 100_000,
+                 schema_version: SchemaVersion = SchemaVersion.V1,
+                 bulk_load: bool = False,
+                 partitioning: Optional[TimePartitioning] = None):
         self._logger = logger
         self._connection = connection
         self._n_records_rotation = records_rotation
         self._n_records_insertion = records_insertion
+        self._schema_version = schema_version
+        self._bulk_load = bulk_load
+        self._partitioning = partitioning
+        self._partition: Optional[Tuple[np.datetime64, np.datetime64]] = None
+        self._encode = _encode_v2 if schema_version is SchemaVersion.V2 else _encode_v1
         self._buf: List[Tuple] = list()
         self._n = 0
-        self._cursor = self._connection.open_as_temporary().cursor()
+        self._n_ignored = 0
+        self._cursor = self._open_as_temporary()
 
-    def _execute_many(self, _buf: Iterable[Iterable]):
+    def _open_as_temporary(self) -> sqlite3.Cursor:
+        cursor = self._connection.open_as_temporary().cursor()
+        if self._bulk_load:
+            for pragma in BULK_LOAD_PRAGMAS:
+                cursor.execute(pragma)
+        return cursor
+
+    def _execute_many(self, _buf: Sequence[Sequence]):
         self._cursor.executemany(
-            'INSERT INTO executions '
+            f'INSERT {"OR IGNORE " if self._schema_version is SchemaVersion.V2 else ""}INTO executions '
             'VALUES ('
             '?,'
             '?,'
@@ -99,6 +258,11 @@ class SqliteExecutionWriter:
             '?)', _buf
         )
 
+        ignored = len(_buf) - self._cursor.rowcount
+        if ignored:
+            self._n_ignored += ignored
+            self._logger.warning(f'ignored rows of duplicate id: {ignored}, total: {self._n_ignored}')
+
     async def write(self, iterable: AsyncIterable[Execution]):
         """
         self._records_insertion のレコード数毎にデータベースファイルへ書き出し、self._records_rotationに達するとファイルを
@@ -109,55 +273,248 @@ class SqliteExecutionWriter:
         self._logger.info(f'new iterable, n: {self._n}, len(buf): {len(self._buf)}')
 
         async for e in iterable:
-            self._buf.append((
-                e.symbol.value,
-                (e._id and e._id or None),
-                str(e.timestamp),
-                (e.side and e.side.value or ''),
-                str(e.price),
-                str(e.size),
-                e.buy_child_order_acceptance_id,
-                e.sell_child_order_acceptance_id,
-                e.synchronized_execution_price_deviation and str(e.synchronized_execution_price_deviation) or None,
-                e.synchronized_execution_time_delta and e.synchronized_execution_time_delta.item() or None,
-                (e.synchronized_execution and e.synchronized_execution.symbol
-                 and e.synchronized_execution.symbol.value or None),
-                (e.synchronized_execution and e.synchronized_execution._id
-                 and e.synchronized_execution._id or None),
-                (e.synchronized_execution and e.synchronized_execution.timestamp
-                 and str(e.synchronized_execution.timestamp) or None),
-                (e.synchronized_execution and e.synchronized_execution.side
-                 and e.synchronized_execution.side.value or None),
-                (e.synchronized_execution and e.synchronized_execution.price
-                 and str(e.synchronized_execution.price) or None),
-                (e.synchronized_execution and e.synchronized_execution.size
-                 and str(e.synchronized_execution.size) or None),
-                (e.synchronized_execution and e.synchronized_execution.buy_child_order_acceptance_id
-                 and e.synchronized_execution.buy_child_order_acceptance_id or None),
-                (e.synchronized_execution and e.synchronized_execution.sell_child_order_acceptance_id
-                 and e.synchronized_execution.sell_child_order_acceptance_id or None),
-            ))
-            self._n += 1
-
-            if self._n % self._n_records_insertion == 0:
-                self._execute_many(self._buf)
-                self._logger.info(
-                    f'inserted {len(self._buf)} buffer records'
-                    f', subtotal n: {int(self._n_records_insertion * (self._n / self._n_records_insertion))} records'
-                )
-                self._buf.clear()
-
-                if self._n == self._n_records_rotation:
-                    path = self._connection.close()
-                    self._logger.info(f'rotated, n: {self._n}, filename: {os.path.basename(path)}')
-
-                    self._n = 0
-                    self._cursor = self._connection.open_as_temporary().cursor()
-                    self._create_table_if_not_exists(self._cursor)
+            self._append(e)
 
         self._logger.info(f'end of iterable, n: {self._n}, len(buf): {len(self._buf)}')
 
+    def _append(self, e: Execution):
+        if self._schema_version is SchemaVersion.V2 and not e._id:
+            return
+
+        if self._partitioning is not None and (self._partition is None or self._partition[1] <= e.timestamp):
+            # 区間が変わる前のファイルに行があれば、分割します。前の区間の日時の約定（取引所の日時が前後して遅れて
+            # 届いた約定）では分割せず、現在のファイルに書き出します。チャンクはidと日時の両方について昇順のままです
+            if self._partition is not None and self._n:
+                self._rotate()
+            self._partition = self._partitioning.range(e.timestamp)
+
+        self._buf.append(self._encode(e))
+        self._n += 1
+
+        if self._n % self._n_records_insertion == 0:
+            self._execute_many(self._buf)
+            self._logger.info(
+                f'inserted {len(self._buf)} buffer records'
+                f', subtotal n: {int(self._n_records_insertion * (self._n / self._n_records_insertion))} records'
+            )
+            self._buf.clear()
+
+            if self._n == self._n_records_rotation:
+                self._rotate()
+
+    def _rotate(self):
+        if self._buf:
+            self._execute_many(self._buf)
+            self._buf.clear()
+
+        path = self._connection.close()
+        self._logger.info(f'rotated, n: {self._n}, filename: {os.path.basename(path)}')
+
+        self._n = 0
+        self._cursor = self._open_as_temporary()
+        self._create_table_if_not_exists(self._cursor)
+
+    def commit(self):
+        """
+        バッファーに残っている行を書き出して、一時ファイルへコミットします。
+        """
+        if self._buf:
+            self._execute_many(self._buf)
+            self._buf.clear()
+        self._cursor.connection.commit()
+
+    def close(self) -> Optional[str]:
+        """
+        バッファーに残っている行を書き出して、ファイルを閉じます。閉じたファイルのパスを返します。
+        書き出した行が無い場合は、一時ファイルを削除してNoneを返します。
+        """
+        if self._buf:
+            self._execute_many(self._buf)
+            self._buf.clear()
+        return self._connection.close()
+
     def _create_table_if_not_exists(self, cur: sqlite3.Cursor):
+        create_table_if_not_exists(cur, self._schema_version, indexes=not self._bulk_load)
+
+
+class ThreadedSqliteExecutionWriter(SqliteExecutionWriter):
+    """
+    専用のスレッドで変換、挿入およびローテーションを行うライター
+
+    イベントループ側は`chunk_size`件ごとのExecutionのリストを、最大`queue_size`個のキューへ入れるだけです。
+    上流のストリーム (S3からのダウンロードや展開など) と、SQLiteへの挿入が並行して進みます。
+    キューが一杯の場合、上流の読み込みは待たされます。その他の引数は、SqliteExecutionWriterと同じです。
+
+    接続は書き出しのスレッドから使われるため、`check_same_thread=False`で開かれている必要があります。
+    """
+
+    def __init__(self, logger: Logger,
+                 connection: AbstractConnection,
+                 queue_size: int = 4,
+                 chunk_size: int = 10_000,
+                 **kwargs):
+        super().__init__(logger, connection, **kwargs)
+        if queue_size < 1:
+            raise ValueError(f'queue_size must be positive: {queue_size}')
+
+        self._queue_size = queue_size
+        self._chunk_size = chunk_size
+
+    async def write(self, iterable: AsyncIterable[Execution]):
+        loop = asyncio.get_running_loop()
+        queue: 'asyncio.Queue[Optional[List[Execution]]]' = asyncio.Queue(maxsize=self._queue_size)
+        errors: List[BaseException] = list()
+
+        def _get() -> Optional[List[Execution]]:
+            return asyncio.run_coroutine_threadsafe(queue.get(), loop).result()
+
+        def _work():
+            try:
+                self._create_table_if_not_exists(self._cursor)
+                while True:
+                    chunk = _get()
+                    if chunk is None:
+                        return
+                    for e in chunk:
+                        self._append(e)
+            except BaseException as e:
+                errors.append(e)
+                # イベントループ側がキューへの追加で待たされないよう、終端まで読み捨てます
+                while _get() is not None:
+                    pass
+
+        self._logger.info(f'new iterable, n: {self._n}, len(buf): {len(self._buf)}')
+
+        worker = threading.Thread(target=_work, name=self.__class__.__name__, daemon=True)
+        worker.start()
+        try:
+            chunk: List[Execution] = list()
+            async for e in iterable:
+                chunk.append(e)
+                if len(chunk) == self._chunk_size:
+                    if errors:
+                        break
+                    await queue.put(chunk)
+                    chunk = list()
+            if chunk and not errors:
+                await queue.put(chunk)
+
+        finally:
+            await queue.put(None)
+            await loop.run_in_executor(None, worker.join)
+
+        if errors:
+            raise errors[0]
+
+        self._logger.info(f'end of iterable, n: {self._n}, len(buf): {len(self._buf)}')
+
+
+# Enum.valueはディスクリプタを経由するため、書き出す値は辞書から引きます
+_SYMBOL_VALUES = {symbol: symbol.value for symbol in Symbol}
+_SIDE_VALUES = {side: side.value for side in Side}
+
+_NO_SYNCHRONIZED_EXECUTION = (None,) * 8
+
+
+def _encode_v1(e: Execution) -> Tuple:
+    # 固定小数点モードのExecutionも、Decimalと同じ表現で書き出します
+    precision = Precision.of(e.symbol)
+    return (
+        _SYMBOL_VALUES[e.symbol],
+        e._id or None,
+        str(e.timestamp),
+        e.side and _SIDE_VALUES[e.side] or '',
+        str(precision.decimal_price(e.price)),
+        str(precision.decimal_size(e.size)),
+        e.buy_child_order_acceptance_id,
+        e.sell_child_order_acceptance_id,
+        e.synchronized_execution_price_deviation and str(e.synchronized_execution_price_deviation) or None,
+        e.synchronized_execution_time_delta and e.synchronized_execution_time_delta.item() or None,
+    ) + _encode_synchronized_v1(e.synchronized_execution, precision)
+
+
+def _encode_synchronized_v1(s: Optional[SynchronizedExecution], precision: Precision) -> Tuple:
+    if s is None:
+        return _NO_SYNCHRONIZED_EXECUTION
+
+    precision = s.symbol and Precision.of(s.symbol) or precision
+    return (
+        s.symbol and _SYMBOL_VALUES[s.symbol] or None,
+        s._id or None,
+        s.timestamp and str(s.timestamp) or None,
+        s.side and _SIDE_VALUES[s.side] or None,
+        s.price and str(precision.decimal_price(s.price)) or None,
+        s.size and str(precision.decimal_size(s.size)) or None,
+        s.buy_child_order_acceptance_id or None,
+        s.sell_child_order_acceptance_id or None,
+    )
+
+
+def _encode_v2(e: Execution) -> Tuple:
+    precision = Precision.of(e.symbol)
+    return (
+        _SYMBOL_VALUES[e.symbol],
+        e._id,
+        encode_epoch_timestamp(e.timestamp),
+        SIDE_CODES[e.side or Side.NOTHING],
+        _encode_number(precision.decimal_price(e.price)),
+        _encode_number(precision.decimal_size(e.size)),
+        e.buy_child_order_acceptance_id,
+        e.sell_child_order_acceptance_id,
+        e.synchronized_execution_price_deviation and float(e.synchronized_execution_price_deviation) or None,
+        e.synchronized_execution_time_delta and e.synchronized_execution_time_delta.item() or None,
+    ) + _encode_synchronized_v2(e.synchronized_execution, precision)
+
+
+def _encode_synchronized_v2(s: Optional[SynchronizedExecution], precision: Precision) -> Tuple:
+    if s is None:
+        return _NO_SYNCHRONIZED_EXECUTION
+
+    precision = s.symbol and Precision.of(s.symbol) or precision
+    return (
+        s.symbol and _SYMBOL_VALUES[s.symbol] or None,
+        s._id or None,
+        None if s.timestamp is None else encode_epoch_timestamp(s.timestamp),
+        SIDE_CODES[s.side] if s.side else None,
+        s.price and _encode_number(precision.decimal_price(s.price)) or None,
+        s.size and _encode_number(precision.decimal_size(s.size)) or None,
+        s.buy_child_order_acceptance_id or None,
+        s.sell_child_order_acceptance_id or None,
+    )
+
+
+def _encode_number(value: Decimal) -> Union[int, float]:
+    """
+    Decimalを、sqlite3がそのまま書き込める数値に変換します。整数値はINTEGERとして格納されます。
+    """
+    return int(value) if value == value.to_integral_value() else float(value)
+
+
+def create_table_if_not_exists(cur: sqlite3.Cursor,
+                               schema_version: SchemaVersion = SchemaVersion.V1,
+                               indexes: bool = True):
+    if schema_version is SchemaVersion.V2:
+        cur.execute('CREATE TABLE IF NOT EXISTS executions ('
+                    'symbol TEXT NOT NULL, '
+                    'id INTEGER PRIMARY KEY, '
+                    'timestamp INTEGER NOT NULL, '
+                    'side INTEGER NOT NULL, '
+                    'price NUMERIC NOT NULL, '
+                    'size NUMERIC NOT NULL, '
+                    'buy_child_order_acceptance_id TEXT, '
+                    'sell_child_order_acceptance_id TEXT, '
+                    'synchronized_execution_price_deviation REAL, '
+                    'synchronized_execution_time_delta INTEGER, '
+                    'synchronized_symbol TEXT, '
+                    'synchronized_id INTEGER, '
+                    'synchronized_timestamp INTEGER, '
+                    'synchronized_side INTEGER, '
+                    'synchronized_price NUMERIC, '
+                    'synchronized_size NUMERIC, '
+                    'synchronized_buy_child_order_acceptance_id TEXT, '
+                    'synchronized_sell_child_order_acceptance_id TEXT)')
+        cur.execute(f'PRAGMA user_version = {SchemaVersion.V2.value}')
+    else:
         cur.execute('CREATE TABLE IF NOT EXISTS executions ('
                     'symbol TEXT NOT NULL, '
                     'id INTEGER, '
@@ -177,3 +534,220 @@ class SqliteExecutionWriter:
                     'synchronized_size REAL, '
                     'synchronized_buy_child_order_acceptance_id TEXT, '
                     'synchronized_sell_child_order_acceptance_id TEXT)')
+
+    if indexes:
+        create_indexes_if_not_exist(cur, schema_version)
+
+
+def create_indexes_if_not_exist(cur: sqlite3.Cursor, schema_version: SchemaVersion = SchemaVersion.V1):
+    """
+    SqliteStreamReaderの範囲指定 (WHERE句) のためのインデックスを作成します。スキーマV2のidは主キーです。
+    """
+    if schema_version is SchemaVersion.V1:
+        cur.execute('CREATE INDEX IF NOT EXISTS executions_id ON executions (id)')
+    cur.execute('CREATE INDEX IF NOT EXISTS executions_timestamp ON executions (timestamp)')
+
+
+def convert_to_schema_v2(source: sqlite3.Connection, destination: sqlite3.Connection,
+                         batch_size: int = 100_000) -> int:
+    """
+    スキーマV1のデータベースの行を、スキーマV2のデータベースへ書き出し、重複したidのため書き出さなかった行の数を返します。
+
+    idの無い行は、SqliteStreamReaderが読み込まないため書き出されません。
+    重複したidの2件目以降は、スキーマV2ではidが主キーのため書き出されません。スキーマV1のSqliteStreamReaderは
+    これらの行も読み込むため、変換によって読み込まれる約定は減ります。
+    """
+    if SchemaVersion.detect(source) is not SchemaVersion.V1:
+        raise ValueError('source database is not schema v1')
+
+    cursor = source.cursor()
+    cursor.row_factory = None
+    cursor.execute('SELECT * FROM executions WHERE id IS NOT NULL ORDER BY id')
+
+    destination_cursor = destination.cursor()
+    create_table_if_not_exists(destination_cursor, SchemaVersion.V2)
+
+    ignored = 0
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+
+        timestamps = np.array([row[2].rstrip('Z') for row in rows], dtype='datetime64[ns]').view(np.int64).tolist()
+        destination_cursor.executemany(
+            f'INSERT OR IGNORE INTO executions VALUES ({", ".join("?" * 18)})',
+            (_convert_row_to_v2(row, timestamp) for row, timestamp in zip(rows, timestamps))
+        )
+        ignored += len(rows) - destination_cursor.rowcount
+
+    cursor.close()
+    destination_cursor.close()
+    destination.commit()
+    return ignored
+
+
+def _convert_row_to_v2(row: Sequence[Any], timestamp: int) -> Tuple:
+    synchronized_timestamp, synchronized_side = row[12], row[13]
+    return (
+        *row[:2],
+        timestamp,
+        SIDE_CODES[row[3] and Side(row[3]) or Side.NOTHING],
+        *row[4:12],
+        None if synchronized_timestamp is None else encode_epoch_timestamp(
+            np.datetime64(synchronized_timestamp.rstrip('Z'), 'ns')
+        ),
+        None if synchronized_side is None else SIDE_CODES[Side(synchronized_side)],
+        *row[14:],
+    )
+
+
+class IngestionJournal:
+    """
+    S3オブジェクトの取り込みの進捗
+
+    取り込みを終えたS3キーと、その時点でコミットされた最大のExecution idを、出力先ディレクトリの`FILENAME`に
+    記録します。SqliteExecutionWriter.commitの後に記録されるため、記録されたキーの約定は永続化されています。
+    """
+
+    FILENAME = 'ingestion.json'
+
+    def __init__(self, completed_keys: Iterable[str] = (), last_id: Optional[int] = None):
+        self._completed_keys: List[str] = list(completed_keys)
+        self._completed_key_set = set(self._completed_keys)
+        self._last_id = last_id
+
+    @property
+    def completed_keys(self) -> Sequence[str]:
+        return self._completed_keys
+
+    @property
+    def last_id(self) -> Optional[int]:
+        return self._last_id
+
+    def is_completed(self, key: str) -> bool:
+        return key in self._completed_key_set
+
+    def complete(self, key: str, last_id: Optional[int]):
+        if key not in self._completed_key_set:
+            self._completed_keys.append(key)
+            self._completed_key_set.add(key)
+        if last_id is not None:
+            self._last_id = last_id
+
+    @staticmethod
+    def load(directory: str) -> 'IngestionJournal':
+        """
+        ジャーナルを読み込みます。ジャーナルが存在しない場合は、空のジャーナルを返します。
+        """
+        try:
+            with open(os.path.join(directory, IngestionJournal.FILENAME)) as f:
+                d = json.load(f)
+        except FileNotFoundError:
+            return IngestionJournal()
+        return IngestionJournal(completed_keys=d['completed_keys'], last_id=d['last_id'])
+
+    def save(self, directory: str):
+        path = os.path.join(directory, self.FILENAME)
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(dict(completed_keys=self._completed_keys, last_id=self._last_id), f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f'{path}.tmp', path)
+
+
+async def write_resumable(logger: Logger,
+                          writer: SqliteExecutionWriter,
+                          connection: Connection,
+                          keys: Iterable[str],
+                          open_stream: Callable[[str], AsyncIterable[Execution]]):
+    """
+    キー毎のストリームを書き出し、キー毎にコミットしてIngestionJournalへ記録します。
+
+    ジャーナルに記録されたキーは読み込まずに飛ばします。どのキーのストリームからも、既にコミットされたidまでの約定を
+    除きます。これにより、隣り合うS3オブジェクトが同じ約定を含む場合や、中断されたキーを最初から読み込み直す場合にも、
+    idは重複しません。ジャーナルへ記録する前に中断された場合も、一時ファイルとマニフェストから求めた
+    コミット済みのidで重複を除きます。
+    バルクロードモードでは一時ファイルへのコミットが同期されないため、中断後の再開は保証されません。
+    """
+    journal = IngestionJournal.load(connection.basedir)
+    boundary_ids = [i for i in (journal.last_id, connection.last_committed_id()) if i is not None]
+    boundary_id: Optional[int] = max(boundary_ids, default=None)
+
+    for key in keys:
+        if journal.is_completed(key):
+            logger.info(f'skipped completed key: {key}')
+            continue
+
+        stream = open_stream(key)
+        if boundary_id is not None:
+            logger.info(f'writing after id: {boundary_id}, key: {key}')
+            stream = FilterStream(logger, stream, predicate=lambda e, _id=boundary_id: e._id > _id)
+
+        await writer.write(iterable=stream)
+        writer.commit()
+
+        last_id = connection.last_committed_id()
+        journal.complete(key, last_id)
+        journal.save(connection.basedir)
+        if last_id is not None:
+            boundary_id = last_id
+
+
+def stitch_chunks(logger: Logger, sources: Sequence[str], destination: str) -> List[str]:
+    """
+    `sources`の各ディレクトリのチャンクを、この順に`destination`へ移動し、移動したチャンクのパスを返します。
+
+    各ディレクトリのチャンクのうち、それより前のディレクトリ (および`destination`の既存のチャンク) の最大のid以下の行は、
+    重複として削除され、ファイル名が付け直されます。ディレクトリの中のS3キーの間の重複は、write_resumableで除かれています。移動後に`destination`のマニフェストを作り直し、`sources`を削除します。
+    各ディレクトリのチャンクは、idが連続している必要があります。
+    """
+    os.makedirs(destination, exist_ok=True)
+    last_id: Optional[int] = max((e.chunk.last_id for e in ChunkManifest.build(destination).entries), default=None)
+    stitched: List[str] = list()
+
+    for source in sources:
+        boundary_id = last_id
+        for path in list_sqlite_paths(source):
+            if boundary_id is not None and FileName.parse(os.path.basename(path)).first_id <= boundary_id:
+                path = _trim_chunk(logger, path, boundary_id)
+                if path is None:
+                    continue
+
+            to_path = os.path.join(destination, os.path.basename(path))
+            os.replace(path, to_path)
+            stitched.append(to_path)
+
+            chunk_last_id = FileName.parse(os.path.basename(to_path)).last_id
+            last_id = chunk_last_id if last_id is None else max(last_id, chunk_last_id)
+        logger.info(f'stitched: {source}, last id: {last_id}')
+
+    _fsync(destination)
+    ChunkManifest.build(destination).save(destination)
+    for source in sources:
+        shutil.rmtree(source)
+    return stitched
+
+
+def _trim_chunk(logger: Logger, path: str, boundary_id: int) -> Optional[str]:
+    """
+    チャンクから`boundary_id`以下のidの行を削除し、ファイル名を付け直したパスを返します。
+    残る行が無い場合は、チャンクを削除してNoneを返します。
+    """
+    con = sqlite3.connect(path)
+    try:
+        with con:
+            con.execute('DELETE FROM executions WHERE id <= ?', (boundary_id,))
+        cur = con.cursor()
+        chunk, rows = _read_chunk(cur, FileName.parse(os.path.basename(path)).exchange)
+        cur.close()
+    finally:
+        con.close()
+
+    logger.info(f'trimmed duplicates up to id: {boundary_id}, path: {os.path.basename(path)}, rows: {rows}')
+    if chunk is None:
+        os.remove(path)
+        return None
+
+    to_path = os.path.join(os.path.dirname(path), FileName.unparse(chunk))
+    os.replace(path, to_path)
+    return to_path
@@ -1,4 +1,6 @@
+import os
 import sqlite3
+import tempfile
 import unittest
 from decimal import Decimal
 from typing import AsyncIterable, AsyncIterator
@@ -8,16 +10,20 @@ import sys
 
 from trade.execution.model import Execution
 from trade.execution.stream.tests.test_sqlite import e1, e2
-from trade.executionwriter.sqlite import SqliteExecutionWriter, AbstractConnection
+from trade.execution.stream.sqlite import ChunkManifest, list_sqlite_paths, SchemaVersion, SqliteStreamReader, \
+    FileName
+from trade.executionwriter.sqlite import SqliteExecutionWriter, AbstractConnection, Connection, \
+    ThreadedSqliteExecutionWriter, TimePartitioning, IngestionJournal, write_resumable, stitch_chunks
 from trade.log import get_logger
-from trade.model import Symbol
+from trade.model import Symbol, Exchange
+from trade.side import Side
 
 
 class SqliteExecutionWriterTestCase(unittest.IsolatedAsyncioTestCase):
     class InMemoryConnection(AbstractConnection):
 
         def __init__(self):
-            self._con = sqlite3.connect(':memory:')
+            self._con = sqlite3.connect(':memory:', check_same_thread=False)
 
         def open_as_temporary(self) -> sqlite3.Connection:
             return self._con
@@ -113,10 +119,470 @@ class SqliteExecutionWriterTestCase(unittest.IsolatedAsyncioTestCase):
 
         self.assertEqual(0, len(actual))
 
+    async def test_write_index(self):
+        class Iterable(AsyncIterable[Execution]):
+            async def __aiter__(self) -> AsyncIterator[Execution]:
+                yield e1
+                yield e2
+
+        connection = self.InMemoryConnection()
+
+        writer = SqliteExecutionWriter(
+            logger=get_logger(self.__class__.__name__, stream=sys.stdout),
+            connection=connection,
+        )
+        await writer.write(iterable=Iterable())
+
+        plan = connection.get().execute(
+            'EXPLAIN QUERY PLAN SELECT * FROM executions WHERE id IS NOT NULL AND timestamp >= ? ORDER BY id',
+            ('2019-07-07T08:59:59',)
+        ).fetchall()
+        self.assertTrue(any('executions_timestamp' in row[-1] or 'executions_id' in row[-1] for row in plan), plan)
+
+    async def test_write_schema_v2(self):
+        class Iterable(AsyncIterable[Execution]):
+            async def __aiter__(self) -> AsyncIterator[Execution]:
+                yield e1
+                yield e2
+                yield e2
+                yield Execution(symbol=Symbol.FXBTCJPY, _id=None,
+                                timestamp=np.datetime64('2019-07-07T08:59:58.877569400'),
+                                side=None, price=Decimal('100'), size=Decimal('0.01'),
+                                buy_child_order_acceptance_id='JRF20190707-085958-692751',
+                                sell_child_order_acceptance_id='JRF20190707-085958-403844')
+
+        connection = self.InMemoryConnection()
+        logger = get_logger(self.__class__.__name__, stream=sys.stdout)
+        writer = SqliteExecutionWriter(
+            logger=logger,
+            connection=connection,
+            records_insertion=1,
+            schema_version=SchemaVersion.V2,
+        )
+        with self.assertLogs(logger, 'WARNING') as logs:
+            await writer.write(iterable=Iterable())
+        self.assertEqual(['WARNING:ignored rows of duplicate id: 1, total: 1'],
+                         [f'{r.levelname}:{r.getMessage()}' for r in logs.records])
+
+        self.assertIs(SchemaVersion.V2, SchemaVersion.detect(connection.get()))
+        self.assertEqual(
+            [
+                ('FXBTCJPY', 1, 1562489998877569400, 1, 100, 0.01, 'JRF20190707-085958-692751',
+                 'JRF20190707-085958-403844', None, None, None, None, None, None, None, None, None, None),
+                ('FXBTCJPY', 2, 1562489999877569400, -1, 10, 1.23, 'JRF20190707-085958-692752',
+                 'JRF20190707-085958-403845', 0.11111111111111112, -1000000001, 'BTCJPY', 3,
+                 1562490000877569401, -1, 9, 1.1, 'JRF20190707-085958-692753', 'JRF20190707-085958-403846'),
+            ],
+            connection.get().execute('SELECT * FROM executions').fetchall()
+        )
+        self.assertEqual(
+            [e1, e2],
+            [e async for e in SqliteStreamReader(get_logger(self.__class__.__name__), connection=connection.get())]
+        )
+
+
+class _SequentialExecutions(AsyncIterable[Execution]):
+
+    def __init__(self, n: int,
+                 start: np.datetime64 = np.datetime64('2019-07-07T08:59:58.877569400'),
+                 interval: np.timedelta64 = np.timedelta64(1, 's')):
+        self._n = n
+        self._start = start
+        self._interval = interval
+
+    async def __aiter__(self) -> AsyncIterator[Execution]:
+        for n in range(self._n):
+            yield Execution(symbol=Symbol.FXBTCJPY, _id=n + 1,
+                            timestamp=self._start + self._interval * n,
+                            side=Side.BUY, price=Decimal('100'), size=Decimal('0.01'),
+                            buy_child_order_acceptance_id='JRF20190707-085958-692751',
+                            sell_child_order_acceptance_id='JRF20190707-085958-403844')
+
+
+class _TimestampedExecutions(AsyncIterable[Execution]):
+
+    def __init__(self, *timestamps: str):
+        self._timestamps = timestamps
+
+    async def __aiter__(self) -> AsyncIterator[Execution]:
+        for n, timestamp in enumerate(self._timestamps):
+            yield Execution(symbol=Symbol.FXBTCJPY, _id=n + 1, timestamp=np.datetime64(timestamp, 'ns'),
+                            side=Side.BUY, price=Decimal('100'), size=Decimal('0.01'),
+                            buy_child_order_acceptance_id='JRF20190707-085958-692751',
+                            sell_child_order_acceptance_id='JRF20190707-085958-403844')
+
+
+class ConnectionTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def test_close_updates_manifest(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            writer = SqliteExecutionWriter(
+                logger=get_logger(self.__class__.__name__, stream=sys.stdout),
+                connection=Connection(tempdir, exchange=Exchange.bitFlyer),
+                records_rotation=2,
+                records_insertion=2,
+            )
+            await writer.write(iterable=_SequentialExecutions(6))
+
+            manifest = ChunkManifest.load(tempdir)
+            self.assertEqual([(1, 2), (3, 4), (5, 6)], [(e.chunk.first_id, e.chunk.last_id) for e in manifest.entries])
+            self.assertEqual([2, 2, 2], [e.rows for e in manifest.entries])
+            self.assertEqual(
+                [os.path.getsize(os.path.join(tempdir, e.filename)) for e in manifest.entries],
+                [e.size for e in manifest.entries]
+            )
+            self.assertEqual(
+                [e.to_dict() for e in ChunkManifest.build(tempdir).entries], [e.to_dict() for e in manifest.entries]
+            )
+
+            paths = list(list_sqlite_paths(tempdir, id_from=3))
+            os.remove(os.path.join(tempdir, ChunkManifest.FILENAME))
+            self.assertEqual(list(list_sqlite_paths(tempdir, id_from=3)), paths)
+            self.assertEqual(2, len(paths))
+
+    async def test_close_bulk_load(self):
+        for schema_version, indexes in [
+            (SchemaVersion.V1, ['executions_id', 'executions_timestamp']),
+            (SchemaVersion.V2, ['executions_timestamp']),
+        ]:
+            with self.subTest(schema_version=schema_version), tempfile.TemporaryDirectory() as tempdir:
+                writer = SqliteExecutionWriter(
+                    logger=get_logger(self.__class__.__name__, stream=sys.stdout),
+                    connection=Connection(tempdir, exchange=Exchange.bitFlyer),
+                    records_rotation=4,
+                    records_insertion=2,
+                    schema_version=schema_version,
+                    bulk_load=True,
+                )
+                await writer.write(iterable=_SequentialExecutions(8))
+
+                paths = list(list_sqlite_paths(tempdir))
+                self.assertEqual(2, len(paths))
+                for path in paths:
+                    con = sqlite3.connect(path)
+                    self.assertEqual(
+                        indexes,
+                        [name for name, in con.execute("SELECT name FROM sqlite_master WHERE type = 'index' "
+                                                       "AND name NOT LIKE 'sqlite_%' ORDER BY name")]
+                    )
+                    self.assertEqual(('ok',), con.execute('PRAGMA integrity_check').fetchone())
+                    self.assertEqual(4, len([e async for e in SqliteStreamReader(get_logger(__name__), con)]))
+                    con.close()
+
+
+class _InterruptedExecutions(AsyncIterable[Execution]):
+
+    def __init__(self, executions: AsyncIterable[Execution], id_from: int, id_to: int, interrupted_at: int = None):
+        self._executions = executions
+        self._id_from = id_from
+        self._id_to = id_to
+        self._interrupted_at = interrupted_at
+
+    async def __aiter__(self) -> AsyncIterator[Execution]:
+        async for e in self._executions:
+            if e._id == self._interrupted_at:
+                raise ConnectionResetError(e._id)
+            if self._id_to < e._id:
+                return
+            if self._id_from <= e._id:
+                yield e
+
+
+class IngestionJournalTestCase(unittest.IsolatedAsyncioTestCase):
+
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            self.assertEqual([], IngestionJournal.load(tempdir).completed_keys)
+
+            journal = IngestionJournal()
+            journal.complete('a', 3)
+            journal.complete('b', None)
+            journal.save(tempdir)
+
+            journal = IngestionJournal.load(tempdir)
+            self.assertEqual(['a', 'b'], journal.completed_keys)
+            self.assertEqual(3, journal.last_id)
+            self.assertTrue(journal.is_completed('b'))
+            self.assertFalse(journal.is_completed('c'))
+            self.assertEqual([IngestionJournal.FILENAME], os.listdir(tempdir))
+
+    async def test_write_resumable(self):
+        logger = get_logger(self.__class__.__name__, stream=sys.stdout)
+        ranges = dict(a=(1, 3), b=(4, 6), c=(7, 9))
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            connection = Connection(tempdir, exchange=Exchange.bitFlyer)
+            writer = SqliteExecutionWriter(logger, connection=connection, records_rotation=2, records_insertion=1)
+            with self.assertRaises(ConnectionResetError):
+                # キーbの6番目の約定の前で中断し、一時ファイルにコミットされていない5番目の約定を失う
+                await write_resumable(
+                    logger, writer, connection, keys=['a', 'b', 'c'],
+                    open_stream=lambda key: _InterruptedExecutions(_SequentialExecutions(9), *ranges[key], 6)
+                )
+            writer._cursor.connection.close()
+            self.assertEqual(['a'], IngestionJournal.load(tempdir).completed_keys)
+
+            opened = list()
+
+            def open_stream(key: str) -> AsyncIterable[Execution]:
+                opened.append(key)
+                return _InterruptedExecutions(_SequentialExecutions(9), *ranges[key])
+
+            connection = Connection(tempdir, exchange=Exchange.bitFlyer)
+            writer = SqliteExecutionWriter(logger, connection=connection, records_rotation=2, records_insertion=1)
+            await write_resumable(logger, writer, connection, keys=['a', 'b', 'c'], open_stream=open_stream)
+            writer.close()
+
+            self.assertEqual(['b', 'c'], opened)
+            self.assertEqual(['a', 'b', 'c'], IngestionJournal.load(tempdir).completed_keys)
+            self.assertEqual(9, IngestionJournal.load(tempdir).last_id)
+
+            ids = list()
+            for path in list_sqlite_paths(tempdir):
+                con = sqlite3.connect(path)
+                ids.extend([e._id async for e in SqliteStreamReader(logger, con)])
+                con.close()
+            self.assertEqual(list(range(1, 10)), ids)
+
+    async def test_write_resumable_overlapping(self):
+        logger = get_logger(self.__class__.__name__, stream=sys.stdout)
+        # 隣り合うキーが同じ約定を含み、重なりはファイルの分割をまたぎます
+        ranges = dict(a=(1, 4), b=(3, 7), c=(6, 9))
+
+        for schema_version in SchemaVersion:
+            with self.subTest(schema_version=schema_version), tempfile.TemporaryDirectory() as tempdir:
+                connection = Connection(tempdir, exchange=Exchange.bitFlyer)
+                writer = SqliteExecutionWriter(logger, connection=connection, records_rotation=3, records_insertion=1,
+                                               schema_version=schema_version)
+                await write_resumable(
+                    logger, writer, connection, keys=['a', 'b', 'c'],
+                    open_stream=lambda key: _InterruptedExecutions(_SequentialExecutions(9), *ranges[key])
+                )
+                writer.close()
+
+                ids = list()
+                for path in list_sqlite_paths(tempdir):
+                    con = sqlite3.connect(path)
+                    ids.extend(con.execute('SELECT id FROM executions ORDER BY id').fetchall())
+                    con.close()
+                self.assertEqual([(n,) for n in range(1, 10)], ids)
+                self.assertEqual(9, IngestionJournal.load(tempdir).last_id)
+
+
+class StitchChunksTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def test_stitch_chunks(self):
+        logger = get_logger(self.__class__.__name__, stream=sys.stdout)
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            destination = os.path.join(tempdir, 'sqlite')
+            sources = [os.path.join(tempdir, f'part-{n}') for n in range(3)]
+            # 隣り合うS3 Keyが同じ約定を含むように、各ワーカーの範囲は前の範囲と重なります
+            for source, id_range in zip(sources, [(1, 8), (7, 15), (10, 12)]):
+                writer = SqliteExecutionWriter(
+                    logger, connection=Connection(source, exchange=Exchange.bitFlyer),
+                    records_rotation=3, records_insertion=1,
+                )
+                await writer.write(_InterruptedExecutions(_SequentialExecutions(15), *id_range))
+                writer.close()
+
+            stitched = stitch_chunks(logger, sources, destination)
+
+            self.assertEqual(list(list_sqlite_paths(destination)), stitched)
+            self.assertFalse(any(os.path.exists(source) for source in sources))
+
+            ids = list()
+            for path in stitched:
+                con = sqlite3.connect(path)
+                chunk_ids = [e._id async for e in SqliteStreamReader(logger, con)]
+                con.close()
+                chunk = FileName.parse(os.path.basename(path))
+                self.assertEqual((chunk.first_id, chunk.last_id), (chunk_ids[0], chunk_ids[-1]))
+                ids.extend(chunk_ids)
+            self.assertEqual(list(range(1, 16)), ids)
+
+            manifest = ChunkManifest.load(destination)
+            self.assertEqual([os.path.basename(path) for path in stitched], [e.filename for e in manifest.entries])
+            self.assertEqual(15, sum(e.rows for e in manifest.entries))
+
+    async def test_close_empty(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            connection = Connection(tempdir, exchange=Exchange.bitFlyer)
+            writer = SqliteExecutionWriter(
+                get_logger(self.__class__.__name__, stream=sys.stdout), connection=connection,
+                records_rotation=2, records_insertion=2,
+            )
+            await writer.write(_SequentialExecutions(4))
+
+            self.assertIsNone(connection.close())
+            self.assertEqual(2, len(list(list_sqlite_paths(tempdir))))
+            self.assertFalse(os.path.exists(os.path.join(tempdir, 'temp.sqlite3')))
+
+
+class TimePartitioningTestCase(unittest.IsolatedAsyncioTestCase):
+
+    def test_range(self):
+        jst = TimePartitioning.TIMEZONES['JST']
+        for partitioning, dt, expected in [
+            (TimePartitioning('D'), '2019-07-07T23:59:59.999999999',
+             ('2019-07-07T00:00', '2019-07-08T00:00')),
+            (TimePartitioning('D', jst), '2019-07-07T14:59:59.999999999',
+             ('2019-07-06T15:00', '2019-07-07T15:00')),
+            (TimePartitioning('D', jst), '2019-07-07T15:00',
+             ('2019-07-07T15:00', '2019-07-08T15:00')),
+            (TimePartitioning('h'), '2019-07-07T08:59:58.877569400',
+             ('2019-07-07T08:00', '2019-07-07T09:00')),
+        ]:
+            with self.subTest(dt=dt):
+                self.assertEqual(
+                    tuple(np.datetime64(v, 'ns') for v in expected), partitioning.range(np.datetime64(dt, 'ns'))
+                )
+
+        with self.assertRaises(ValueError):
+            TimePartitioning('m')
+
+    async def test_write(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            # 2019-07-07T12:00Z から1時間毎。日本時間の日の境界は 15:00Z
+            writer = SqliteExecutionWriter(
+                logger=get_logger(self.__class__.__name__, stream=sys.stdout),
+                connection=Connection(tempdir, exchange=Exchange.bitFlyer),
+                records_rotation=2,
+                records_insertion=1,
+                partitioning=TimePartitioning('D', TimePartitioning.TIMEZONES['JST']),
+            )
+            await writer.write(iterable=_SequentialExecutions(
+                6, start=np.datetime64('2019-07-07T12:00', 'ns'), interval=np.timedelta64(1, 'h')
+            ))
+            writer.close()
+
+            self.assertEqual(
+                [(1, 2), (3, 3), (4, 5), (6, 6)],
+                [(e.chunk.first_id, e.chunk.last_id) for e in ChunkManifest.load(tempdir).entries]
+            )
+
+            def _ids(**kwargs):
+                return [FileName.parse(os.path.basename(p)).first_id
+                        for p in list_sqlite_paths(tempdir, overlapping=True, **kwargs)]
+
+            day = dict(
+                datetime_from=np.datetime64('2019-07-07T15:00'), datetime_until=np.datetime64('2019-07-08T15:00')
+            )
+            self.assertEqual([4, 6], _ids(**day))
+            self.assertEqual([1, 3], _ids(datetime_until=np.datetime64('2019-07-07T15:00')))
+            self.assertEqual([3, 4], _ids(datetime_from=np.datetime64('2019-07-07T13:30'),
+                                          datetime_until=np.datetime64('2019-07-07T15:30')))
+
+            os.remove(os.path.join(tempdir, ChunkManifest.FILENAME))
+            self.assertEqual([4, 6], _ids(**day))
+
+    async def test_write_late_executions(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            writer = SqliteExecutionWriter(
+                logger=get_logger(self.__class__.__name__, stream=sys.stdout),
+                connection=Connection(tempdir, exchange=Exchange.bitFlyer),
+                records_rotation=None,
+                records_insertion=1,
+                partitioning=TimePartitioning('h'),
+            )
+            # 3番目と5番目の約定は、境界を越えた後に前の区間の日時で届きます
+            await writer.write(iterable=_TimestampedExecutions(
+                '2019-07-07T00:59:59.9', '2019-07-07T01:00:00.1', '2019-07-07T00:59:59.95',
+                '2019-07-07T01:00:00.2', '2019-07-07T00:59:59.99',
+            ))
+            writer.close()
+
+            entries = ChunkManifest.load(tempdir).entries
+            self.assertEqual([(1, 1), (2, 5)], [(e.chunk.first_id, e.chunk.last_id) for e in entries])
+            self.assertEqual(
+                [np.datetime64('2019-07-07T00:59:59.9', 'ns'), np.datetime64('2019-07-07T01:00:00.1', 'ns')],
+                [e.chunk.first_datetime for e in entries]
+            )
+            self.assertEqual([2], [e.first_id for e in ChunkManifest.load(tempdir).find(
+                datetime_from=np.datetime64('2019-07-07T01:00'))])
+
+
+class ThreadedSqliteExecutionWriterTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def _write(self, writer_class, **kwargs) -> list:
+        connection = SqliteExecutionWriterTestCase.InMemoryConnection()
+        writer = writer_class(
+            logger=get_logger(self.__class__.__name__, stream=sys.stdout),
+            connection=connection,
+            records_rotation=4,
+            records_insertion=2,
+            **kwargs
+        )
+        await writer.write(iterable=_SequentialExecutions(5))
+        await writer.write(iterable=_SequentialExecutions(3))
+        return connection.get().execute('SELECT * FROM executions').fetchall()
+
+    async def test_write(self):
+        expected = await self._write(SqliteExecutionWriter)
+        self.assertEqual(8, len(expected))
+
+        for queue_size, chunk_size in [(1, 1), (1, 3), (4, 1_000)]:
+            with self.subTest(queue_size=queue_size, chunk_size=chunk_size):
+                self.assertEqual(
+                    expected,
+                    await self._write(ThreadedSqliteExecutionWriter, queue_size=queue_size, chunk_size=chunk_size)
+                )
+
+    async def test_write_rotation(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            writer = ThreadedSqliteExecutionWriter(
+                logger=get_logger(self.__class__.__name__, stream=sys.stdout),
+                connection=Connection(tempdir, exchange=Exchange.bitFlyer),
+                records_rotation=2,
+                records_insertion=2,
+                chunk_size=3,
+            )
+            await writer.write(iterable=_SequentialExecutions(6))
+
+            self.assertEqual(
+                [(1, 2), (3, 4), (5, 6)],
+                [(e.chunk.first_id, e.chunk.last_id) for e in ChunkManifest.load(tempdir).entries]
+            )
+
+    async def test_write_upstream_error(self):
+        class Iterable(AsyncIterable[Execution]):
+            async def __aiter__(self) -> AsyncIterator[Execution]:
+                yield e1
+                raise RuntimeError('upstream')
+
+        writer = ThreadedSqliteExecutionWriter(
+            logger=get_logger(self.__class__.__name__, stream=sys.stdout),
+            connection=SqliteExecutionWriterTestCase.InMemoryConnection(),
+            chunk_size=1,
+        )
+        with self.assertRaisesRegex(RuntimeError, 'upstream'):
+            await writer.write(iterable=Iterable())
+
+    async def test_write_error(self):
+        class FailingConnection(SqliteExecutionWriterTestCase.InMemoryConnection):
+            def close(self):
+                raise OSError('close')
+
+        writer = ThreadedSqliteExecutionWriter(
+            logger=get_logger(self.__class__.__name__, stream=sys.stdout),
+            connection=FailingConnection(),
+            records_rotation=2,
+            records_insertion=2,
+            queue_size=1,
+            chunk_size=1,
+        )
+        with self.assertRaisesRegex(OSError, 'close'):
+            await writer.write(iterable=_SequentialExecutions(100))
+
 
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.TestLoader().loadTestsFromTestCase(SqliteExecutionWriterTestCase))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(ConnectionTestCase))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(IngestionJournalTestCase))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(StitchChunksTestCase))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TimePartitioningTestCase))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(ThreadedSqliteExecutionWriterTestCase))
     return suite
 
 
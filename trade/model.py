@@ -1,7 +1,7 @@
 import dataclasses
-from decimal import Decimal
+from decimal import Decimal, ROUND_HALF_EVEN
 from enum import Enum
-from typing import Sequence, Any
+from typing import Sequence, Any, Dict, Union
 
 import numpy as np
 import pandas as pd
@@ -135,3 +135,71 @@ def normalize_exchange_name(name: str) -> str:
         return 'bitFlyer'
 
     raise ValueError(f'Unexpected name: {name}')
+
+
+@dataclasses.dataclass(frozen=True)
+class Precision:
+    """
+    固定小数点モードにおける、シンボル毎の価格およびサイズの小数点以下の桁数
+
+    固定小数点モードでは、価格およびサイズを、それぞれ10の`price`乗倍、`size`乗倍した整数で保持します。
+    例えば FXBTCJPY では、価格は円単位の整数、サイズはsatoshi単位の整数です。
+    """
+    price: int
+    size: int
+
+    @staticmethod
+    def of(symbol: Symbol) -> 'Precision':
+        return _PRECISIONS[symbol]
+
+    def decimal_price(self, price: Union[int, Decimal]) -> Decimal:
+        """
+        価格をDecimalで返します。固定小数点でない場合は、そのまま返します。
+        """
+        if isinstance(price, int):
+            return from_fixed_point(price, self.price)
+        return price
+
+    def decimal_size(self, size: Union[int, Decimal]) -> Decimal:
+        """
+        サイズをDecimalで返します。固定小数点でない場合は、そのまま返します。
+        """
+        if isinstance(size, int):
+            return from_fixed_point(size, self.size)
+        return size
+
+
+_PRECISIONS: Dict[Symbol, Precision] = {
+    Symbol.FXBTCJPY: Precision(price=0, size=8),
+    Symbol.BTCJPY: Precision(price=0, size=8),
+    Symbol.BCHBTC: Precision(price=8, size=8),
+    Symbol.ETHJPY: Precision(price=0, size=8),
+    Symbol.ETHUSD: Precision(price=2, size=0),
+    Symbol.ETHBTC: Precision(price=8, size=8),
+    Symbol.XBTUSD: Precision(price=1, size=0),
+    Symbol.XBTZ19: Precision(price=1, size=0),
+    Symbol.XBTZ20: Precision(price=1, size=0),
+}
+
+_POWERS_OF_TEN: Sequence[Decimal] = tuple(Decimal(10 ** n) for n in range(19))
+
+
+def to_fixed_point(value: Union[Decimal, int, float, str], precision: int) -> int:
+    """
+    値を、10の`precision`乗倍した整数に変換します。精度を超える桁は、ExecutionBatchの列単位の変換 (`np.rint`) と
+    同じく、最近接偶数への丸め (ROUND_HALF_EVEN) で丸められます。
+    """
+    if isinstance(value, int):
+        return value * 10 ** precision
+    if isinstance(value, float):
+        return round(value * 10 ** precision)
+    if isinstance(value, str):
+        value = Decimal(value)
+    return int(value.scaleb(precision).to_integral_value(rounding=ROUND_HALF_EVEN))
+
+
+def from_fixed_point(value: int, precision: int) -> Decimal:
+    """
+    10の`precision`乗倍された整数を、Decimalに変換します。
+    """
+    return Decimal(value) / _POWERS_OF_TEN[precision]
@@ -1,7 +1,11 @@
 import asyncio
+import functools
+import os
+import sqlite3
 from argparse import ArgumentParser, Namespace
+from concurrent.futures import ProcessPoolExecutor
 from logging import Logger
-from typing import AsyncIterable, List, Optional, Dict, Any
+from typing import AsyncIterable, Optional, Dict, Any, Iterable, List
 
 import numpy as np
 import sys
@@ -10,11 +14,18 @@ from trade.execution.model import Execution
 from trade.execution.stream.adapter.filter import DropWhileStream, NewPricesStream, OHLCStream
 from trade.execution.stream.adapter.sync import SynchronizedStream
 from trade.execution.stream.chain import ChainedStream
-from trade.execution.stream.s3 import S3Stream, list_s3_keys, build_s3_key_prefix
-from trade.execution.stream.sqlite import list_sqlite_connections, SqliteStreamReader
-from trade.executionwriter.sqlite import Connection, SqliteExecutionWriter
+from trade.execution.stream.s3 import S3Stream, list_s3_keys, build_s3_key_prefix, S3Prefetcher, S3Cache, \
+    list_s3_keys_by_day, days_of
+from trade.execution.stream.sqlite import list_sqlite_connections, SqliteStreamReader, list_sqlite_paths, \
+    ChunkManifest, SchemaVersion
+from trade.executionwriter.sqlite import Connection, SqliteExecutionWriter, ThreadedSqliteExecutionWriter, \
+    convert_to_schema_v2, TimePartitioning, write_resumable, stitch_chunks
+from trade.log import get_logger
 from trade.model import Exchange, Symbol
 
+# 並列モードで、ワーカープロセス毎の中間チャンクを書き出す、出力先ディレクトリ内のディレクトリ
+PARALLEL_DIRECTORY = '.parallel'
+
 
 async def setup_sqlite_wrapper(logger: Logger, args: Namespace):
     args: Dict[str, Any] = vars(args)
@@ -23,6 +34,7 @@ async def setup_sqlite_wrapper(logger: Logger, args: Namespace):
 
     if not args['datetime_from'] or args['datetime_from'] == "''":
         args['datetime_from'] = np.datetime64('NaT')
+    args['schema_version'] = SchemaVersion(args['schema_version'])
 
     args['symbol'] = Symbol(args['symbol'])
     args['exchange'] = Exchange(args['exchange'])
@@ -37,6 +49,7 @@ async def setup_sqlite_synchronized_reduced_newprices_wrapper(logger: Logger, ar
 
     if not args['datetime_from'] or args['datetime_from'] == "''":
         args['datetime_from'] = np.datetime64('NaT')
+    args['schema_version'] = SchemaVersion(args['schema_version'])
 
     await setup_sqlite_synchronized_reduced_newprices(logger=logger, **args)
 
@@ -48,10 +61,36 @@ async def setup_sqlite_synchronized_reduced_ohlc_wrapper(logger: Logger, args: N
 
     if not args['datetime_from'] or args['datetime_from'] == "''":
         args['datetime_from'] = np.datetime64('NaT')
+    args['schema_version'] = SchemaVersion(args['schema_version'])
 
     await setup_sqlite_synchronized_reduced_ohlc(logger=logger, **args)
 
 
+async def convert_sqlite_to_schema_v2_wrapper(logger: Logger, args: Namespace):
+    args: Dict[str, Any] = vars(args)
+
+    del args['func']
+
+    await convert_sqlite_to_schema_v2(logger=logger, **args)
+
+
+def _build_writer(logger: Logger,
+                  connection: Connection,
+                  schema_version: SchemaVersion,
+                  bulk_load: bool,
+                  threaded_writer: bool,
+                  rotation_period: Optional[str],
+                  rotation_timezone: str) -> SqliteExecutionWriter:
+    writer_class = ThreadedSqliteExecutionWriter if threaded_writer else SqliteExecutionWriter
+    partitioning = rotation_period and TimePartitioning(
+        TimePartitioning.PERIODS[rotation_period], TimePartitioning.TIMEZONES[rotation_timezone]
+    ) or None
+    return writer_class(
+        logger=logger, connection=connection, schema_version=schema_version, bulk_load=bulk_load,
+        partitioning=partitioning
+    )
+
+
 async def setup_sqlite(
         logger: Logger,
         s3_bucket: str,
@@ -64,13 +103,42 @@ async def setup_sqlite(
         s3_key_prefix_day: Optional[int],
         destination_directory: str,
         datetime_from: np.datetime64,
+        schema_version: SchemaVersion = SchemaVersion.V1,
+        bulk_load: bool = False,
+        threaded_writer: bool = False,
+        rotation_period: Optional[str] = None,
+        rotation_timezone: str = 'UTC',
+        prefetch: int = 2,
+        prefetch_memory_budget: int = 512,
+        s3_cache_directory: Optional[str] = None,
+        s3_cache_max_size: int = 10 * 1024,
+        offline: bool = False,
+        list_concurrency: int = 8,
+        workers: int = 1,
 ):
+    """
+    `prefetch`が1以上の場合、取り込み中のS3オブジェクトに続く`prefetch`個のオブジェクトを並行してダウンロードします。
+    `prefetch_memory_budget` (MiB) は、先読みしたオブジェクトを保持するメモリの目安です。
+    `s3_cache_directory`が指定された場合、S3オブジェクトを`s3_cache_max_size` (MiB) までこのディレクトリに保存します。
+    `offline`がTrueの場合、S3にアクセスせず、このディレクトリに保存されたオブジェクトだけを取り込みます。
+    年、または年と月が指定され、`list_concurrency`が2以上の場合、S3 Keyを日毎に並行して一覧します。
+    `workers`が2以上の場合、S3 Keyを連続した範囲に分けて、ワーカープロセスで並列に取り込みます。
+    """
+    if offline and not s3_cache_directory:
+        raise ValueError('--offline requires --s3-cache-directory')
+    if workers > 1 and s3_cache_directory:
+        # S3Cacheのインデックスは、プロセス間で共有できません
+        raise ValueError('--workers cannot be used with --s3-cache-directory')
+    cache = s3_cache_directory and S3Cache(
+        logger, directory=s3_cache_directory, max_size=s3_cache_max_size * 1024 * 1024, offline=offline
+    ) or None
+
     if np.isnat(datetime_from):
         datetime_from: np.datetime64 = np.datetime64(datetime_from, 'ns', utc=True)
     logger.info(f'datetime_from: {datetime_from}')
 
     s3_key_prefix = build_s3_key_prefix(
-        logger=_logger,
+        logger=logger,
         symbol=symbol,
         exchange=exchange,
         channel=channel,
@@ -79,14 +147,124 @@ async def setup_sqlite(
         month=s3_key_prefix_month,
         day=s3_key_prefix_day,
     )
+    if s3_key_prefix_year and not s3_key_prefix_day and list_concurrency > 1:
+        s3_keys = list_s3_keys_by_day(
+            logger=logger, bucket=s3_bucket, symbol=symbol, exchange=exchange, channel=channel, version=version,
+            days=days_of(int(s3_key_prefix_year), s3_key_prefix_month and int(s3_key_prefix_month)),
+            datetime_from=datetime_from, concurrency=list_concurrency, cache=cache,
+        )
+    else:
+        s3_keys = list_s3_keys(
+            logger=logger, bucket=s3_bucket, s3_key_prefix=s3_key_prefix, datetime_from=datetime_from, cache=cache
+        )
+
+    writer_options = dict(
+        schema_version=schema_version, bulk_load=bulk_load, threaded_writer=threaded_writer,
+        rotation_period=rotation_period, rotation_timezone=rotation_timezone,
+    )
+    if workers > 1:
+        await _setup_sqlite_parallel(
+            logger, list(s3_keys), s3_bucket, symbol, exchange, destination_directory, writer_options, workers,
+            prefetch, prefetch_memory_budget,
+        )
+        return
+
     connection = Connection(basedir=destination_directory, exchange=exchange)
-    writer = SqliteExecutionWriter(logger=logger, connection=connection)
+    writer = _build_writer(logger, connection, **writer_options)
+    try:
+        await _ingest_s3_keys(
+            logger, writer, connection, s3_keys, s3_bucket, symbol, prefetch, prefetch_memory_budget, cache
+        )
+    finally:
+        if cache is not None:
+            cache.close()
+
+
+async def _ingest_s3_keys(logger: Logger,
+                          writer: SqliteExecutionWriter,
+                          connection: Connection,
+                          s3_keys: Iterable[str],
+                          s3_bucket: str,
+                          symbol: Symbol,
+                          prefetch: int,
+                          prefetch_memory_budget: int,
+                          cache: Optional[S3Cache]):
+    # キー毎にコミットしてジャーナルへ記録するため、中断しても同じ引数で再実行すれば続きから取り込みます
+    if not prefetch:
+        await write_resumable(
+            logger, writer, connection, keys=s3_keys,
+            open_stream=lambda s3_key: S3Stream(logger, bucket=s3_bucket, key=s3_key, symbol=symbol, cache=cache),
+        )
+        return
 
-    for s3_key in list_s3_keys(
-            logger=logger, bucket=s3_bucket, s3_key_prefix=s3_key_prefix, datetime_from=datetime_from
-    ):
-        s3_stream = S3Stream(logger, bucket=s3_bucket, key=s3_key, symbol=symbol)
-        await writer.write(iterable=s3_stream)
+    prefetcher = S3Prefetcher(
+        logger, bucket=s3_bucket, keys=s3_keys, symbol=symbol,
+        prefetch=prefetch, memory_budget=prefetch_memory_budget * 1024 * 1024, cache=cache,
+    )
+    try:
+        await write_resumable(logger, writer, connection, keys=prefetcher.keys, open_stream=prefetcher.open)
+    finally:
+        prefetcher.close()
+
+
+async def _setup_sqlite_parallel(logger: Logger,
+                                 s3_keys: List[str],
+                                 s3_bucket: str,
+                                 symbol: Symbol,
+                                 exchange: Exchange,
+                                 destination_directory: str,
+                                 writer_options: Dict[str, Any],
+                                 workers: int,
+                                 prefetch: int,
+                                 prefetch_memory_budget: int):
+    """
+    S3 Keyを`workers`個の連続した範囲に分けて、ワーカープロセス毎の中間ディレクトリへ取り込み、
+    stitch_chunksでidの順に出力先ディレクトリへ移動します。
+
+    各ワーカーはIngestionJournalで進捗を記録するため、中断しても同じ引数で再実行すれば続きから取り込みます。
+    """
+    parts: List[List[str]] = [part.tolist() for part in np.array_split(np.array(s3_keys, dtype=object), workers)]
+    part_directories = [
+        os.path.join(destination_directory, PARALLEL_DIRECTORY, f'part-{n:03}') for n, part in enumerate(parts) if part
+    ]
+    logger.info(f'keys: {len(s3_keys)}, workers: {len(part_directories)}')
+
+    loop = asyncio.get_running_loop()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        await asyncio.gather(*[
+            loop.run_in_executor(pool, functools.partial(
+                _ingest_s3_keys_part, part_directory, part, s3_bucket, symbol, exchange, writer_options,
+                prefetch, prefetch_memory_budget,
+            ))
+            for part_directory, part in zip(part_directories, [part for part in parts if part])
+        ])
+
+    stitched = stitch_chunks(logger, part_directories, destination_directory)
+    logger.info(f'stitched chunks: {len(stitched)}')
+    os.rmdir(os.path.join(destination_directory, PARALLEL_DIRECTORY))
+
+
+def _ingest_s3_keys_part(part_directory: str,
+                         s3_keys: List[str],
+                         s3_bucket: str,
+                         symbol: Symbol,
+                         exchange: Exchange,
+                         writer_options: Dict[str, Any],
+                         prefetch: int,
+                         prefetch_memory_budget: int):
+    """
+    ワーカープロセスで、S3 Keyの範囲を`part_directory`へ取り込み、最後の一時ファイルもチャンクとして閉じます。
+    """
+    logger = get_logger(
+        f'setup-sqlite.{os.path.basename(part_directory)}', stream=sys.stdout,
+        _format='%(asctime)s:%(levelname)s:%(name)s:%(message)s'
+    )
+    connection = Connection(basedir=part_directory, exchange=exchange)
+    writer = _build_writer(logger, connection, **writer_options)
+    asyncio.run(_ingest_s3_keys(
+        logger, writer, connection, s3_keys, s3_bucket, symbol, prefetch, prefetch_memory_budget, cache=None
+    ))
+    writer.close()
 
 
 async def setup_sqlite_synchronized_reduced_newprices(
@@ -96,18 +274,25 @@ async def setup_sqlite_synchronized_reduced_newprices(
         secondary_directory: str,
         destination_directory: str,
         datetime_from: np.datetime64,
+        schema_version: SchemaVersion = SchemaVersion.V1,
+        bulk_load: bool = False,
+        threaded_writer: bool = False,
+        rotation_period: Optional[str] = None,
+        rotation_timezone: str = 'UTC',
 ):
     if np.isnat(datetime_from):
         datetime_from: np.datetime64 = np.datetime64(datetime_from, 'ns', utc=True)
     logger.info(f'datetime_from: {datetime_from}')
 
-    primary_iterables: List[AsyncIterable[Execution]] = list()
-    for primary_con in list_sqlite_connections(path=primary_directory, datetime_from=datetime_from):
-        primary_iterables.append(SqliteStreamReader(logger=logger, connection=primary_con))
-
-    secondary_iterables: List[AsyncIterable[Execution]] = list()
-    for secondary_con in list_sqlite_connections(path=secondary_directory, datetime_from=datetime_from):
-        secondary_iterables.append(SqliteStreamReader(logger=logger, connection=secondary_con))
+    # 接続は、ChainedStreamが各upstreamを消費する時に開かれます
+    primary_iterables: Iterable[AsyncIterable[Execution]] = (
+        SqliteStreamReader(logger=logger, connection=primary_con)
+        for primary_con in list_sqlite_connections(path=primary_directory, datetime_from=datetime_from)
+    )
+    secondary_iterables: Iterable[AsyncIterable[Execution]] = (
+        SqliteStreamReader(logger=logger, connection=secondary_con)
+        for secondary_con in list_sqlite_connections(path=secondary_directory, datetime_from=datetime_from)
+    )
 
     primary_stream: AsyncIterable[Execution] = NewPricesStream(
         logger=logger, time_window=time_window,
@@ -130,12 +315,15 @@ async def setup_sqlite_synchronized_reduced_newprices(
 
     write_con = Connection(basedir=destination_directory, exchange=Exchange.bitFlyer)
 
-    await SqliteExecutionWriter(logger=logger, connection=write_con).write(
+    writer = _build_writer(
+        logger, write_con, schema_version, bulk_load, threaded_writer, rotation_period, rotation_timezone
+    )
+    await writer.write(
         SynchronizedStream(
             logger=logger, primary_iterable=primary_stream, secondary_iterable=secondary_stream
         )
     )
-    write_con.close()
+    writer.close()
 
 
 async def setup_sqlite_synchronized_reduced_ohlc(
@@ -144,14 +332,20 @@ async def setup_sqlite_synchronized_reduced_ohlc(
         source_directory: str,
         destination_directory: str,
         datetime_from: np.datetime64,
+        schema_version: SchemaVersion = SchemaVersion.V1,
+        bulk_load: bool = False,
+        threaded_writer: bool = False,
+        rotation_period: Optional[str] = None,
+        rotation_timezone: str = 'UTC',
 ):
     if np.isnat(datetime_from):
         datetime_from: np.datetime64 = np.datetime64(datetime_from, 'ns', utc=True)
     logger.info(f'datetime_from: {datetime_from}')
 
-    source_iterables: List[AsyncIterable[Execution]] = list()
-    for con in list_sqlite_connections(path=source_directory, datetime_from=datetime_from):
-        source_iterables.append(SqliteStreamReader(logger, connection=con))
+    source_iterables: Iterable[AsyncIterable[Execution]] = (
+        SqliteStreamReader(logger, connection=con)
+        for con in list_sqlite_connections(path=source_directory, datetime_from=datetime_from)
+    )
 
     reduced_stream: AsyncIterable[Execution] = OHLCStream(
         logger=logger, time_window=time_window,
@@ -167,15 +361,54 @@ async def setup_sqlite_synchronized_reduced_ohlc(
 
     write_con = Connection(basedir=destination_directory, exchange=Exchange.bitFlyer)
 
-    await SqliteExecutionWriter(logger=logger, connection=write_con).write(
+    writer = _build_writer(
+        logger, write_con, schema_version, bulk_load, threaded_writer, rotation_period, rotation_timezone
+    )
+    await writer.write(
         iterable=reduced_stream
     )
-    write_con.close()
+    writer.close()
 
 
-if __name__ == '__main__':
-    from trade.log import get_logger
+async def convert_sqlite_to_schema_v2(
+        logger: Logger,
+        source_directory: str,
+        destination_directory: str,
+):
+    """
+    スキーマV1のSQLiteデータベースファイルを、同じファイル名のスキーマV2のファイルへ変換します。
+    """
+    if not os.path.exists(destination_directory):
+        os.makedirs(destination_directory)
+
+    for source_path in list_sqlite_paths(source_directory):
+        destination_path = os.path.join(destination_directory, os.path.basename(source_path))
+        source = sqlite3.Connection(source_path)
+        destination = sqlite3.Connection(destination_path)
+        try:
+            ignored = convert_to_schema_v2(source, destination)
+        finally:
+            source.close()
+            destination.close()
+        if ignored:
+            logger.warning(f'ignored rows of duplicate id: {ignored}, file: {os.path.basename(source_path)}')
+        logger.info(f'converted: {os.path.basename(source_path)}')
+
+    ChunkManifest.build(destination_directory).save(destination_directory)
+
+
+def _add_writer_arguments(parser: ArgumentParser):
+    parser.add_argument('--schema-version', type=int, default=SchemaVersion.V1.value)
+    parser.add_argument('--bulk-load', action='store_true',
+                        help='ジャーナルと同期を無効にして書き出します。中断後の再開は保証されません')
+    parser.add_argument('--threaded-writer', action='store_true')
+    parser.add_argument('--rotation-period', choices=list(TimePartitioning.PERIODS), default=None,
+                        help='指定された場合、この時間の境界でもファイルを分割します')
+    parser.add_argument('--rotation-timezone', choices=list(TimePartitioning.TIMEZONES), default='UTC',
+                        help='--rotation-period の境界を決めるタイムゾーン')
+
 
+if __name__ == '__main__':
     _logger = get_logger(__name__, stream=sys.stdout, _format='%(asctime)s:%(levelname)s:%(message)s')
 
     _p = ArgumentParser()
@@ -192,6 +425,21 @@ if __name__ == '__main__':
     _p_setup_sqlite.add_argument('--s3-key-prefix-day', default=None)
     _p_setup_sqlite.add_argument('--datetime-from', default=None)
     _p_setup_sqlite.add_argument('--destination-directory')
+    _p_setup_sqlite.add_argument('--prefetch', type=int, default=2,
+                                 help='並行してダウンロードする、続くS3オブジェクトの数。0の場合は先読みしません')
+    _p_setup_sqlite.add_argument('--prefetch-memory-budget', type=int, default=512,
+                                 help='先読みしたS3オブジェクトを保持するメモリの目安 (MiB)')
+    _p_setup_sqlite.add_argument('--s3-cache-directory', default=None,
+                                 help='指定された場合、S3オブジェクトをこのディレクトリに保存し、次回から再利用します')
+    _p_setup_sqlite.add_argument('--s3-cache-max-size', type=int, default=10 * 1024,
+                                 help='保存するS3オブジェクトの合計の上限 (MiB)。超えた場合は最も長く使われていないものから削除します')
+    _p_setup_sqlite.add_argument('--list-concurrency', type=int, default=8,
+                                 help='--s3-key-prefix-day が無い場合に、日毎のS3 Keyの一覧を並行して取得する数')
+    _p_setup_sqlite.add_argument('--workers', type=int, default=1,
+                                 help='2以上の場合、S3 Keyを分けてワーカープロセスで並列に取り込みます')
+    _p_setup_sqlite.add_argument('--offline', action='store_true',
+                                 help='S3にアクセスせず、--s3-cache-directory に保存されたオブジェクトだけを取り込みます')
+    _add_writer_arguments(_p_setup_sqlite)
     _p_setup_sqlite.set_defaults(func=setup_sqlite_wrapper)
 
     _p_setup_reduced_newprices = _subparsers.add_parser('setup-reduced-newprices')
@@ -200,6 +448,7 @@ if __name__ == '__main__':
     _p_setup_reduced_newprices.add_argument('--secondary-directory')
     _p_setup_reduced_newprices.add_argument('--destination-directory')
     _p_setup_reduced_newprices.add_argument('--datetime-from', default=None)
+    _add_writer_arguments(_p_setup_reduced_newprices)
     _p_setup_reduced_newprices.set_defaults(func=setup_sqlite_synchronized_reduced_newprices_wrapper)
 
     _p_setup_reduced_ohlc = _subparsers.add_parser('setup-reduced-ohlc')
@@ -207,7 +456,13 @@ if __name__ == '__main__':
     _p_setup_reduced_ohlc.add_argument('--source-directory')
     _p_setup_reduced_ohlc.add_argument('--destination-directory')
     _p_setup_reduced_ohlc.add_argument('--datetime-from', default=None)
+    _add_writer_arguments(_p_setup_reduced_ohlc)
     _p_setup_reduced_ohlc.set_defaults(func=setup_sqlite_synchronized_reduced_ohlc_wrapper)
 
+    _p_convert_sqlite_v2 = _subparsers.add_parser('convert-sqlite-v2')
+    _p_convert_sqlite_v2.add_argument('--source-directory')
+    _p_convert_sqlite_v2.add_argument('--destination-directory')
+    _p_convert_sqlite_v2.set_defaults(func=convert_sqlite_to_schema_v2_wrapper)
+
     _args = _p.parse_args()
     asyncio.run(_args.func(logger=_logger, args=_args))
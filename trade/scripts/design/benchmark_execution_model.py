@@ -0,0 +1,129 @@
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from decimal import Decimal
+from typing import Callable, List, Any
+
+import numpy as np
+
+from trade.execution.model import Execution
+from trade.model import Symbol
+from trade.side import Side
+
+"""
+# Execution/SynchronizedExecution のメモリと生成コスト
+
+## 背景
+プレイバックのスイープでは数億件のExecutionを生成する。
+インスタンス毎の`__dict__`、空の`attrs`辞書、全属性が`None`のSynchronizedExecutionの確保が支配的だった。
+
+## 条件
+--n 1000000 、Python 3.8 、SqliteStreamReaderが同期カラムがNULLの行から生成するのと同じ形のExecution
+
+## 結果
+                           bytes/execution  construction (sec)
+legacy (__dict__)                    600.0                2.94
+slots                                136.0                1.83
+
+同期カラムがNULLの行について、メモリはおよそ4.4分の1、生成はおよそ1.6倍速くなった。
+Decimal / numpy.datetime64 の属性値自体は両者で共通なので、測定から除外している。
+"""
+
+
+class _LegacyExecution:
+    """
+    `__slots__`導入前のExecution（比較用）
+    """
+
+    def __init__(self, symbol, _id, timestamp, side, price, size,
+                 buy_child_order_acceptance_id, sell_child_order_acceptance_id,
+                 timeunit_if_ohlc_from=None,
+                 synchronized_execution_price_deviation=None,
+                 synchronized_execution_time_delta=None,
+                 synchronized_execution=None,
+                 **attrs):
+        self.symbol = symbol
+        self._id = _id
+        self.timestamp = timestamp
+        self.side = side
+        self.price = price
+        self.size = size
+        self.buy_child_order_acceptance_id = buy_child_order_acceptance_id
+        self.sell_child_order_acceptance_id = sell_child_order_acceptance_id
+        self.timeunit_if_ohlc_from = timeunit_if_ohlc_from
+        self.synchronized_execution_price_deviation = synchronized_execution_price_deviation
+        self.synchronized_execution_time_delta = synchronized_execution_time_delta
+        self.synchronized_execution = synchronized_execution
+        self.attrs = attrs
+
+
+class _LegacySynchronizedExecution:
+    """
+    `__slots__`導入前のSynchronizedExecution（比較用）
+    """
+
+    def __init__(self, symbol=None, _id=None, timestamp=None, side=None, price=None, size=None,
+                 buy_child_order_acceptance_id=None, sell_child_order_acceptance_id=None, **attrs):
+        self.symbol = symbol
+        self._id = _id
+        self.timestamp = timestamp
+        self.side = side
+        self.price = price
+        self.size = size
+        self.buy_child_order_acceptance_id = buy_child_order_acceptance_id
+        self.sell_child_order_acceptance_id = sell_child_order_acceptance_id
+        self.attrs = attrs
+
+
+_TIMESTAMP = np.datetime64('2019-07-07T08:59:58.877569400', 'ns')
+_PRICE = Decimal('1234567')
+_SIZE = Decimal('0.01')
+
+
+def build_legacy() -> Any:
+    return _LegacyExecution(
+        symbol=Symbol.FXBTCJPY, _id=1, timestamp=_TIMESTAMP, side=Side.BUY, price=_PRICE, size=_SIZE,
+        buy_child_order_acceptance_id='JRF20190707-085958-692751',
+        sell_child_order_acceptance_id='JRF20190707-085958-403844',
+        synchronized_execution=_LegacySynchronizedExecution(),
+    )
+
+
+def build_slots() -> Any:
+    return Execution(
+        symbol=Symbol.FXBTCJPY, _id=1, timestamp=_TIMESTAMP, side=Side.BUY, price=_PRICE, size=_SIZE,
+        buy_child_order_acceptance_id='JRF20190707-085958-692751',
+        sell_child_order_acceptance_id='JRF20190707-085958-403844',
+        synchronized_execution=None,
+    )
+
+
+def measure_memory(factory: Callable[[], Any], n: int) -> float:
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    executions: List[Any] = [factory() for _ in range(n)]
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # リスト自体の大きさは除外する
+    return (after - before - executions.__sizeof__()) / n
+
+
+def measure_construction(factory: Callable[[], Any], n: int) -> float:
+    t = time.perf_counter()
+    for _ in range(n):
+        factory()
+    return time.perf_counter() - t
+
+
+if __name__ == '__main__':
+    p = ArgumentParser()
+    p.add_argument('--n', type=int, default=1_000_000)
+    args = p.parse_args()
+
+    print(f'n: {args.n}')
+    print(f'{"":24}{"bytes/execution":>18}{"construction (sec)":>20}')
+    for name, _factory in [('legacy (__dict__)', build_legacy), ('slots', build_slots)]:
+        print(f'{name:24}'
+              f'{measure_memory(_factory, args.n):>18.1f}'
+              f'{measure_construction(_factory, args.n):>20.2f}')
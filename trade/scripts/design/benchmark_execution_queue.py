@@ -0,0 +1,139 @@
+import random
+import time
+from argparse import ArgumentParser
+from collections import deque
+from decimal import Decimal
+from functools import partial
+from typing import List, Deque, Callable
+
+import numpy as np
+import os
+import pandas as pd
+
+from trade.execution.model import Execution, SwitchedToRealtime
+from trade.execution.queue import TimeWindowExecutionQueue
+from trade.log import get_logger
+from trade.model import Symbol
+from trade.side import Side
+
+"""
+# TimeWindowExecutionQueue.put_nowait の挿入位置の探索と、古い要素の削除
+
+## 背景
+put_nowait は、挿入位置を右端から1件ずつ比較して探し (deque.insert) 、古い要素の削除ではdequeを先頭から走査していた。
+取引所のtimestampが前後した約定がまとめて届くと、遅れた約定毎に、それより新しい約定の数だけ比較が行われる。
+
+## 条件
+--n 300000 、平均10ms間隔の約定、--time-window 10min (保持期間内に約6万件) 、Python 3.8 、クライアントなし。
+in-order は遅れが無い場合。bursts は --burst 件の約定が、最大 --delay ms 遅れたtimestampを含んで、まとめて届く場合
+（各バーストで約定の1割が遅れる）。legacy は変更前の put_nowait と同じ処理。
+
+## 結果
+workload     mode          sec      puts/sec
+in-order     legacy       6.03        49,782
+in-order     bisect       2.58       116,261
+bursts       legacy      44.69         6,713
+bursts       bisect       2.83       105,877
+
+遅れの無い場合も、bisect はおよそ2.3倍速い。legacy の挿入位置は右端の1件との比較で決まるが、
+削除の判定で約定毎に numpy.datetime64 の減算と比較を行うためである。bisect はtimestampを一度だけナノ秒の整数にする。
+バーストでは、legacy は遅れた約定毎にそれより新しい数百件を比較するため、遅れの無い場合の7倍程度遅くなり、
+bisect は二分探索 (O(log n)) と list.insert のメモリ移動だけで済むので、遅れの有無でほとんど変わらない。
+測定のばらつきは約15%（同じ条件の別の測定では、bursts の legacy 39.18秒、bisect 2.13秒）。
+"""
+
+
+class _LegacyTimeWindowExecutionQueue:
+    """
+    変更前のTimeWindowExecutionQueueの、put_nowaitの挿入と削除（比較用）
+    """
+
+    def __init__(self, time_window: str):
+        self._time_window = pd.to_timedelta(time_window).to_timedelta64()
+        self._deque: Deque[Execution] = deque()
+
+    def put_nowait(self, execution: Execution):
+        if not self._deque:
+            self._deque.append(execution)
+
+        else:
+            idx = len(self._deque)
+            while 0 < idx:
+                left = self._deque[idx - 1]
+
+                if left.timestamp < execution.timestamp:
+                    self._deque.insert(idx, execution)
+                    break
+
+                if left.timestamp == execution.timestamp:
+                    self._deque.append(execution)
+                    break
+
+                idx -= 1
+            else:
+                self._deque.appendleft(execution)
+
+            n_pops = 0
+            most_right = self._deque[-1]
+            for n, deque_execution in enumerate(self._deque):
+                delta = most_right.timestamp - deque_execution.timestamp
+                if delta <= self._time_window:
+                    break
+                n_pops += 1
+            [self._deque.popleft() for _ in range(n_pops)]
+
+
+def build_executions(n: int, burst: int, delay_ms: int, seed: int = 0) -> List[Execution]:
+    """
+    到着順の約定を返します。`delay_ms`が0の場合は、timestampの順です。
+    """
+    _random = random.Random(seed)
+    start = np.datetime64('2019-07-07T08:59:58.877569400', 'ns')
+    offsets: List[int] = list()
+    t = 0
+    for _ in range(n):
+        t += _random.randint(1, 19)
+        offsets.append(t)
+
+    if delay_ms:
+        for begin in range(0, n, burst):
+            for i in range(begin, min(begin + burst, n)):
+                if _random.random() < 0.1:
+                    offsets[i] -= _random.randint(1, delay_ms)
+
+    return [Execution(
+        symbol=Symbol.FXBTCJPY, _id=i, timestamp=start + np.timedelta64(offset, 'ms'),
+        side=Side.BUY, price=Decimal('1000000'), size=Decimal('0.01'),
+        buy_child_order_acceptance_id='JRF20190707-085958-692751',
+        sell_child_order_acceptance_id='JRF20190707-085958-403844',
+    ) for i, offset in enumerate(offsets)]
+
+
+def measure(put_nowait: Callable[[Execution], None], executions: List[Execution]) -> float:
+    t = time.perf_counter()
+    for execution in executions:
+        put_nowait(execution)
+    return time.perf_counter() - t
+
+
+if __name__ == '__main__':
+    p = ArgumentParser()
+    p.add_argument('--n', type=int, default=300_000)
+    p.add_argument('--time-window', default='10min')
+    p.add_argument('--burst', type=int, default=2000)
+    p.add_argument('--delay', type=int, default=5000, help='遅れの最大 (ms)')
+    args = p.parse_args()
+
+    _logger = get_logger(__name__, stream=open(os.devnull, 'w'))
+
+    print(f'{"workload":13}{"mode":8}{"sec":>9}{"puts/sec":>14}')
+    for workload, delay in [('in-order', 0), ('bursts', args.delay)]:
+        _executions = build_executions(args.n, args.burst, delay)
+        for mode, q in [
+            ('legacy', _LegacyTimeWindowExecutionQueue(args.time_window)),
+            ('bisect', TimeWindowExecutionQueue(
+                _logger, args.time_window, partial(SwitchedToRealtime, symbol=Symbol.FXBTCJPY)
+            )),
+        ]:
+            sec = measure(q.put_nowait, _executions)
+            print(f'{workload:13}{mode:8}{sec:>9.2f}{args.n / sec:>14,.0f}')
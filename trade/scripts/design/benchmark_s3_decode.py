@@ -0,0 +1,146 @@
+import asyncio
+import json
+import lzma
+import os
+import random
+import time
+from argparse import ArgumentParser
+from io import BytesIO
+from typing import List, Tuple, AsyncIterable, Any, AsyncIterator
+
+from botocore.response import StreamingBody
+
+from trade.execution.model import Execution
+from trade.execution.stream.s3 import S3Stream, S3BatchStream
+from trade.log import get_logger
+from trade.model import Symbol
+
+"""
+# S3Stream のバイト列による読み飛ばしと、S3BatchStream の列単位の変換
+
+## 背景
+S3Stream は全ての行をstrにデコードしてから約定のチャネルかを調べ、約定の行毎に json.loads を呼び、
+Execution.encode_bitflyer_response (約定毎の np.datetime64 と Decimal(str(...))) でExecutionを生成していた。
+
+## 条件
+--lines 200000 、Python 3.8 、標準のjson (orjsonは未導入) 、メモリ上のxzログ (伸長を含む) 。
+合成ログの3分の2は0-4段の差分の板の行、3分の1は1-3件の約定の行（平均2件）。
+decompress は伸長だけの時間（下限）、legacy は変更前の S3Stream と同じ処理。
+
+## 結果
+mode              sec      lines/sec   executions/sec
+decompress       0.81        246,531          164,414
+legacy           2.40         83,502           55,689
+bytes            2.09         95,667           63,801
+batch            1.64        121,980           81,349
+
+bytes (S3Stream) は板の行を行に分割せずに読み飛ばし、ブロック内の約定の行をひとつのJSON配列としてデコードするが、
+約定毎のencode_bitflyer_responseが残るため、改善は15%程度にとどまる。
+batch (S3BatchStream) はタイムスタンプ、価格、サイズを列単位で変換し、legacy のおよそ1.5倍速い。
+残りの時間の約半分はxzの伸長で、これはデコードの方法では減らせない。
+測定のばらつきは約20%（同じ条件の別の測定では、legacy 2.99秒、bytes 2.60秒、batch 1.95秒）。
+orjsonが導入されている環境では、JSONのデコード (batch の時間の約4分の1) がさらに速くなる。
+"""
+
+
+def build_log(lines: int, seed: int = 0) -> Tuple[bytes, int]:
+    """
+    合成したxzログと、それに含まれる約定の件数を返します。
+    """
+    _random = random.Random(seed)
+    buf: List[str] = list()
+    _id, executions = 620220851, 0
+    for n in range(lines):
+        if n % 3:
+            buf.append(json.dumps({
+                'channel': 'lightning_board_FX_BTC_JPY',
+                'message': {'mid_price': 445899, **{side: [
+                    {'price': 445893 + _random.randint(-500, 500), 'size': round(_random.uniform(0, 10), 8)}
+                    for _ in range(_random.randint(0, 4))
+                ] for side in ('bids', 'asks')}},
+            }))
+            continue
+
+        messages = list()
+        for _ in range(_random.randint(1, 3)):
+            _id += 1
+            messages.append({
+                'id': _id, 'side': _random.choice(['BUY', 'SELL']), 'price': 445893 + _random.randint(0, 100),
+                'size': round(_random.uniform(0.01, 1), 8),
+                'exec_date': f'2018-12-04T09:{n // 60000 % 60:02}:{n // 1000 % 60:02}'
+                             f'.{_random.randint(0, 9999999):07}Z',
+                'buy_child_order_acceptance_id': 'JRF20181204-091751-414757',
+                'sell_child_order_acceptance_id': 'JRF20181204-092312-922802',
+            })
+        executions += len(messages)
+        buf.append(json.dumps({'channel': 'lightning_executions_FX_BTC_JPY', 'message': messages}))
+    return lzma.compress('\n'.join(buf).encode('utf-8')), executions
+
+
+def _body(compressed: bytes) -> StreamingBody:
+    return StreamingBody(BytesIO(compressed), len(compressed))
+
+
+async def decompress(compressed: bytes) -> int:
+    lzma.decompress(compressed)
+    return _executions
+
+
+class _LegacyS3Stream(AsyncIterable[Execution]):
+    """
+    変更前のS3Stream（比較用）
+    """
+
+    def __init__(self, compressed: bytes):
+        self._compressed = compressed
+
+    async def __aiter__(self) -> AsyncIterator[Execution]:
+        binary = lzma.decompress(self._compressed)
+
+        for line in [line.decode('utf-8') for line in binary.splitlines()]:
+            if 'lightning_executions_' not in line:
+                continue
+            _json = json.loads(line)
+            for message in _json['message']:
+                execution = Execution.encode_bitflyer_response(symbol=Symbol.FXBTCJPY, dictobj=message)
+                yield execution
+
+
+async def legacy(compressed: bytes) -> int:
+    return await _count(_LegacyS3Stream(compressed))
+
+
+async def stream(compressed: bytes) -> int:
+    return await _count(S3Stream(_logger, 'bucket', 'key', Symbol.FXBTCJPY, body=_body(compressed)))
+
+
+async def batch(compressed: bytes) -> int:
+    n = 0
+    async for b in S3BatchStream(_logger, 'bucket', 'key', Symbol.FXBTCJPY, body=_body(compressed)):
+        n += len(b)
+    return n
+
+
+async def _count(iterable: AsyncIterable[Any]) -> int:
+    n = 0
+    async for _ in iterable:
+        n += 1
+    return n
+
+
+_logger = get_logger(__name__, stream=open(os.devnull, 'w'))
+
+if __name__ == '__main__':
+    p = ArgumentParser()
+    p.add_argument('--lines', type=int, default=200_000)
+    args = p.parse_args()
+
+    _compressed, _executions = build_log(args.lines)
+
+    print(f'{"mode":12}{"sec":>9}{"lines/sec":>15}{"executions/sec":>17}')
+    for name, measure in [('decompress', decompress), ('legacy', legacy), ('bytes', stream), ('batch', batch)]:
+        t = time.perf_counter()
+        count = asyncio.run(measure(_compressed))
+        sec = time.perf_counter() - t
+        assert count == _executions, (name, count, _executions)
+        print(f'{name:12}{sec:>9.2f}{args.lines / sec:>15,.0f}{count / sec:>17,.0f}')
@@ -0,0 +1,101 @@
+import asyncio
+import math
+import os
+import tempfile
+import time
+from argparse import ArgumentParser
+from typing import Optional, List, AsyncIterator, AsyncIterable, Tuple
+
+from trade.execution.model import Execution
+from trade.execution.stream.sqlite import SchemaVersion
+from trade.executionwriter.sqlite import SqliteExecutionWriter, Connection
+from trade.log import get_logger
+from trade.model import Exchange
+from trade.scripts.design.benchmark_sqlite_projection import _SyntheticExecutions
+
+"""
+# SqliteExecutionWriter のバルクロードモード
+
+## 背景
+dataset.py setup-sqlite による1か月分のS3ログの取り込みは、一時ファイルへの書き出しが律速と考えられていた。
+既定のPRAGMAでは、ページキャッシュ (2MiB) があふれる度にロールバックジャーナルが同期され、
+インデックスは行の挿入毎に更新される。
+
+## 条件
+--n 1000000 --records-rotation 250000 、Python 3.8 、ext4上の一時ディレクトリ (fsync 約0.1ms) 、
+半数の行に同期された約定を持つ合成データ（benchmark_sqlite_projection と同じ）を事前に生成し、
+Execution のタプルへの変換を含むライター全体を測定。written MiB は /proc/self/io の wchar 。
+
+## 結果
+mode          schema       sec      rows/sec   written MiB
+default       v1         19.96        50,107           233
+bulk          v1         19.21        52,056           226
+default       v2         21.41        46,697           164
+bulk          v2         21.07        47,460           158
+
+このディスクでは、バルクロードモードの改善は2-4%程度で、測定のばらつき (約10%) の範囲に収まった。
+ライターはチャンク毎に一度しかコミットせず、新しいページはジャーナルに書かれないため、既定のPRAGMAでも
+fsyncの回数とジャーナルへの書き込みは少ない。時間の大部分は、Execution のタプルへの変換と sqlite3 の
+バインドおよびB-treeの更新が占める。fsyncの遅いストレージ（ネットワークストレージなど）では差が大きくなり得るため、
+--basedir でそのディスク上を指定して測定すること。
+"""
+
+
+class _ListIterable(AsyncIterable[Execution]):
+
+    def __init__(self, executions: List[Execution]):
+        self._executions = executions
+
+    async def __aiter__(self) -> AsyncIterator[Execution]:
+        for execution in self._executions:
+            yield execution
+
+
+async def generate(n: int) -> List[Execution]:
+    return [e async for e in _SyntheticExecutions(n)]
+
+
+def written_bytes() -> float:
+    """
+    このプロセスがwrite(2)したバイト数。/proc/self/io が無い環境ではNaNを返します。
+    """
+    try:
+        with open('/proc/self/io') as f:
+            return float(next(line for line in f if line.startswith('wchar:')).split()[1])
+    except OSError:
+        return float('nan')
+
+
+async def measure(basedir: str, executions: List[Execution], records_rotation: int, schema_version: SchemaVersion,
+                  bulk_load: bool) -> Tuple[float, float]:
+    logger = get_logger(__name__, stream=open(os.devnull, 'w'))
+    writer = SqliteExecutionWriter(
+        logger, connection=Connection(basedir, exchange=Exchange.bitFlyer),
+        records_rotation=records_rotation, records_insertion=math.gcd(records_rotation, 100_000),
+        schema_version=schema_version, bulk_load=bulk_load,
+    )
+    t, written = time.perf_counter(), written_bytes()
+    await writer.write(_ListIterable(executions))
+    return time.perf_counter() - t, written_bytes() - written
+
+
+def main(basedir: Optional[str], n: int, records_rotation: int):
+    executions = asyncio.run(generate(n))
+
+    print(f'{"mode":14}{"schema":8}{"sec":>8}{"rows/sec":>14}{"written MiB":>14}')
+    for schema_version in SchemaVersion:
+        for bulk_load in (False, True):
+            with tempfile.TemporaryDirectory(dir=basedir) as tempdir:
+                sec, written = asyncio.run(measure(tempdir, executions, records_rotation, schema_version, bulk_load))
+            print(f'{"bulk" if bulk_load else "default":14}{schema_version.name.lower():8}'
+                  f'{sec:>8.2f}{n / sec:>14,.0f}{written / 2 ** 20:>14,.0f}')
+
+
+if __name__ == '__main__':
+    p = ArgumentParser()
+    p.add_argument('--basedir', default=None, help='一時ディレクトリを作成するディレクトリ。測定するディスク上を指定します')
+    p.add_argument('--n', type=int, default=1_000_000)
+    p.add_argument('--records-rotation', type=int, default=250_000)
+    args = p.parse_args()
+
+    main(args.basedir, args.n, args.records_rotation)
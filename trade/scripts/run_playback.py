@@ -2,18 +2,24 @@ import asyncio
 import sys
 from argparse import ArgumentParser
 from decimal import Decimal
+from functools import partial
 from logging import Logger
-from typing import AsyncIterable
+from typing import AsyncIterable, Optional
+
+import numpy as np
 
 from trade.broker.stub import stub_broker
 from trade.execution.model import Execution
-from trade.execution.stream.chain import ChainedStream
-from trade.execution.stream.sqlite import SqliteStreamReader, list_sqlite_connections
+from trade.execution.stream.adapter.batch import UnbatchStream
+from trade.execution.stream.chain import ChainedStream, ChainedBatchStream, ParallelChainedBatchStream
+from trade.execution.stream.sqlite import SqliteStreamReader, list_sqlite_connections, SqliteBatchStreamReader, \
+    Projection, ThreadedSqliteStreamReader, list_sqlite_paths, decode_sqlite_chunk
 from trade.log import get_logger
+from trade.model import Symbol, Precision
 from trade.strategy.stub import RandomDotenStrategy
 
 
-def playback_random_doten(logger: Logger, reader: AsyncIterable[Execution]):
+def playback_random_doten(logger: Logger, reader: AsyncIterable[Execution], precision: Optional[Precision] = None):
     time_window = '30minute'
     losscut = Decimal('-8000')
 
@@ -24,7 +30,8 @@ def playback_random_doten(logger: Logger, reader: AsyncIterable[Execution]):
             logger,
             time_window=time_window
         ),
-        losscut=losscut
+        losscut=losscut,
+        precision=precision
     ))
 
 
@@ -32,16 +39,68 @@ if __name__ == '__main__':
     _p = ArgumentParser()
     _p.add_argument('--strategy')
     _p.add_argument('--sqlite-basedir')
+    _p.add_argument('--batch-size', type=int, default=None,
+                    help='指定された場合、この行数ごとのExecutionBatchとしてデータベースを読み込みます')
+    _p.add_argument('--datetime-from', type=np.datetime64, default=None,
+                    help='指定された場合、この日時以降のExecutionだけを読み込みます')
+    _p.add_argument('--datetime-until', type=np.datetime64, default=None,
+                    help='指定された場合、この日時より前のExecutionだけを読み込みます')
+    _p.add_argument('--projection', choices=[p.value for p in Projection], default=Projection.SYNCHRONIZED.value,
+                    help='読み込むカラムの組。core は symbol, id, timestamp, side, price, size のみを読み込みます')
+    _p.add_argument('--parallel', type=int, default=None,
+                    help='指定された場合、この数のチャンクをワーカープロセスで先行してデコードします')
+    _p.add_argument('--prefetch', type=int, default=None,
+                    help='指定された場合、ワーカースレッドでデータベースを読み込み、この数のチャンクを先読みします')
+    _p.add_argument('--fixed-point', action='store_true',
+                    help='価格およびサイズを、固定小数点の整数として扱います (FXBTCJPYのみ)')
     _args = _p.parse_args()
 
     _logger = get_logger(__name__, _format='%(asctime)s:%(levelname)s:%(message)s', stream=sys.stdout)
-    _sqlite_connections = list_sqlite_connections(path=_args.sqlite_basedir, datetime_from=None)
-    _reader = ChainedStream(
-        _logger,
-        upstreams=[SqliteStreamReader(_logger, connection=c) for c in _sqlite_connections]
+    # 範囲と重なるデータベースだけを開き、範囲外の行はリーダーのWHERE句で除きます
+    _sqlite_connections = list_sqlite_connections(
+        path=_args.sqlite_basedir, datetime_from=_args.datetime_from, datetime_until=_args.datetime_until,
+        overlapping=True
+    )
+    _options = dict(
+        datetime_from=_args.datetime_from, datetime_until=_args.datetime_until, projection=Projection(_args.projection)
     )
+    if _args.parallel:
+        _reader = UnbatchStream(
+            _logger,
+            upstream=ParallelChainedBatchStream(
+                _logger,
+                tasks=[partial(decode_sqlite_chunk, _logger, p, batch_size=_args.batch_size or 10_000, **_options)
+                       for p in list_sqlite_paths(_args.sqlite_basedir, datetime_from=_args.datetime_from,
+                                                  datetime_until=_args.datetime_until, overlapping=True)],
+                lookahead=_args.parallel
+            ),
+            fixed_point=_args.fixed_point
+        )
+    elif _args.batch_size:
+        _reader = UnbatchStream(
+            _logger,
+            upstream=ChainedBatchStream(
+                _logger,
+                upstreams=(SqliteBatchStreamReader(_logger, connection=c, batch_size=_args.batch_size, **_options)
+                           for c in _sqlite_connections)
+            ),
+            fixed_point=_args.fixed_point
+        )
+    elif _args.prefetch:
+        _reader = ChainedStream(
+            _logger,
+            upstreams=(ThreadedSqliteStreamReader(_logger, connection=c, prefetch=_args.prefetch,
+                                                  fixed_point=_args.fixed_point, **_options)
+                       for c in _sqlite_connections)
+        )
+    else:
+        _reader = ChainedStream(
+            _logger,
+            upstreams=(SqliteStreamReader(_logger, connection=c, fixed_point=_args.fixed_point, **_options)
+                       for c in _sqlite_connections)
+        )
 
     if _args.strategy == 'random':
-        playback_random_doten(_logger, _reader)
+        playback_random_doten(_logger, _reader, precision=_args.fixed_point and Precision.of(Symbol.FXBTCJPY) or None)
     else:
         _p.error(_p.format_usage())
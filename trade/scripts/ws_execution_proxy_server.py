@@ -1,15 +1,19 @@
 import asyncio
 import sys
 from argparse import ArgumentParser
+from dataclasses import dataclass
 from functools import partial
 from json import dumps, loads
 from logging import Logger
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Union, List, Tuple
+from urllib.parse import urlparse, parse_qs
 
 import websockets
 
 from trade.execution.model import encode_bitflyer_channel, Execution, SwitchedToRealtime
-from trade.execution.queue import TimeWindowExecutionQueue
+from trade.execution.protocol import encode_control_frame, encode_batch_frame, BATCH_SIZE_PARAMETER, \
+    ENCODING_PARAMETER, ACCEPTANCE_IDS_PARAMETER, Encoding, encode_binary_record, encode_binary_frame
+from trade.execution.queue import TimeWindowExecutionQueue, SlowConsumerPolicy, SlowConsumerError
 from trade.log import get_logger
 from trade.model import Symbol
 
@@ -18,7 +22,14 @@ class WarmUpExecutionWebSocketProxyServer:
     """
     保持期間付きの、約定配信WebSocketプロキシサーバ
 
-    `RealtimeWebSocketStream`が購読できるJSON形式で配信します。
+    `RealtimeWebSocketStream`が購読できるJSON形式で配信します。フレーム形式は`trade.execution.protocol`を参照してください。
+
+    `max_depth`が指定された場合、未取得の約定数がこれを超えたクライアントは`slow_consumer_policy`に従って扱われます。
+    クライアントは、接続するパスのクエリ (例: `/?max_depth=1000&policy=conflate`) でこれらを上書きできます。
+    クエリで`batch_size`を指定したクライアントには、最大その件数の約定をひとつのフレームで送ります。
+    クエリで`encoding=binary`を指定したクライアントには、約定をバイナリのフレームで送ります。
+    `send_timeout` (秒) 以内に送信が完了しないクライアントは、切断されます。
+    `stats_interval` (秒) 毎に、クライアント毎の未取得の約定数と捨てた約定数をログに出力します。
     """
 
     _q: TimeWindowExecutionQueue
@@ -28,15 +39,23 @@ class WarmUpExecutionWebSocketProxyServer:
                  warm_up_window: str,
                  switched_to_realtime_partial: partial,
                  host='localhost',
-                 port=8765):
+                 port=8765,
+                 max_depth: Optional[int] = None,
+                 slow_consumer_policy: SlowConsumerPolicy = SlowConsumerPolicy.DISCONNECT,
+                 send_timeout: Optional[float] = None,
+                 stats_interval: Optional[float] = 60):
         self._logger = logger
         self._warm_up_window = warm_up_window
         self._host = host
         self._port = port
+        self._send_timeout = send_timeout
+        self._stats_interval = stats_interval
         self._q: 'TimeWindowExecutionQueue[Execution]' = TimeWindowExecutionQueue(
             logger=self._logger,
             time_window=self._warm_up_window,
-            switched_to_realtime_partial=switched_to_realtime_partial
+            switched_to_realtime_partial=switched_to_realtime_partial,
+            max_depth=max_depth,
+            slow_consumer_policy=slow_consumer_policy,
         )
 
     def start(self):
@@ -47,9 +66,19 @@ class WarmUpExecutionWebSocketProxyServer:
 
         await asyncio.gather(
             asyncio.create_task(self._proxying()),
+            asyncio.create_task(self._reporting()),
             websockets.serve(self._handle_client, self._host, self._port),
         )
 
+    async def _reporting(self):
+        if not self._stats_interval:
+            return
+
+        while True:
+            await asyncio.sleep(self._stats_interval)
+            for client_key, stats in self._q.client_stats().items():
+                self._logger.info(f'client: {client_key}, depth: {stats.depth}, dropped: {stats.dropped}')
+
     async def _proxying(self):
         uri = 'wss://ws.lightstream.bitflyer.com/json-rpc'
 
@@ -78,30 +107,102 @@ class WarmUpExecutionWebSocketProxyServer:
         client_key = ws.request_headers['Sec-WebSocket-Key']
         self._logger.info(f'got client key: {client_key}')
 
-        self._q.spawn_queue(client_key)
-        self._logger.info(f'spawned queue for client: {client_key}, n-execution: {self._q.execution_count()}')
+        options = _ClientOptions.parse(path)
+        self._q.spawn_queue(client_key, max_depth=options.max_depth, slow_consumer_policy=options.slow_consumer_policy)
+        self._logger.info(f'spawned queue for client: {client_key}, n-execution: {self._q.execution_count()}, '
+                          f'options: {options}')
 
-        while True:
-            execution = await self._q.get(client_key)
+        try:
+            while True:
+                executions = await self._q.get_batch(client_key, options.batch_size or 1)
+
+                if isinstance(executions[0], SwitchedToRealtime):
+                    await self._send(ws, encode_control_frame(executions[0]))
+                    continue
+
+                if options.encoding == Encoding.BINARY:
+                    await self._send(ws, _encode_binary_frame(executions, options.acceptance_ids))
+                    continue
+
+                raw_responses = [e.attrs['raw_response'] for e in executions if 'raw_response' in e.attrs]
+                if not raw_responses:
+                    continue
+
+                if options.batch_size:
+                    await self._send(ws, encode_batch_frame(raw_responses))
+                else:
+                    await self._send(ws, raw_responses[0])
+
+        except websockets.exceptions.ConnectionClosed:
+            self._logger.info(f'could not send execution to the client: {client_key}')
+
+        except (SlowConsumerError, asyncio.TimeoutError) as e:
+            self._logger.warning(f'disconnecting slow client: {client_key}, {e.__class__.__name__}')
+            # 送信の途中で中断した接続は、終了のハンドシェイクを待たずに閉じる
+            ws.fail_connection(code=1008, reason='slow consumer')
 
-            if isinstance(execution, SwitchedToRealtime):
-                await ws.send(repr(execution))
-                continue
+        finally:
+            self._logger.info(f'disposing spawned queue...: {client_key}, stats: {self._q.client_stats()[client_key]}')
+            self._q.dispose_queue(client_key)
+            self._logger.info(f'successfully finished to dispose spawned queue: {client_key}')
+            self._logger.info(f'number of remaining spawned queues: {self._q.spawned_queue_count()}')
 
-            if 'raw_response' in execution.attrs:
-                try:
-                    await ws.send(execution.attrs['raw_response'])
+    async def _send(self, ws: websockets.WebSocketServerProtocol, frame: Union[str, bytes]):
+        if self._send_timeout is None:
+            await ws.send(frame)
+        else:
+            await asyncio.wait_for(ws.send(frame), self._send_timeout)
 
-                except websockets.exceptions.ConnectionClosedError as e:
-                    self._logger.info(
-                        f'could not send execution to the client, disposing spawned queue...: {client_key}'
-                    )
 
-                    self._q.dispose_queue(client_key)
-                    self._logger.info(f'successfully finished to dispose spawned queue: {client_key}')
-                    self._logger.info(f'number of remaining spawned queues: {self._q.spawned_queue_count()}')
+@dataclass
+class _ClientOptions:
+    """
+    クライアントが接続したパスのクエリで指定する、クライアント毎の設定
+    """
+
+    # 指定されない場合、サーバの設定が使われます
+    max_depth: Optional[int] = None
+    slow_consumer_policy: Optional[SlowConsumerPolicy] = None
+
+    # 指定された場合、最大この件数の約定をひとつのバッチのフレームで送ります
+    batch_size: Optional[int] = None
+
+    encoding: Encoding = Encoding.JSON
+
+    # バイナリのフレームにacceptance idを含めるか
+    acceptance_ids: bool = True
 
-                    return
+    @staticmethod
+    def parse(path: str) -> '_ClientOptions':
+        query = parse_qs(urlparse(path).query)
+        options = _ClientOptions()
+        if 'max_depth' in query:
+            options.max_depth = int(query['max_depth'][-1])
+        if 'policy' in query:
+            options.slow_consumer_policy = SlowConsumerPolicy(query['policy'][-1])
+        if BATCH_SIZE_PARAMETER in query:
+            options.batch_size = int(query[BATCH_SIZE_PARAMETER][-1])
+        if ENCODING_PARAMETER in query:
+            options.encoding = Encoding(query[ENCODING_PARAMETER][-1])
+        if ACCEPTANCE_IDS_PARAMETER in query:
+            options.acceptance_ids = query[ACCEPTANCE_IDS_PARAMETER][-1] != '0'
+        return options
+
+
+def _encode_binary_frame(executions: List[Execution], acceptance_ids: bool) -> bytes:
+    """
+    約定をバイナリのフレームに変換します。約定毎のレコードは`attrs`に保持され、他のクライアントへの送信で再利用されます。
+    """
+    parts: List[Tuple[bytes, bytes]] = list()
+    for execution in executions:
+        part = execution.attrs.get('binary_record')
+        if part is None:
+            part = execution.attrs['binary_record'] = encode_binary_record(execution)
+        parts.append(part)
+
+    return encode_binary_frame(
+        [record for record, _ in parts], [ids for _, ids in parts] if acceptance_ids else None
+    )
 
 
 if __name__ == '__main__':
@@ -110,6 +211,12 @@ if __name__ == '__main__':
     _p.add_argument('--symbol')
     _p.add_argument('--host')
     _p.add_argument('--port')
+    _p.add_argument('--max-depth', type=int, default=None,
+                    help='クライアント毎の未取得の約定数の上限。省略した場合は上限なし')
+    _p.add_argument('--slow-consumer-policy', choices=[policy.value for policy in SlowConsumerPolicy],
+                    default=SlowConsumerPolicy.DISCONNECT.value)
+    _p.add_argument('--send-timeout', type=float, default=None, help='送信のタイムアウト (秒)')
+    _p.add_argument('--stats-interval', type=float, default=60, help='クライアント毎の統計を出力する間隔 (秒)')
     _args = _p.parse_args()
 
     _logger = get_logger(__name__, _format='%(asctime)s:%(levelname)s:%(message)s', stream=sys.stdout)
@@ -120,5 +227,9 @@ if __name__ == '__main__':
         switched_to_realtime_partial=partial(SwitchedToRealtime, symbol=Symbol(_args.symbol)),
         host=_args.host,
         port=_args.port,
+        max_depth=_args.max_depth,
+        slow_consumer_policy=SlowConsumerPolicy(_args.slow_consumer_policy),
+        send_timeout=_args.send_timeout,
+        stats_interval=_args.stats_interval,
     )
     distributor.start()
@@ -9,7 +9,7 @@ import numpy as np
 from trade.broker.declarative.model import NormalizedPositions, Position
 from trade.broker.declarative.queue import LifoQueue as LifoQueueClearable
 from trade.execution.model import SwitchedToRealtime, Execution
-from trade.model import Symbol
+from trade.model import Symbol, Precision
 from trade.side import Side
 from trade.sign import Signal
 from trade.strategies import Strategies
@@ -55,9 +55,11 @@ class StrategiesStub(Strategies):
                     self._logger.info('imitating same side')
                     continue
 
+                # 固定小数点モードの価格は、ブローカーへの発注の境界でDecimalに変換します
                 positions_queue.put_nowait(NormalizedPositions({
                     Symbol.FXBTCJPY: Position(
-                        symbol=execution.symbol, side=signal.side, price=signal.price, size=self._size
+                        symbol=execution.symbol, side=signal.side,
+                        price=Precision.of(execution.symbol).decimal_price(signal.price), size=self._size
                     )
                 }))
                 self._prev_signal = signal
@@ -132,7 +132,8 @@ class RocDrawDown(DrawDownBase):
             else:
                 price_delta = self._held_price - price
 
-            roc = (price_delta / self._held_price) + self._roc_offset
+            # 固定小数点の整数同士の除算がfloatにならないよう、Decimalで計算します
+            roc = (Decimal(price_delta) / self._held_price) + self._roc_offset
 
             if Decimal('0') < roc:
                 self._value = Decimal('0.0')
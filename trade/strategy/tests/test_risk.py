@@ -118,6 +118,24 @@ class PercentageDrawDownTestCase(unittest.TestCase):
         dd.apply(price=Decimal('98'))
         self.assertEqual(Decimal('-0.01'), dd.get_value())
 
+    def test_apply_fixed_point(self):
+        logger = get_logger(self.test_apply_fixed_point.__name__)
+
+        dd = RocDrawDown(logger=logger)
+
+        dd.start_period(held_side=Side.BUY, initial_price=10000, initial_roc=Decimal('0'))
+
+        dd.apply(price=10010)
+        self.assertEqual(Decimal('0.0'), dd.get_value())
+        dd.apply(price=9999)
+        self.assertEqual(Decimal('-0.0001'), dd.get_value())
+        self.assertIsInstance(dd.get_value(), Decimal)
+
+        dd.start_period(held_side=Side.SELL, initial_price=10000, initial_roc=Decimal('0'))
+
+        dd.apply(price=10100)
+        self.assertEqual(Decimal('-0.01'), dd.get_value())
+
 
 def test_suite():
     suite = unittest.TestSuite()
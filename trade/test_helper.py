@@ -6,7 +6,7 @@ from unittest import TestCase
 
 import numpy as np
 
-from trade.execution.model import Execution
+from trade.execution.model import Execution, ExecutionBatch
 from trade.execution.model import SynchronizedExecution
 from trade.model import Symbol
 from trade.side import Side
@@ -81,3 +81,13 @@ def build_iterator(executions: List[Execution]) -> AsyncIterable[Execution]:
                 yield e
 
     return _Iterator()
+
+
+def build_batch_iterator(executions: List[Execution], batch_size: int) -> AsyncIterable[ExecutionBatch]:
+    class _Iterator(AsyncIterable[ExecutionBatch]):
+        async def __aiter__(self) -> AsyncIterator[ExecutionBatch]:
+            for n in range(0, len(executions), batch_size):
+                chunk = executions[n:n + batch_size]
+                yield ExecutionBatch.from_executions(symbol=chunk[0].symbol, executions=chunk)
+
+    return _Iterator()